@@ -0,0 +1,173 @@
+import functools
+import itertools
+import os
+import gevent
+import psutil as ps
+from gevent.monkey import get_original
+from gevent.threadpool import ThreadPool
+from ncpa import listener_logger as logging
+
+# Monkey patching makes sockets and sleeps cooperative, but not psutil, stat
+# calls or sqlite. Walking thousands of processes or a stat on a stalled
+# network mount would freeze every greenlet in the listener (websocket
+# streams, other requests, the sampler) until it returned. Calls like these
+# are made in a pool of native threads instead, so only the greenlet that
+# asked for the value waits, and only for as long as the timeout.
+
+# The native thread ident, not the greenlet's
+get_ident = get_original('_thread', 'get_ident')
+
+# Calls that can block for a long time, call() runs these in the pool
+methods = set([ps.disk_usage, ps.disk_partitions])
+if hasattr(os, 'statvfs'):
+    methods.add(os.statvfs)
+
+# Number of threads, 0 makes the calls inline, and the seconds to wait for
+# a call before giving up on it
+size = 4
+default_timeout = 10
+
+# Passed as the timeout to wait for a call for as long as it takes
+forever = -1
+
+# The pool of this process (workers each have their own) and the thread
+# that uses it
+pool = None
+pool_pid = None
+pool_thread = None
+
+# Calls that are running, by method and arguments, so the same call is not
+# made again while it is stuck (on a hung mount each new call would take
+# another thread)
+pending = {}
+
+# Number of calls that have timed out
+timeouts = 0
+
+
+class BlockingTimeout(Exception):
+    pass
+
+
+def setup(config):
+    """Sets the number of threads and the timeout from the config."""
+    global size, default_timeout
+
+    try:
+        size = config.getint('listener', 'blocking_threads')
+    except Exception:
+        size = 4
+    try:
+        default_timeout = config.getfloat('listener', 'blocking_timeout')
+    except Exception:
+        default_timeout = 10
+
+
+def get_pool():
+    """Returns the thread pool of this process, or None if calls should be
+    made inline (no threads or called from a thread other than the hub's).
+
+    """
+    global pool, pool_pid, pool_thread
+
+    if size < 1:
+        return None
+    if pool is None or pool_pid != os.getpid():
+        pool = ThreadPool(size)
+        pool_pid = os.getpid()
+        pool_thread = get_ident()
+        pending.clear()
+    if get_ident() != pool_thread:
+        return None
+    return pool
+
+
+def describe(method, args):
+    name = getattr(method, '__name__', repr(method))
+    return '%s(%s)' % (name, ', '.join(repr(x) for x in args))
+
+
+def apply(method, args=(), kwargs=None, timeout=None):
+    """Returns method(*args, **kwargs), run in the thread pool. Raises
+    BlockingTimeout if it takes longer than timeout seconds (the default
+    from the config when None, no limit when forever), the call itself keeps
+    running in its thread.
+
+    """
+    global timeouts
+
+    kwargs = kwargs or {}
+    current = get_pool()
+    if current is None:
+        return method(*args, **kwargs)
+    if timeout is None:
+        timeout = default_timeout
+    elif timeout == forever:
+        timeout = None
+
+    try:
+        key = (method, args, tuple(sorted(kwargs.items())))
+        hash(key)
+    except TypeError:
+        key = None
+
+    result = pending.get(key, None) if key is not None else None
+    if result is None:
+        result = current.spawn(method, *args, **kwargs)
+        if key is not None:
+            pending[key] = result
+            result.rawlink(lambda _, key=key: pending.pop(key, None))
+
+    try:
+        return result.get(timeout=timeout)
+    except gevent.Timeout:
+        timeouts += 1
+        logging.warning("%s did not return within %ss", describe(method, args), timeout)
+        raise BlockingTimeout("%s did not return within %s seconds" % (describe(method, args), timeout))
+
+
+def call(method, *args, **kwargs):
+    """Calls method, in the thread pool if it is one of the blocking methods."""
+    if method in methods:
+        return apply(method, args, kwargs)
+    return method(*args, **kwargs)
+
+
+def take(iterator, count):
+    return list(itertools.islice(iterator, count))
+
+
+def iterate(iterable, count=100, timeout=None):
+    """Yields the items of iterable, taking count of them at a time in the
+    thread pool. The timeout is for each batch.
+
+    """
+    iterator = iter(iterable)
+    while True:
+        items = apply(take, (iterator, count), timeout=timeout)
+        if not items:
+            return
+        for item in items:
+            yield item
+
+
+def offload(method):
+    """Decorates a method so that it is run in the thread pool. The caller
+    waits for it however long it takes, as it would for the method itself,
+    so the method keeps what it returns and raises and never carries on
+    running after the caller has moved on.
+
+    """
+    @functools.wraps(method)
+    def offloaded(*args, **kwargs):
+        return apply(method, args, kwargs, timeout=forever)
+    return offloaded
+
+
+def get_stats():
+    return {
+        'threads': size,
+        'timeout': default_timeout,
+        'running': len(pending),
+        'timeouts': timeouts,
+    }
@@ -0,0 +1,200 @@
+import time
+import gevent.event
+from ncpa import listener_logger as logging
+
+# A cache for the results of API calls. Identical calls that arrive while one
+# is already running wait for its result instead of collecting the metrics
+# again (single-flight), and results can be kept for a number of seconds set
+# per part of the API tree in the [api cache] section of the config.
+
+# Finished results by key, as (time, result)
+results = {}
+
+# Calls that are running by key, as an AsyncResult the waiting calls share
+in_flight = {}
+
+# Limit on the number of results kept
+max_results = 1024
+
+# Seconds a call waits for the same call that is already running
+wait_timeout = 60
+
+# Arguments that do not change the result of a call
+ignored_args = ("token", "max_age", "snapshot", "config", "remote_addr", "debug", "accessor")
+
+
+def make_key(path, request_args):
+    """Returns the cache key for a call to the node at path (a list of path
+    segments) with the given request arguments.
+
+    """
+    args = []
+    for name, value in request_args.items():
+        if name in ignored_args:
+            continue
+        if isinstance(value, list):
+            value = tuple(value)
+        args.append((name, value))
+    return ("/".join(path), tuple(sorted(args, key=repr)))
+
+
+def get_ttl(config, path):
+    """Returns the number of seconds results for the node at path may be kept,
+    using the longest matching path in the [api cache] section of the config.
+    Entries may end with /* to only match the nodes below.
+
+    """
+    try:
+        ttls = config.items("api cache")
+    except Exception as e:
+        return 0
+
+    accessor = "/".join(path).lower()
+    best, ttl = -1, 0
+    for prefix, value in ttls:
+        prefix = prefix.strip("/")
+        if prefix.endswith("/*"):
+            prefix = prefix[:-2]
+            matches = accessor.startswith(prefix + "/")
+        else:
+            matches = accessor == prefix or accessor.startswith(prefix + "/")
+        if matches and len(prefix) > best:
+            try:
+                ttl = float(value)
+            except ValueError:
+                logging.warning("Invalid cache time for %s in [api cache]: %s", prefix, value)
+                continue
+            best = len(prefix)
+    return ttl
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+def wait_for(waiting, key):
+    """Returns the result of a running call, raising what it raised."""
+    try:
+        return waiting.get(timeout=wait_timeout)
+    except gevent.Timeout:
+        # A call that never finishes is not waited for again
+        if in_flight.get(key, None) is waiting:
+            del in_flight[key]
+        raise WaitTimeout("Timed out waiting %ss for the same call to %s" % (wait_timeout, key[0]))
+
+
+def set_failed(waiting, exc):
+    """Passes the exception of a call on to the calls waiting for it. If
+    the call was killed or timed out (GreenletExit, gevent.Timeout) the
+    waiting calls get an error rather than being stopped as well.
+
+    """
+    if not isinstance(exc, Exception):
+        exc = Exception("The call they waited for was stopped: %r" % exc)
+    waiting.set_exception(exc)
+
+
+def get(key, ttl, method):
+    """Returns the result of method() for key. A result up to ttl seconds old
+    is reused, and if the same key is already being worked out this waits
+    for it instead of running method again.
+
+    """
+    now = time.monotonic()
+    if ttl > 0:
+        try:
+            created, result = results[key]
+            if now - created <= ttl:
+                return result
+        except KeyError:
+            pass
+
+    waiting = in_flight.get(key, None)
+    if waiting is not None:
+        return wait_for(waiting, key)
+
+    waiting = gevent.event.AsyncResult()
+    in_flight[key] = waiting
+    try:
+        result = method()
+    except BaseException as e:
+        set_failed(waiting, e)
+        raise
+    else:
+        waiting.set(result)
+        if ttl > 0:
+            store(key, result)
+        return result
+    finally:
+        if in_flight.get(key, None) is waiting:
+            del in_flight[key]
+
+
+def store(key, result):
+    if len(results) >= max_results:
+        results.clear()
+    results[key] = (time.monotonic(), result)
+
+
+def get_stream(key, ttl, method):
+    """Like get() for a walk that is sent in pieces, method() returns a
+    generator of the JSON. The pieces are passed on as they are produced.
+    Calls for the same key that arrive before the first piece (or within ttl
+    seconds) get the whole JSON once it is done, as a list of one piece.
+
+    """
+    key = key + ("stream",)
+    if ttl > 0:
+        try:
+            created, result = results[key]
+            if time.monotonic() - created <= ttl:
+                return [result]
+        except KeyError:
+            pass
+
+    waiting = in_flight.get(key, None)
+    if waiting is not None:
+        return [wait_for(waiting, key)]
+
+    # Registered before the walk starts so calls that arrive while it gets
+    # ready (the ?sleep= of processes) share it, errors before the first
+    # piece fail the request itself
+    waiting = gevent.event.AsyncResult()
+    in_flight[key] = waiting
+
+    def release():
+        if in_flight.get(key, None) is waiting:
+            del in_flight[key]
+
+    try:
+        pieces_iter = method()
+    except BaseException as e:
+        set_failed(waiting, e)
+        release()
+        raise
+
+    def stream():
+        # The whole JSON is only kept if it is cached or calls are waiting
+        # for it, otherwise the pieces are passed straight on and calls that
+        # arrive from now on make their own walk
+        pieces = [] if ttl > 0 or waiting.linkcount() else None
+        if pieces is None:
+            release()
+        try:
+            for piece in pieces_iter:
+                if pieces is not None:
+                    pieces.append(piece)
+                yield piece
+        except BaseException as e:
+            set_failed(waiting, e)
+            raise
+        else:
+            if pieces is not None:
+                result = "".join(pieces)
+                waiting.set(result)
+                if ttl > 0:
+                    store(key, result)
+        finally:
+            release()
+
+    return stream()
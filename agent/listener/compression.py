@@ -0,0 +1,263 @@
+import zlib
+from geventwebsocket.handler import WebSocketHandler
+from geventwebsocket.websocket import WebSocket, Header, Stream
+from geventwebsocket.exceptions import ProtocolError, WebSocketError
+from ncpa import listener_logger as logging
+
+# Compression of API responses (gzip or deflate, picked from the request's
+# Accept-Encoding) and websocket messages (the permessage-deflate extension
+# from RFC 7692, when the browser offers it). Large walks like processes and
+# services are repetitive JSON and usually shrink to a tenth of their size.
+
+# Settings, replaced by setup() when the listener starts
+enabled = True
+min_size = 1024
+level = 6
+
+# Only the API's JSON and text responses are compressed. The GUI and admin
+# pages show secrets (tokens, passwords) next to text an attacker can get
+# reflected into them, which compression would leak through the response
+# size (BREACH), so they are always sent as they are.
+compressible_types = ('application/json', 'application/openmetrics-text', 'text/plain')
+compressible_paths = ('/api/', '/metrics')
+
+
+def is_compressible(path):
+    return any(path == x or path.startswith(x) for x in compressible_paths)
+
+# Totals of the bytes before and after compression, to see what it saves
+stats = {'responses': 0, 'messages': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+
+def count(kind, size_in, size_out):
+    stats[kind] += 1
+    stats['bytes_in'] += size_in
+    stats['bytes_out'] += size_out
+
+
+def get_bytes_saved():
+    return stats['bytes_in'] - stats['bytes_out']
+
+
+def make_compressor(encoding):
+    # gzip and zlib (HTTP deflate) only differ in the header zlib writes
+    wbits = 31 if encoding == 'gzip' else 15
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def compress_stream(chunks, encoding):
+    """Compresses a streamed response chunk by chunk. Each chunk is flushed
+    so the client gets the data as soon as it is produced.
+
+    """
+    compressor = make_compressor(encoding)
+    size_in, size_out = 0, 0
+    for chunk in chunks:
+        size_in += len(chunk)
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        size_out += len(data)
+        yield data
+    data = compressor.flush()
+    size_out += len(data)
+    count('responses', size_in, size_out)
+    yield data
+
+
+def compress_response(response, accept_encodings, path):
+    """Compresses the response to a request for path (an API or metrics
+    path) with the best encoding the client accepts. Responses smaller than
+    min_size are left alone, streamed responses are always compressed as
+    they are the large ones.
+
+    """
+    if not enabled or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in compressible_types or not is_compressible(path):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = accept_encodings.best_match(('gzip', 'deflate'))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        if response.content_length is not None and response.content_length < min_size:
+            return response
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.direct_passthrough = False
+        del response.headers['Content-Length']
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        compressor = make_compressor(encoding)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) >= len(data):
+            return response
+        count('responses', len(data), len(compressed))
+        response.set_data(compressed)
+
+    # The compressed body is a different representation of the resource
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def negotiate_deflate(offers):
+    """Returns (window_bits, reset_context, response) for the first
+    permessage-deflate offer in the Sec-WebSocket-Extensions header that can
+    be accepted, or None.
+
+    """
+    if not enabled:
+        return None
+
+    for offer in offers.split(','):
+        params = [x.strip() for x in offer.split(';')]
+        if params[0] != 'permessage-deflate':
+            continue
+
+        # The client starts each message with a fresh context, so it is
+        # enough to keep one decompressor per message
+        window_bits, reset_context = 15, False
+        response = ['permessage-deflate', 'client_no_context_takeover']
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            name, value = name.strip(), value.strip().strip('"')
+            if name == 'server_no_context_takeover':
+                reset_context = True
+                response.append(name)
+            elif name == 'server_max_window_bits':
+                try:
+                    window_bits = int(value)
+                except ValueError:
+                    break
+                # zlib can not write raw deflate with a window of 8 bits
+                if not 9 <= window_bits <= 15:
+                    break
+                response.append('%s=%d' % (name, window_bits))
+            elif name not in ('client_no_context_takeover', 'client_max_window_bits'):
+                break
+        else:
+            return window_bits, reset_context, '; '.join(response)
+    return None
+
+
+class DeflateWebSocket(WebSocket):
+    """A websocket using the permessage-deflate extension. Messages smaller
+    than min_size are sent as they are.
+
+    """
+
+    def __init__(self, environ, stream, handler, window_bits=15, reset_context=False):
+        super(DeflateWebSocket, self).__init__(environ, stream, handler)
+        self.window_bits = window_bits
+        self.reset_context = reset_context
+        self.compressor = None
+        self.decompressor = None
+
+    def compress(self, data):
+        # Keeping the context lets repeated messages (top, graphs) refer back
+        # to the previous ones, unless the client asked us not to
+        if self.compressor is None or self.reset_context:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -self.window_bits)
+        data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        # The empty block the flush ends with is left off (RFC 7692 7.2.1)
+        return data[:-4]
+
+    def send_frame(self, message, opcode):
+        if self.closed or opcode not in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            return super(DeflateWebSocket, self).send_frame(message, opcode)
+
+        if opcode == self.OPCODE_TEXT:
+            data = self._encode_bytes(message)
+        else:
+            data = bytes(message)
+        if len(data) < min_size:
+            return super(DeflateWebSocket, self).send_frame(message, opcode)
+
+        size = len(data)
+        data = self.compress(data)
+        count('messages', size, len(data))
+        header = Header.encode_header(True, opcode, b'', len(data), Header.RSV0_MASK)
+        try:
+            self.raw_write(header + data)
+        except OSError:
+            raise WebSocketError("Socket is dead")
+
+    def read_frame(self):
+        header = Header.decode_header(self.stream)
+
+        # RSV1 (RSV0_MASK here) marks the first frame of a compressed message
+        compressed = header.flags == Header.RSV0_MASK
+        if header.flags and not compressed:
+            raise ProtocolError
+        if compressed and header.opcode not in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            raise ProtocolError
+        header.flags = 0
+
+        payload = b''
+        if header.length:
+            payload = self.raw_read(header.length)
+            if len(payload) != header.length:
+                raise WebSocketError('Unexpected EOF reading frame payload')
+            if header.mask:
+                payload = header.unmask_payload(payload)
+
+        if header.opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            self.decompressor = zlib.decompressobj(-15) if compressed else None
+        elif header.opcode != self.OPCODE_CONTINUATION:
+            return header, payload
+
+        if self.decompressor is not None:
+            if header.fin:
+                payload += b'\x00\x00\xff\xff'
+            payload = self.decompressor.decompress(payload)
+            if header.fin:
+                self.decompressor = None
+        return header, payload
+
+
+class DeflateWebSocketHandler(WebSocketHandler):
+    """The websocket handler for the listener, which accepts the browser's
+    permessage-deflate offer when compression is enabled.
+
+    """
+    deflate = None
+
+    def upgrade_connection(self):
+        self.deflate = negotiate_deflate(self.environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS', ''))
+        result = super(DeflateWebSocketHandler, self).upgrade_connection()
+
+        if self.deflate is not None and getattr(self, 'websocket', None) is not None:
+            window_bits, reset_context, response = self.deflate
+
+            # Mark the plain websocket closed so dropping it does not send a
+            # close frame on the connection
+            self.websocket.closed = True
+            self.websocket = DeflateWebSocket(self.environ, Stream(self), self, window_bits, reset_context)
+            self.environ['wsgi.websocket'] = self.websocket
+            logging.debug("Websocket using %s", response)
+        return result
+
+    def start_response(self, status, headers, exc_info=None):
+        if self.deflate is not None and status.startswith('101'):
+            headers = list(headers) + [('Sec-WebSocket-Extensions', self.deflate[2])]
+        return super(DeflateWebSocketHandler, self).start_response(status, headers, exc_info)
+
+
+def setup(config):
+    """Reads the compression settings for the listener from the config."""
+    global enabled, min_size
+
+    try:
+        enabled = config.getboolean('listener', 'compression')
+    except Exception as e:
+        enabled = True
+    try:
+        min_size = config.getint('listener', 'compression_min_size')
+    except Exception as e:
+        min_size = 1024
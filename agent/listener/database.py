@@ -3,11 +3,15 @@ import time
 import sqlite3
 import sys
 import listener.server
+import listener.instrument as instrument
+import listener.blocking as blocking
 
 from ncpa import listener_logger as logging
 
 # A module to wrap sqlite3 for use with a small database to store things
-# like checks across both passive and active sections
+# like checks across both passive and active sections. Queries can wait on
+# the database lock for a while, so they run in the blocking thread pool
+# (without its timeout, sqlite's own timeout applies as it did before).
 
 class DB(object):
 
@@ -20,7 +24,8 @@ class DB(object):
 
     # Connect to the NCPA database
     def connect(self):
-        self.conn = sqlite3.connect(self.dbfile, isolation_level=None, timeout=30)
+        # Queries run in the pool's threads, one at a time for each DB object
+        self.conn = sqlite3.connect(self.dbfile, isolation_level=None, timeout=30, check_same_thread=False)
         self.cursor = self.conn.cursor()
 
     def get_cursor(self):
@@ -29,6 +34,7 @@ class DB(object):
     def close(self):
         self.conn.close()
 
+    @blocking.offload
     def truncate(self, dbname):
         self.cursor.execute('DROP TABLE %s' % dbname)
         self.cursor.execute('VACUUM')
@@ -36,6 +42,7 @@ class DB(object):
         return True
 
     # This is called on both passive and listener startup
+    @blocking.offload
     def setup(self):
         
         # Create main check results database and migration database
@@ -45,6 +52,7 @@ class DB(object):
         # Run migrations
         self.run_migrations()
 
+    @blocking.offload
     def run_db_maintenance(self, config):
         try:
             days = config.getint('general', 'check_logging_time')
@@ -62,14 +70,17 @@ class DB(object):
         pass
 
     # Add a check to the check database
+    @blocking.offload
     def add_check(self, accessor, run_time_start, run_time_end, result, output, sender, checktype):
         data = (accessor, run_time_start, run_time_end, result, output, sender, checktype)
         try:
-            self.cursor.execute('INSERT INTO checks VALUES (?, ?, ?, ?, ?, ?, ?)', data)
+            with instrument.timed('database', 'add_check'):
+                self.cursor.execute('INSERT INTO checks VALUES (?, ?, ?, ?, ?, ?, ?)', data)
         except Exception as ex:
             logging.exception(ex)
 
     # Returns the total amount of checks in the DB
+    @blocking.offload
     def get_checks_count(self, search='', status='', senders=[]):
         where = False
         data = ()
@@ -107,6 +118,7 @@ class DB(object):
         return count
 
     # Returns a list of distinct senders for filtering
+    @blocking.offload
     def get_check_senders(self):
         cmd = "SELECT DISTINCT sender FROM checks"
 
@@ -120,6 +132,7 @@ class DB(object):
         return senders
 
     # Special functions for getting check results
+    @blocking.offload
     def get_checks(self, search='', size=20, page=1, status='', ctype='', senders=[]):
         where = False
         data = ()
@@ -0,0 +1,242 @@
+import collections
+import hashlib
+import json
+import os
+import time
+import gevent
+import ncpa
+import listener.blocking as blocking
+import listener.workers as workers
+from ncpa import listener_logger as logging
+
+# The delta store keeps the last values sent to each caller for each delta
+# accessor, so the next request can be turned into a per second rate. It is
+# a bounded LRU in memory, and can optionally be saved to a single file (every
+# save_interval seconds and at exit) so the previous values survive a restart
+# of the listener.
+
+# The store used by the nodes, replaced by setup() when the listener starts
+store = None
+
+
+def make_key(*parts):
+    """Returns a digest of the parts (accessor, node name, remote address)
+    that stays the same between runs, unlike hash().
+
+    """
+    data = "\0".join(str(x) for x in parts if x is not None)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+def get_counter_rate(before, after, seconds):
+    """Returns the per second rate of a counter that went from before to after,
+    or None if the counter was reset. A counter that goes down from close to
+    the top of a 32 or 64 bit range to close to 0 has wrapped around, any
+    other drop is a reset (interface flap, disk hot-plugged, reboot).
+
+    """
+    if after >= before:
+        return (after - before) / seconds
+    size = 2 ** 32 if before < 2 ** 32 else 2 ** 64
+    if before >= size * 3 // 4 and after < size // 4:
+        return (size - before + after) / seconds
+    return None
+
+
+def get_rates(before, after, seconds, counter=False):
+    """Returns the per second rates between two lists of values, rounded to
+    two places. Counters that were reset have a rate of None.
+
+    """
+    rates = []
+    for b, a in zip(before, after):
+        if counter:
+            rate = get_counter_rate(b, a, seconds)
+        else:
+            rate = (a - b) / seconds
+        rates.append(rate if rate is None else round(rate, 2))
+    return rates
+
+
+def get_delta_rates(key, values, counter=False, collected=None):
+    """Stores values for key and returns the per second rates since the values
+    stored before. collected is the monotonic time the values were collected
+    at (now if None). The first request for a key gets zeros. A counter that
+    was reset gets its last good rate, as the sample can't give a real one,
+    and so do values from the same sample as the last request.
+
+    """
+    store = get_store()
+    previous = store.update(key, values, collected)
+    if previous is None:
+        store.set_rates(key, None)
+        return [0 for x in values]
+
+    before, seconds, last_rates = previous
+    if seconds <= 0:
+        if last_rates is not None and len(last_rates) == len(values):
+            return last_rates
+        return [0 for x in values]
+    rates = get_rates(before, values, seconds, counter)
+    for index, rate in enumerate(rates):
+        if rate is None:
+            logging.info("Counter reset detected, discarding the sample for %s", key)
+            try:
+                rates[index] = last_rates[index]
+            except (IndexError, TypeError):
+                rates[index] = 0
+    store.set_rates(key, rates)
+    return rates
+
+
+class DeltaStore(object):
+
+    def __init__(self, max_entries=4096, filename=None, save_interval=60):
+        self.max_entries = max_entries
+        self.filename = filename
+        self.save_interval = save_interval
+        self.entries = collections.OrderedDict()
+        self.changed = False
+        self.greenlet = None
+
+    def update(self, key, values, collected=None):
+        """Stores values for key, collected at the monotonic time collected
+        (now if None), and returns the (values, seconds, rates) stored before
+        them, or None if there was nothing stored for key.
+
+        """
+        now = time.monotonic()
+        if collected is None:
+            collected = now
+        previous = self.entries.pop(key, None)
+        rates = previous[3] if previous is not None else None
+        self.entries[key] = (collected, time.time() - (now - collected), values, rates)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        self.changed = True
+
+        if previous is None:
+            return None
+        return previous[2], collected - previous[0], previous[3]
+
+    def set_rates(self, key, rates):
+        """Keeps the last rates worked out for key, see get_delta_rates()."""
+        try:
+            self.entries[key] = self.entries[key][:3] + (rates,)
+        except KeyError:
+            pass
+
+    def get_data(self):
+        """Returns the JSON of the entries, with wall clock timestamps as
+        monotonic times mean nothing to another process.
+
+        """
+        data = dict((key, [timestamp, values, rates]) for key, (mono, timestamp, values, rates) in self.entries.items())
+        return json.dumps(data, separators=(",", ":"))
+
+    def write(self, data):
+        tmpfile = self.filename + ".tmp"
+        try:
+            with open(tmpfile, "w") as f:
+                f.write(data)
+            os.replace(tmpfile, self.filename)
+        except (IOError, OSError) as e:
+            logging.error("Could not save the delta store to %s: %r", self.filename, e)
+            return False
+        return True
+
+    def save(self, offload=False):
+        """Writes the entries to the store's file if they changed, in the
+        blocking thread pool if offload is set.
+
+        """
+        if not self.filename or not self.changed:
+            return
+        try:
+            data = self.get_data()
+        except (TypeError, ValueError) as e:
+            logging.error("Could not save the delta store to %s: %r", self.filename, e)
+            return
+        self.changed = False
+        if offload:
+            written = blocking.apply(self.write, (data,), timeout=blocking.forever)
+        else:
+            written = self.write(data)
+        if not written:
+            self.changed = True
+
+    def run(self):
+        # Saved on a timer rather than by the requests, with the write made
+        # in the thread pool so it does not hold them up
+        while True:
+            gevent.sleep(self.save_interval)
+            self.save(offload=True)
+
+    def start(self):
+        if self.filename:
+            self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def load(self):
+        if not self.filename or not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logging.error("Could not load the delta store from %s: %r", self.filename, e)
+            return
+
+        # Map the saved wall clock times on to the monotonic clock
+        offset = time.monotonic() - time.time()
+        entries = sorted(data.items(), key=lambda x: x[1][0])
+        for key, entry in entries[-self.max_entries:]:
+            try:
+                timestamp, values, rates = entry
+            except ValueError:
+                continue
+            self.entries[key] = (timestamp + offset, timestamp, values, rates)
+
+
+def setup(config):
+    """Creates the delta store for the listener from the config."""
+    global store
+
+    try:
+        max_entries = config.getint("listener", "delta_store_size")
+    except Exception as e:
+        max_entries = 4096
+    try:
+        filename = config.get("listener", "delta_store_file").strip()
+    except Exception as e:
+        filename = ""
+
+    if filename in ("", "None"):
+        filename = None
+    else:
+        filename = ncpa.get_filename(filename)
+
+        # Each listener worker keeps its own file
+        if workers.slot is not None:
+            filename += ".%d" % workers.slot
+
+    if store is not None:
+        store.stop()
+    store = DeltaStore(max_entries, filename)
+    if filename:
+        store.load()
+        store.start()
+        workers.at_exit(store.save)
+    return store
+
+
+def get_store():
+    global store
+    if store is None:
+        store = DeltaStore()
+    return store
@@ -0,0 +1,160 @@
+import contextlib
+import functools
+import time
+
+# Timings of the listener itself: latency histograms, call counts and error
+# counts by subsystem (api, getter, walk, check, plugin, database) and key
+# (an accessor prefix, node or plugin name). They are served at
+# /api/agent/stats and shown on the GUI dashboard.
+
+# Upper bounds of the histogram buckets in seconds
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+# Histograms by subsystem, then key
+timings = {}
+
+# Limit on the number of keys kept per subsystem, later keys are counted
+# under "other"
+max_keys = 256
+
+# Number of accessor segments used as the key for API calls
+prefix_depth = 2
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(buckets)
+
+    def observe(self, seconds, error=False):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+        for index, bound in enumerate(buckets):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket the percentile falls in."""
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min(buckets[index], self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg': round(self.total / self.count, 6) if self.count else 0,
+            'max': round(self.max, 6),
+            'p50': round(self.percentile(50), 6),
+            'p95': round(self.percentile(95), 6),
+            'p99': round(self.percentile(99), 6),
+            'buckets': dict(('%g' % bound, count) for bound, count in zip(buckets, self.buckets)),
+        }
+
+
+def get_prefix(accessor, depth=None):
+    """Returns the first segments of an accessor, which the API calls are
+    grouped by (e.g. disk/logical).
+
+    """
+    if depth is None:
+        depth = prefix_depth
+    if isinstance(accessor, (list, tuple)):
+        parts = accessor
+    else:
+        parts = [x for x in str(accessor).strip('/').split('/') if x]
+    return '/'.join(parts[:depth]) or '/'
+
+
+def observe(subsystem, key, seconds, error=False):
+    histograms = timings.setdefault(subsystem, {})
+    histogram = histograms.get(key, None)
+    if histogram is None:
+        if len(histograms) >= max_keys:
+            key = 'other'
+        histogram = histograms.setdefault(key, Histogram())
+    histogram.observe(seconds, error)
+
+
+@contextlib.contextmanager
+def timed(subsystem, key):
+    """Times the block, which counts as an error if it raises."""
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe(subsystem, key, time.perf_counter() - start, error)
+
+
+def timed_method(subsystem, get_key):
+    """Decorates a method to time its calls, get_key returns the key from
+    the same arguments as the method.
+
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with timed(subsystem, get_key(*args, **kwargs)):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(subsystem, key, iterable, start=None):
+    """Yields from iterable and times it until it is used up, for responses
+    that are streamed after the view returns.
+
+    """
+    if start is None:
+        start = time.perf_counter()
+    error = False
+    try:
+        for item in iterable:
+            yield item
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe(subsystem, key, time.perf_counter() - start, error)
+
+
+def get_stats():
+    return dict(
+        (subsystem, dict((key, histogram.as_dict()) for key, histogram in histograms.items()))
+        for subsystem, histograms in timings.items()
+    )
+
+
+def get_summary(subsystem='api', limit=10):
+    """Returns the keys of a subsystem with the most calls, as a list of
+    (key, count, errors, avg ms, p95 ms) for the GUI.
+
+    """
+    histograms = sorted(timings.get(subsystem, {}).items(), key=lambda x: x[1].count, reverse=True)
+    summary = []
+    for key, histogram in histograms[:limit]:
+        summary.append((key, histogram.count, histogram.errors,
+                        round(histogram.total / histogram.count * 1000, 1),
+                        round(histogram.percentile(95) * 1000, 1)))
+    return summary
+
+
+def reset():
+    timings.clear()
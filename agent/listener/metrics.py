@@ -0,0 +1,234 @@
+import collections
+import math
+import re
+import listener.psapi as psapi
+from listener.nodes import RunnableNode
+from listener.snapshot import Snapshot
+from ncpa import listener_logger as logging
+
+# Renders the API tree as OpenMetrics (or the older Prometheus text format)
+# for the /metrics endpoint. The metric names come from the path of each node
+# and the names of instances (mounts, disks, interfaces) become labels, so the
+# output follows the tree without a list of metrics to keep up to date.
+
+# Subtrees that are always rendered, all read through one snapshot
+default_subtrees = ('cpu', 'memory', 'disk', 'interface', 'system', 'user')
+
+# Subtrees that are expensive to collect and have to be asked for with
+# ?include=processes,services
+optional_subtrees = ('processes', 'services')
+
+# Paths whose children are instances, and the label their names go in
+instance_labels = {
+    'disk/logical': 'mount',
+    'disk/mount': 'mount',
+    'disk/physical': 'disk',
+    'interface': 'interface',
+}
+
+# Nodes that return one value per cpu
+per_cpu = ('cpu/idle', 'cpu/percent', 'cpu/system', 'cpu/user')
+
+# Nodes that repeat others in a form only meant for checks
+skipped = ('user/countlist', 'user/list')
+
+# psutil reports cpu times in seconds
+unit_overrides = {'cpu/idle': 's', 'cpu/system': 's', 'cpu/user': 's'}
+
+# Units of the API that have an OpenMetrics base unit, and what to divide by
+base_units = {
+    'B': ('bytes', 1),
+    's': ('seconds', 1),
+    'ms': ('seconds', 1000),
+    '%': ('percent', 1),
+}
+
+invalid_name_chars = re.compile(r'[^a-zA-Z0-9_]')
+
+openmetrics_type = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+prometheus_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Family(object):
+
+    def __init__(self, name, metric_type, unit, help_text):
+        self.name = name
+        self.type = metric_type
+        self.unit = unit
+        self.help = help_text
+        self.samples = []
+
+
+def make_name(path, unit=''):
+    name = invalid_name_chars.sub('_', 'ncpa_' + '_'.join(path)).lower()
+    if unit and unit not in name.split('_'):
+        name += '_' + unit
+    return name
+
+
+def scale(value, divisor):
+    return value / divisor if divisor != 1 else value
+
+
+def get_family(families, name, metric_type, unit, help_text):
+    family = families.get(name, None)
+    if family is None:
+        family = families[name] = Family(name, metric_type, unit, help_text)
+    return family
+
+
+def add_samples(node, path, labels, kwargs, families):
+    """Adds the samples of one node to the families. Returns the node's value
+    if it is text, so the parent can put it on its info metric.
+
+    """
+    key = '/'.join(path)
+    if key in skipped:
+        return None
+
+    try:
+        try:
+            values, unit = node.method(**kwargs)
+        except TypeError:
+            values, unit = node.method()
+    except Exception as e:
+        logging.debug("Could not collect %s for the metrics: %r", key, e)
+        return None
+
+    if isinstance(values, str):
+        return values
+    if isinstance(values, (list, tuple)):
+        if values and all(isinstance(x, str) for x in values):
+            return ','.join(values)
+        if len(values) == 1 and key not in per_cpu:
+            values = values[0]
+    if values is None or values == []:
+        return None
+
+    unit, divisor = base_units.get(unit_overrides.get(key, unit), ('', 1))
+    metric_type = 'counter' if node.counter else 'gauge'
+    family = get_family(families, make_name(path, unit), metric_type, unit, key)
+
+    if isinstance(values, (list, tuple)):
+        label = 'cpu' if key in per_cpu else 'index'
+        for index, value in enumerate(values):
+            if isinstance(value, (int, float)):
+                family.samples.append(('', labels + ((label, str(index)),), scale(value, divisor)))
+    elif isinstance(values, (int, float)):
+        family.samples.append(('', labels, scale(values, divisor)))
+    return None
+
+
+def collect(node, path, labels, kwargs, families, instance=False):
+    """Adds the samples of the nodes below node to the families. The nodes
+    below an instance keep the path of their parent and get its label.
+
+    """
+    label = None if instance else instance_labels.get('/'.join(path), None)
+    info = []
+
+    for name, child in node.children.items():
+        if label is not None:
+            value = name.replace('|', '/') if label == 'mount' else name
+            collect(child, path, labels + ((label, value),), kwargs, families, True)
+        elif isinstance(child, RunnableNode):
+            text = add_samples(child, path + [name], labels, kwargs, families)
+            if text:
+                info.append((invalid_name_chars.sub('_', name), text))
+        else:
+            collect(child, path + [name], labels, kwargs, families)
+
+    # Text values (versions, file system types) are labels of an info metric
+    if info:
+        family = get_family(families, make_name(path), 'info', '', '/'.join(path))
+        family.samples.append(('_info', labels + tuple(info), 1))
+
+
+def collect_processes(node, families):
+    counts = collections.Counter()
+    rss = collections.Counter()
+    for process in node.iter_processes(units=['B']):
+        counts[process['name']] += 1
+        rss[process['name']] += process['mem_rss'][0]
+
+    count = get_family(families, 'ncpa_processes_count', 'gauge', '', 'processes by name')
+    memory = get_family(families, 'ncpa_processes_memory_rss_bytes', 'gauge', 'bytes', 'processes by name')
+    for name in sorted(counts):
+        count.samples.append(('', (('name', name),), counts[name]))
+        memory.samples.append(('', (('name', name),), rss[name]))
+
+
+def collect_services(node, families):
+    services = node.walk(first=True)[node.name]
+    family = get_family(families, 'ncpa_services_running', 'gauge', '', 'services')
+    for name, status in sorted(services.items()):
+        family.samples.append(('', (('service', name),), 1 if status == 'running' else 0))
+
+
+def get_families(config, include=()):
+    """Collects the metric families of the default subtrees and the optional
+    subtrees in include.
+
+    """
+    families = collections.OrderedDict()
+    kwargs = {'snapshot': Snapshot()}
+
+    for name in default_subtrees + tuple(x for x in optional_subtrees if x in include):
+        node = psapi.getter(name, config, '/metrics', {})
+        if name == 'processes':
+            collect_processes(node, families)
+        elif name == 'services':
+            collect_services(node, families)
+        else:
+            collect(node, [name], (), kwargs, families)
+    return families
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(int(value))
+
+
+def render(families, openmetrics=True):
+    """Returns the families in the OpenMetrics text format, or the Prometheus
+    text format when openmetrics is False.
+
+    """
+    lines = []
+    for family in families.values():
+        # The Prometheus format has no info type and names counters (and
+        # info metrics turned into gauges) by their samples
+        metric_type, name = family.type, family.name
+        if not openmetrics:
+            if metric_type == 'counter':
+                name += '_total'
+            elif metric_type == 'info':
+                metric_type = 'gauge'
+                name += '_info'
+
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        if openmetrics and family.unit:
+            lines.append('# UNIT %s %s' % (name, family.unit))
+        lines.append('# HELP %s %s' % (name, escape(family.help)))
+
+        for suffix, labels, value in family.samples:
+            if family.type == 'counter':
+                suffix = '_total'
+            if labels:
+                labels = '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+            else:
+                labels = ''
+            lines.append('%s%s%s %s' % (family.name, suffix, labels, format_value(value)))
+
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
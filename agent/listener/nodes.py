@@ -1,14 +1,19 @@
-import os
-import tempfile
 import time
 import itertools
 import logging
-import pickle
 import copy
+import functools
+import json
 import re
+import gevent
+import gevent.lock
 import listener.environment as environment
 import listener.server
 import listener.database as database
+import listener.deltas as deltas
+import listener.instrument as instrument
+import listener.sampler as sampler
+from listener.snapshot import Snapshot, HistorySnapshot
 
 from ncpa import listener_logger as logging
 
@@ -18,6 +23,9 @@ valid_nodes = []
 
 
 class ParentNode(object):
+    # Nodes that can send their walk in pieces set this and walk_stream()
+    streaming = False
+
     def __init__(self, name, children=None, *args, **kwargs):
         if children is None:
             children = []
@@ -35,6 +43,14 @@ class ParentNode(object):
     def add_child(self, new_node):
         self.children[new_node.name] = new_node
 
+    def context(self):
+        """Returns the node to use for one request. The tree is shared by all
+        requests, so the per-request state (unit, title, thresholds, etc) is
+        set on a shallow copy that shares the children instead of the node.
+
+        """
+        return copy.copy(self)
+
     def accessor(self, path, config, full_path, args):
         if path:
             next_child_name, rest_path = path[0], path[1:]
@@ -56,20 +72,77 @@ class ParentNode(object):
             # Continue down the node path
             return child.accessor(rest_path, config, full_path, args)
         else:
-            return copy.deepcopy(self)
+            return self.context()
 
     def walk(self, *args, **kwargs):
+        # All children share one snapshot of the metrics for this request
+        if kwargs.get("snapshot", None) is None:
+            kwargs["snapshot"] = Snapshot()
+
+        # The node that was requested walks its children concurrently, the
+        # nodes below it walk theirs in order
+        if kwargs.get("deadline", None) is None and len(self.children) > 1:
+            concurrency, timeout = get_walk_settings(kwargs.get("config", None))
+            if concurrency > 1:
+                return self.walk_concurrently(concurrency, timeout, *args, **kwargs)
+
         stat = {}
         for name, child in self.children.items():
             try:
                 if kwargs.get("first", None) is None:
                     kwargs["first"] = False
-                stat.update(child.walk(*args, **kwargs))
+                stat.update(child.context().walk(*args, **kwargs))
             except Exception as exc:
                 logging.exception(exc)
                 stat.update({name: "Error retrieving child: %r" % str(exc)})
         return {self.name: stat}
 
+    def walk_stream(self, *args, **kwargs):
+        """Yields the JSON for walk() in pieces. Nodes with large results
+        override this so they do not have to build the whole result first.
+
+        """
+        yield json.dumps(self.walk(*args, **kwargs), ensure_ascii=False)
+
+    def walk_concurrently(self, concurrency, timeout, *args, **kwargs):
+        """Walks the children in greenlets, at most concurrency at a time. The
+        children that are not done after timeout seconds are stopped and
+        return a timeout error instead of holding up the rest.
+
+        """
+        kwargs["deadline"] = time.monotonic() + timeout
+        if kwargs.get("first", None) is None:
+            kwargs["first"] = False
+
+        semaphore = gevent.lock.BoundedSemaphore(concurrency)
+
+        def walk_child(child):
+            with semaphore:
+                return child.walk(*args, **kwargs)
+
+        greenlets = [
+            (name, gevent.spawn(walk_child, child.context()))
+            for name, child in self.children.items()
+        ]
+        gevent.joinall([x[1] for x in greenlets], timeout=timeout)
+
+        stat = {}
+        for name, greenlet in greenlets:
+            if greenlet.successful():
+                stat.update(greenlet.value)
+            elif greenlet.ready():
+                logging.exception(greenlet.exception)
+                stat.update({name: "Error retrieving child: %r" % str(greenlet.exception)})
+            else:
+                greenlet.kill(block=False)
+                logging.warning("Walking %s timed out after %s seconds", name, timeout)
+                stat.update({name: {"error": {
+                    "code": 110,
+                    "type": "timeout",
+                    "message": "The node did not respond within %s seconds." % timeout,
+                }}})
+        return {self.name: stat}
+
     def run_check(self, *args, **kwargs):
         err = (
             "UNKNOWN: Unable to run check on node without check method. Requested '%s' node."
@@ -108,12 +181,17 @@ class RunnableParentNode(ParentNode):
         secondary_perfdata = []
         total = ""
 
+        # All children share one snapshot of the metrics for this request
+        if kwargs.get("snapshot", None) is None:
+            kwargs["snapshot"] = Snapshot()
+
         if self.primary_unit == "%":
-            total, total_unit = self.children["total"].get_values(*args, **kwargs)
+            total, total_unit = self.children["total"].context().get_values(*args, **kwargs)
             total = total[0]
 
         for name, child in self.children.items():
             if name in self.include:
+                child = child.context()
                 if name == self.primary:
                     primary_info = child.run_check(
                         use_prefix=True,
@@ -191,23 +269,38 @@ class RunnableParentNode(ParentNode):
 
 
 class RunnableNode(ParentNode):
+    # Counters only go up, so a drop is a wrap or reset when taking deltas
+    counter = False
+
     def __init__(self, name, method, *args, **kwargs):
         self.method = method
         self.name = name
         self.children = {}
         self.unit = ""
         self.delta = False
+        self.counter = kwargs.get("counter", False)
 
     def accessor(self, path, config, full_path, args):
         if path:
             full_path = ", ".join(path)
             return DoesNotExistNode("", self.name, full_path)
         else:
-            return copy.deepcopy(self)
+            return self.context()
 
+    @instrument.timed_method("walk", lambda self, *args, **kwargs: self.name)
     def walk(self, *args, **kwargs):
+        if kwargs.get("history", None):
+            return self.walk_history(*args, **kwargs)
+
+        # The snapshot also records when the values were collected, which
+        # delta rates are worked out over
+        if kwargs.get("snapshot", None) is None:
+            kwargs["snapshot"] = Snapshot()
+
         try:
             values, unit = self.method(*args, **kwargs)
+        except InvalidArgument as exc:
+            return {self.name: {"error": str(exc)}}
         except TypeError:
             values, unit = self.method()
         except AttributeError:
@@ -223,6 +316,87 @@ class RunnableNode(ParentNode):
             return {self.name: [values, self.unit]}
         return {self.name: values}
 
+    def walk_history(self, *args, **kwargs):
+        """Returns the values of the node over the last 'history' seconds from
+        the background sampler, downsampled to the min, max and avg of every
+        'step' seconds.
+
+        """
+        current = sampler.sampler
+        if current is None or not current.samples:
+            return {self.name: {"error": "History is not available, the metric sampler is not running."}}
+
+        try:
+            history = float(get_first(kwargs["history"]))
+            step = float(get_first(kwargs.get("step", current.interval)))
+            if history <= 0 or step <= 0:
+                raise ValueError
+        except ValueError:
+            return {self.name: {"error": "The history and step must be a positive number of seconds."}}
+
+        samples = list(current.samples)
+        start = samples[-1].time - history
+
+        # Keep one sample from before the start to calculate rates from
+        first = 0
+        for index, sample in enumerate(samples):
+            if sample.time >= start:
+                first = max(index - 1, 0)
+                break
+
+        points = []
+        previous = None
+        used = False
+        unit = None
+        for sample in samples[first:]:
+            snapshot = HistorySnapshot(sample, previous)
+            kwargs["snapshot"] = snapshot
+            try:
+                values, unit = self.method(*args, **kwargs)
+                self.set_unit(unit, kwargs)
+                values = self.get_adjusted_scale(values, kwargs)
+            except Exception as exc:
+                logging.debug("No history for %s at %s: %r", self.name, sample.timestamp, exc)
+                continue
+            finally:
+                used = used or snapshot.used
+                previous = sample
+            points.append((sample, values))
+
+        if not used:
+            return {self.name: {"error": "History is not available for this node."}}
+
+        if kwargs.get("delta", False):
+            self.delta = True
+            self.unit = self.unit + "/s"
+            points = [
+                (sample, get_rate(before, values, sample.time - last.time, self.counter))
+                for (last, before), (sample, values) in zip(points, points[1:])
+                if sample.time > last.time
+            ]
+
+            # Leave out the points where a counter was reset
+            points = [x for x in points if x[1] is not None]
+
+        # Group the points that are inside the history into buckets of step seconds
+        buckets = []
+        for sample, values in points:
+            if sample.time < start:
+                continue
+            index = int((sample.time - start) // step)
+            if not buckets or buckets[-1][0] != index:
+                buckets.append((index, sample.timestamp, []))
+            buckets[-1][2].append(self.get_aggregated_values(values, kwargs))
+
+        series = []
+        for index, timestamp, group in buckets:
+            minimum, maximum, average = summarize_values(group)
+            series.append({"timestamp": round(timestamp, 3), "min": minimum, "max": maximum, "avg": average})
+
+        if self.unit:
+            return {self.name: [series, self.unit]}
+        return {self.name: series}
+
     def set_unit(self, unit, request_args):
         if "unit" in request_args:
             self.unit = request_args["unit"][0]
@@ -231,7 +405,7 @@ class RunnableNode(ParentNode):
 
     def get_delta_values(self, values, request_args, hasher=False, *args, **kwargs):
         delta = request_args.get("delta", False)
-        # Here we check which value we should hash against for the delta pickle
+        # Here we check which value we should key the stored delta values on
         # If the value is empty string, empty list, empty object, 0, False or None,
         # then this is clearly not what we want and we simply hash against the API
         # accessor.
@@ -248,18 +422,12 @@ class RunnableNode(ParentNode):
             self.unit = self.unit + "/s"
             remote_addr = request_args.get("remote_addr", None)
 
-            values = self.deltaize_values(values, accessor, remote_addr)
+            # Rates are over the times the values were collected (the sample
+            # they came from), not the times of the requests
+            snapshot = request_args.get("snapshot", None)
+            collected = getattr(snapshot, "last_time", None)
 
-            # Wait 1 second and try again if no value was given due to no pickle
-            # file having been created yet (check doesn't have old data)
-            if values is False:
-                time.sleep(1)
-                logging.debug("Re-running check for 1 second of data.")
-                try:
-                    values, unit = self.method(*args, **kwargs)
-                except TypeError:
-                    values, unit = self.method()
-                values = self.deltaize_values(values, accessor, remote_addr)
+            values = self.deltaize_values(values, accessor, remote_addr, collected)
 
         return values
 
@@ -311,6 +479,9 @@ class RunnableNode(ParentNode):
             return values
 
     def get_values(self, *args, **kwargs):
+        if kwargs.get("snapshot", None) is None:
+            kwargs["snapshot"] = Snapshot()
+
         try:
             values, unit = self.method(*args, **kwargs)
         except TypeError:
@@ -333,6 +504,7 @@ class RunnableNode(ParentNode):
 
         return values, unit
 
+    @instrument.timed_method("check", lambda self, *args, **kwargs: self.name)
     def run_check(
         self,
         use_perfdata=True,
@@ -351,6 +523,8 @@ class RunnableNode(ParentNode):
             values, unit = self.get_values(*args, **kwargs)
         except AttributeError:
             return self.execute_plugin(*args, **kwargs)
+        except InvalidArgument as exc:
+            return {"returncode": 3, "stdout": "UNKNOWN: %s" % exc}
 
         try:
             perfdata = None
@@ -359,13 +533,9 @@ class RunnableNode(ParentNode):
             is_warning = False
             is_critical = False
             if self.warning:
-                is_warning = any(
-                    [self.is_within_range(self.warning, x) for x in values]
-                )
+                is_warning = get_nagios_range(self.warning).any_alerts(values)
             if self.critical:
-                is_critical = any(
-                    [self.is_within_range(self.critical, x) for x in values]
-                )
+                is_critical = get_nagios_range(self.critical).any_alerts(values)
             returncode, stdout, perfdata = self.get_nagios_return(
                 values,
                 is_warning,
@@ -522,46 +692,12 @@ class RunnableNode(ParentNode):
 
         return returncode, stdout, perfdata
 
-    def deltaize_values(self, values, hash_val, remote_addr=None):
-        if remote_addr:
-            hash_val = hash_val + remote_addr
-        filename = "ncpa-%d.tmp" % hash(hash_val)
-        tmpfile = os.path.join(tempfile.gettempdir(), filename)
-
+    def deltaize_values(self, values, hash_val, remote_addr=None, collected=None):
         if not isinstance(values, (list, tuple)):
             values = [values]
 
-        try:
-            # If the file exists, we extract the data from it and save it to our loaded_values variable.
-            with open(tmpfile, "rb") as values_file:
-                loaded_values = pickle.load(values_file)
-                last_modified = os.path.getmtime(tmpfile)
-        except (IOError, EOFError):
-            # Otherwise load the loaded_values and last_modified with values that will cause zeros to show up.
-            logging.debug('No pickle file found for hash_val "%s"', hash_val)
-            loaded_values = values
-            last_modified = 0
-        except (KeyError, pickle.UnpicklingError):
-            logging.error('Problem unpickling data for hash_val "%s"', hash_val)
-            loaded_values = values
-            last_modified = 0
-
-        # Update the pickled data
-        logging.debug(
-            'Updating pickle for hash_val "%s". Filename is %s.', hash_val, tmpfile
-        )
-        with open(tmpfile, "wb") as values_file:
-            pickle.dump(values, values_file)
-
-        # If last modified is 0, then return false
-        if last_modified == 0:
-            return 0
-
-        # Calculate the return value and return it
-        delta = time.time() - last_modified
-        dvalues = [
-            round(abs((x - y) / delta), 2) for x, y in zip(loaded_values, values)
-        ]
+        key = deltas.make_key(hash_val, remote_addr)
+        dvalues = deltas.get_delta_rates(key, list(values), self.counter, collected)
 
         if len(dvalues) == 1:
             dvalues = dvalues[0]
@@ -635,51 +771,7 @@ class RunnableNode(ParentNode):
         # First off, we must ensure that the range exists, otherwise just return (not warning or critical.)
         if not nagios_range:
             return False
-
-        # Next make sure the value is a number of some sort
-        value = float(value)
-
-        # Setup our regular expressions to parse the Nagios ranges
-        first_float = r"(?P<first>(-?[0-9]+(\.[0-9]+)?))"
-        second_float = r"(?P<second>(-?[0-9]+(\.[0-9]+)?))"
-
-        # The following is a list of regular expression => function. If the regular expression matches
-        # then run the function. The function is a comparison involving value.
-        actions = [
-            (
-                r"^%s$" % first_float,
-                lambda y: (value > float(y.group("first"))) or (value < 0),
-            ),
-            (r"^%s:$" % first_float, lambda y: value < float(y.group("first"))),
-            (
-                r"^:%s$" % first_float,
-                lambda y: (value > float(y.group("first"))) or (value < 0),
-            ),
-            (r"^~:%s$" % first_float, lambda y: value > float(y.group("first"))),
-            (
-                r"^%s:%s$" % (first_float, second_float),
-                lambda y: (value < float(y.group("first")))
-                or (value > float(y.group("second"))),
-            ),
-            (
-                r"^@%s:%s$" % (first_float, second_float),
-                lambda y: not (
-                    (value < float(y.group("first")))
-                    or (value > float(y.group("second")))
-                ),
-            ),
-        ]
-
-        # For each of the previous list items, run the regular expression, and if the regular expression
-        # finds a match, run the function and return its comparison result.
-        nagios_range = "".join(nagios_range)
-        for regex_string, func in actions:
-            res = re.match(regex_string, nagios_range)
-            if res:
-                return func(res)
-
-        # If none of the items matches, the warning/critical format was bogus! Sound the alarms!
-        raise Exception("Improper warning/critical format.")
+        return get_nagios_range(nagios_range).alerts(value)
 
     @staticmethod
     def elapsed_time(seconds):
@@ -704,11 +796,123 @@ class LazyNode(RunnableNode):
             return {self.name: []}
 
 
+class NagiosRange(object):
+    """A parsed Nagios warning/critical threshold. Values outside of low and
+    high raise an alert, or inside of them for ranges starting with @.
+
+    """
+
+    # Setup our regular expressions to parse the Nagios ranges
+    float_pattern = r"-?[0-9]+(?:\.[0-9]+)?"
+    patterns = [
+        (re.compile(r"^(%s)$" % float_pattern), lambda x: (0.0, x[0], False)),
+        (re.compile(r"^(%s):$" % float_pattern), lambda x: (x[0], float("inf"), False)),
+        (re.compile(r"^:(%s)$" % float_pattern), lambda x: (0.0, x[0], False)),
+        (re.compile(r"^~:(%s)$" % float_pattern), lambda x: (float("-inf"), x[0], False)),
+        (re.compile(r"^(%s):(%s)$" % (float_pattern, float_pattern)), lambda x: (x[0], x[1], False)),
+        (re.compile(r"^@(%s):(%s)$" % (float_pattern, float_pattern)), lambda x: (x[0], x[1], True)),
+    ]
+
+    def __init__(self, low, high, inside=False):
+        self.low = low
+        self.high = high
+        self.inside = inside
+
+    @classmethod
+    def parse(cls, text):
+        for regex, make_range in cls.patterns:
+            res = regex.match(text)
+            if res:
+                return cls(*make_range([float(x) for x in res.groups()]))
+
+        # If none of the items matches, the warning/critical format was bogus! Sound the alarms!
+        raise Exception("Improper warning/critical format.")
+
+    def alerts(self, value):
+        value = float(value)
+        return (value < self.low or value > self.high) != self.inside
+
+    def any_alerts(self, values):
+        low, high, inside = self.low, self.high, self.inside
+        for value in values:
+            value = float(value)
+            if (value < low or value > high) != inside:
+                return True
+        return False
+
+
+@functools.lru_cache(maxsize=256)
+def parse_nagios_range(text):
+    return NagiosRange.parse(text)
+
+
+def get_nagios_range(nagios_range):
+    """Returns the parsed NagiosRange for a threshold, which may be given as a
+    string or a list of strings (from the query string).
+
+    """
+    if isinstance(nagios_range, (list, tuple)):
+        nagios_range = "".join(nagios_range)
+    return parse_nagios_range(nagios_range)
+
+
+def get_walk_settings(config):
+    """Returns the number of children walked at the same time and the seconds
+    a walk may take, from the [api] section of the config.
+
+    """
+    try:
+        concurrency = config.getint("api", "walk_concurrency")
+    except Exception as e:
+        concurrency = 16
+    try:
+        timeout = config.getfloat("api", "walk_timeout")
+    except Exception as e:
+        timeout = 30.0
+    return concurrency, timeout
+
+
+def get_first(value):
+    # Request arguments are lists when they come from the query string
+    if isinstance(value, (list, tuple)):
+        return value[0]
+    return value
+
+
+def get_rate(before, after, seconds, counter=False):
+    # Returns None if a counter was reset between the values
+    if isinstance(after, (list, tuple)):
+        rates = deltas.get_rates(before, after, seconds, counter)
+        return None if None in rates else rates
+    return deltas.get_rates([before], [after], seconds, counter)[0]
+
+
+def summarize_values(group):
+    """Returns the min, max and avg of a group of values, value by value when
+    the node returns a list (e.g. one value per cpu).
+
+    """
+    if isinstance(group[0], (list, tuple)):
+        columns = list(zip(*group))
+        return (
+            [min(x) for x in columns],
+            [max(x) for x in columns],
+            [round(sum(x) / len(x), 2) for x in columns],
+        )
+    return min(group), max(group), round(sum(group) / len(group), 2)
+
+
 # -----------------------------
 # Error related class definitions
 # -----------------------------
 
 
+# Raised by the method of a node when an argument of the request can not be
+# used, the walk or check returns the message as its error
+class InvalidArgument(ValueError):
+    pass
+
+
 # If node does not exist, we should give a decent error message with helpful
 # information about the name of the node they are trying to find is
 class DoesNotExistNode:
@@ -740,3 +944,42 @@ class DoesNotExistNode:
             err = "%s %s" % (err, self.extra_message)
         err = err.replace("|", "/")
         return {"stdout": err, "returncode": 3}
+
+
+def stream_error(closing, exc):
+    """Returns the JSON that ends a stream that failed part of the way, with
+    an error member after what was sent so the document is still whole.
+
+    """
+    logging.exception(exc)
+    return "%s, %s: %s}" % (closing, json.dumps("error"), json.dumps("Error while collecting: %s" % exc))
+
+
+def stream_list(name, items):
+    """Yields the JSON for {name: [item, ...]} from items as they are produced."""
+    yield "{%s: [" % json.dumps(name)
+    separator = ""
+    try:
+        for item in items:
+            yield separator + json.dumps(item, ensure_ascii=False)
+            separator = ", "
+    except Exception as exc:
+        yield stream_error("]", exc)
+        return
+    yield "]}"
+
+
+def join_chunks(fragments, chunk_size=65536):
+    """Joins small JSON fragments into chunks of about chunk_size characters,
+    so a streamed response is not sent a few bytes at a time.
+
+    """
+    chunk, size = [], 0
+    for fragment in fragments:
+        chunk.append(fragment)
+        size += len(fragment)
+        if size >= chunk_size:
+            yield "".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk)
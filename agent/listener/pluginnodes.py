@@ -4,11 +4,11 @@ from configparser import NoOptionError
 import subprocess
 import shlex
 import re
-import copy
 import queue
 import listener.nodes as nodes
 import listener.database as database
 import listener.environment as environment
+import listener.instrument as instrument
 import listener.server as server
 from ncpa import listener_logger as logging
 import signal
@@ -37,20 +37,26 @@ class PluginNode(nodes.RunnableNode):
         self.arguments = []
         self.killed = False
 
+    def context(self):
+        node = super(PluginNode, self).context()
+        node.arguments = list(self.arguments)
+        return node
+
     def accessor(self, path, config, full_path, args):
+        node = self.context()
 
         # Get raw args value(s) and check if we need to add them
         raw_args = args.getlist("args")
         if len(raw_args) > 0:
-            self.arguments += raw_args
+            node.arguments += raw_args
 
         # Add arguments that may have been passed with the path
         # THIS IS TO KEEP OLD VERSION < 2.1 FUNCTIONALITY
         #  ** this will be deprecated in NCPA 3 ***
         if len(path) > 0:
-            self.arguments += path
+            node.arguments += path
 
-        return copy.deepcopy(self)
+        return node
 
     def walk(self, config, **kwargs):
         result = self.execute_plugin(config, **kwargs)
@@ -83,6 +89,7 @@ class PluginNode(nodes.RunnableNode):
         else:
             os.killpg(p.pid, signal.SIGKILL)
 
+    @instrument.timed_method("plugin", lambda self, *args, **kwargs: self.name)
     def execute_plugin(self, config, *args, **kwargs):
         """Runs custom scripts that MUST be located in the scripts subdirectory
         of the executable
@@ -236,7 +243,9 @@ class PluginAgentNode(nodes.ParentNode):
         except Exception as e:
             follow_symlinks = False
 
-        self.children = {}
+        # Filled in before it replaces the old children, which requests may
+        # still be walking
+        children = {}
 
         try:
             for root, dirs, files in os.walk(plugin_path, followlinks=follow_symlinks):
@@ -246,14 +255,15 @@ class PluginAgentNode(nodes.ParentNode):
                     plugin_abs_path = os.path.join(root, plugin)
                     if os.path.isfile(plugin_abs_path):
                         if environment.SYSTEM == "Windows":
-                            self.children[plugin.lower()] = PluginNode(plugin, plugin_abs_path)
+                            children[plugin.lower()] = PluginNode(plugin, plugin_abs_path)
                         else:
-                            self.children[plugin] = PluginNode(plugin, plugin_abs_path)
+                            children[plugin] = PluginNode(plugin, plugin_abs_path)
         except OSError as exc:
             logging.warning("Unable to access directory %s", plugin_path)
             logging.warning(
                 "Unable to assemble plugins. Does the directory exist? - %r", exc
             )
+        self.children = children
 
     def accessor(self, path, config, full_path, args):
         self.setup_plugin_children(config)
@@ -1,7 +1,9 @@
 import psutil
 import listener.nodes as nodes
+import listener.blocking as blocking
 import re
 import platform
+import time
 import tempfile
 import subprocess
 from ncpa import listener_logger as logging
@@ -204,31 +206,45 @@ class ProcessNode(nodes.LazyNode):
 
         return proc_filter
 
+    # Read for each process in one pass by process_iter
+    process_attrs = ["name", "exe", "username", "cmdline", "cpu_percent", "memory_percent", "memory_info"]
+
     @staticmethod
-    def standard_form(self, process, ps_procs, units="", sleep=None):
+    def standard_form(self, process, ps_procs, units="", sleep=None, cpu_count=None):
         pid = str(process.pid)
 
+        # Values already read by process_iter, None where access was denied,
+        # anything else is read from the process here
+        info = getattr(process, "info", None) or {}
+
+        def read(attr, *args):
+            if attr in info:
+                if info[attr] is None:
+                    raise psutil.AccessDenied(process.pid)
+                return info[attr]
+            return getattr(process, attr)(*args)
+
         try:
             if pid in ps_procs:
                 proc = ps_procs.get(pid)
                 cmd = proc[2]
             else:
-                cmd = " ".join(process.cmdline())
+                cmd = " ".join(read("cmdline"))
         except BaseException:
             cmd = "Unknown"
 
         try:
-            name = process.name()
+            name = read("name")
         except BaseException:
             name = "Unknown"
 
         try:
-            exe = process.exe()
+            exe = read("exe")
         except BaseException:
             exe = "Unknown"
 
         try:
-            username = process.username()
+            username = read("username")
         except BaseException:
             username = "Unknown"
 
@@ -238,7 +254,9 @@ class ProcessNode(nodes.LazyNode):
                 proc = ps_procs.get(pid)
                 cpu_percent = round(float(proc[0]), 2)
             else:
-                cpu_percent = round(process.cpu_percent(sleep) / psutil.cpu_count(), 2)
+                if cpu_count is None:
+                    cpu_count = psutil.cpu_count()
+                cpu_percent = round(read("cpu_percent", sleep) / cpu_count, 2)
         except BaseException:
             cpu_percent = 0
 
@@ -248,7 +266,7 @@ class ProcessNode(nodes.LazyNode):
                 proc = ps_procs.get(pid)
                 mem_percent = round(float(proc[1]), 2)
             else:
-                mem_percent = round(process.memory_percent(), 2)
+                mem_percent = round(read("memory_percent"), 2)
         except BaseException:
             mem_percent = 0
 
@@ -259,7 +277,7 @@ class ProcessNode(nodes.LazyNode):
                 u = "%s%s" % (units, "B")
 
             # Get adjusted scales
-            pmi = process.memory_info()
+            pmi = read("memory_info")
             value, uts = self.adjust_scale(self, pmi.rss, units)
             mem_rss = (value, u)
             value, uts = self.adjust_scale(self, pmi.vms, units)
@@ -280,11 +298,49 @@ class ProcessNode(nodes.LazyNode):
             "mem_rss": mem_rss,
         }
 
+    # The process list can be large, so it is sent as it is collected
+    streaming = True
+
     def get_process_dict(self, *args, **kwargs):
+        return list(self.iter_processes(*args, **kwargs))
+
+    def iter_processes(self, *args, **kwargs):
+        """Yields the processes that match the filter one at a time. They are
+        read from psutil in the blocking thread pool, a batch at a time.
+
+        """
         units = kwargs.get("units", ["B"])
         sleep = self.get_sleep(kwargs)
         proc_filter = self.make_filter(*args, **kwargs)
-        processes = []
+        ps_procs = self.get_ps_procs()
+
+        # With a sleep the cpu usage of every process is measured over the
+        # same sleep, rather than sleeping for each process in turn
+        if sleep and not ps_procs:
+            blocking.apply(self.start_cpu_percent)
+            time.sleep(sleep)
+
+        processes = self.read_processes(proc_filter, ps_procs, units[0])
+        return blocking.iterate(processes)
+
+    @staticmethod
+    def start_cpu_percent():
+        """Starts measuring the cpu usage of all processes, the next
+        cpu_percent() of each is its usage since now.
+
+        """
+        for process in psutil.process_iter():
+            try:
+                process.cpu_percent()
+            except psutil.Error:
+                pass
+
+    @staticmethod
+    def get_ps_procs():
+        """Returns the extra process data from ps on systems where psutil does
+        not have it, by pid.
+
+        """
         ps_procs = {}
 
         # Mac OS X requires using ps command to get cpu/memory data (as nagios)
@@ -318,18 +374,28 @@ class ProcessNode(nodes.LazyNode):
                 cols = line.split()
                 ps_procs[cols[1]] = [cols[2], cols[3], " ".join(cols[10:])]
 
-        # Do actual process looping
-        for process in psutil.process_iter():
+        return ps_procs
+
+    def read_processes(self, proc_filter, ps_procs, units):
+        attrs = self.process_attrs
+
+        # Mac OS X and AIX get the cpu/memory usage from ps instead
+        if ps_procs:
+            attrs = [x for x in attrs if x not in ("cpu_percent", "memory_percent")]
+        cpu_count = psutil.cpu_count()
+
+        # Do actual process looping, process_iter reads the attributes of each
+        # process at once (with oneshot) instead of one call at a time
+        for process in psutil.process_iter(attrs=attrs, ad_value=None):
             try:
-                proc_obj = self.standard_form(self, process, ps_procs, units[0], sleep)
-                if proc_filter(proc_obj):
-                    processes.append(proc_obj)
+                proc_obj = self.standard_form(self, process, ps_procs, units, None, cpu_count)
+                if not proc_filter(proc_obj):
+                    continue
             except Exception as e:
                 # Could not access process, most likely because of windows permissions
                 logging.exception(e)
                 continue
-
-        return processes
+            yield proc_obj
 
     def walk(self, *args, **kwargs):
         self.method = self.get_process_dict
@@ -338,6 +404,11 @@ class ProcessNode(nodes.LazyNode):
         else:
             return {self.name: []}
 
+    def walk_stream(self, *args, **kwargs):
+        if kwargs.get("first", True):
+            return nodes.stream_list(self.name, self.iter_processes(*args, **kwargs))
+        return nodes.stream_list(self.name, [])
+
     def get_process_label(self, request_args):
         title = "Process count"
 
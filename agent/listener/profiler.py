@@ -0,0 +1,277 @@
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+import gevent
+from gevent import monkey
+from ncpa import listener_logger as logging
+
+# Profiling hooks for admins, to see what a listener (or passive) process is
+# spending its time and memory on under real load without a restart:
+#
+# - profile_call() runs one API request under cProfile
+# - SamplingProfiler samples the stack of the main thread from a native
+#   thread, so it sees every greenlet (and the idle hub) for N seconds
+# - MemoryTracer diffs tracemalloc snapshots to find what keeps growing
+
+# Parts of NCPA and its libraries the samples are grouped by, in the order
+# they are checked against the file names of a stack
+components = (
+    ('psapi', os.path.join('listener', 'psapi.py')),
+    ('processes', os.path.join('listener', 'processes.py')),
+    ('services', os.path.join('listener', 'services.py')),
+    ('plugins', os.path.join('listener', 'pluginnodes.py')),
+    ('nodes', os.path.join('listener', 'nodes.py')),
+    ('database', os.path.join('listener', 'database.py')),
+    ('psutil', os.sep + 'psutil' + os.sep),
+    ('flask', os.sep + 'flask' + os.sep),
+    ('werkzeug', os.sep + 'werkzeug' + os.sep),
+    ('jinja2', os.sep + 'jinja2' + os.sep),
+)
+
+# The running (or last) sampling profile and memory tracer of the process
+sampler = None
+tracer = None
+
+
+def get_function_name(filename, lineno, name):
+    return '%s:%d(%s)' % (filename, lineno, name)
+
+
+def profile_call(method, limit=30):
+    """Runs method under cProfile, returns its result and the functions with
+    the most cumulative time as a list of dicts.
+
+    """
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    result = profile.runcall(method)
+    elapsed = time.perf_counter() - start
+
+    stats = pstats.Stats(profile)
+    rows = []
+    for (filename, lineno, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({
+            'function': get_function_name(filename, lineno, name),
+            'ncalls': nc,
+            'tottime': round(tt, 6),
+            'cumtime': round(ct, 6),
+        })
+    rows.sort(key=lambda x: x['cumtime'], reverse=True)
+    return result, {'elapsed': round(elapsed, 6), 'calls': stats.total_calls, 'functions': rows[:limit]}
+
+
+def get_component(filename):
+    for name, part in components:
+        if part in filename:
+            return name
+    return None
+
+
+class SamplingProfiler(object):
+    """Samples the main thread's stack every interval seconds for a number of
+    seconds. It runs in a real thread (gevent is monkey patched in the
+    listener) and only reads frames, so the listener keeps serving requests.
+
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread_id = monkey.get_original('threading', 'get_ident')()
+        self.running = False
+        self.started = None
+        self.stopped = None
+        self.samples = 0
+        self.idle = 0
+        self.own = collections.Counter()
+        self.total = collections.Counter()
+        self.components = collections.Counter()
+        self.stacks = collections.Counter()
+
+    def start(self, seconds):
+        self.running = True
+        self.started = time.time()
+        self.stop_at = time.monotonic() + seconds
+        start_new_thread = monkey.get_original('_thread', 'start_new_thread')
+        start_new_thread(self.run, ())
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        sleep = monkey.get_original('time', 'sleep')
+        try:
+            while self.running and time.monotonic() < self.stop_at:
+                frame = sys._current_frames().get(self.thread_id, None)
+                if frame is not None:
+                    self.add_sample(frame)
+                sleep(self.interval)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self.running = False
+            self.stopped = time.time()
+
+    def add_sample(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, frame.f_lineno, code.co_name))
+            frame = frame.f_back
+        if not stack:
+            return
+
+        self.samples += 1
+
+        # The hub waiting in its loop means no greenlet had work to do
+        filename, lineno, name = stack[0]
+        if name == 'run' and 'gevent' in filename and 'hub' in filename:
+            self.idle += 1
+            return
+
+        self.own[get_function_name(*stack[0])] += 1
+        functions = set(get_function_name(f, 0, n) for f, l, n in stack)
+        for function in functions:
+            self.total[function] += 1
+        for component in set(get_component(f) for f, l, n in stack):
+            if component is not None:
+                self.components[component] += 1
+        self.stacks[';'.join('%s(%s)' % (os.path.basename(f), n) for f, l, n in reversed(stack))] += 1
+
+    def report(self, limit=30):
+        def percent(count):
+            return round(count * 100.0 / self.samples, 1) if self.samples else 0
+
+        return {
+            'running': self.running,
+            'started': self.started,
+            'stopped': self.stopped,
+            'samples': self.samples,
+            'idle': percent(self.idle),
+            'components': [(name, percent(count)) for name, count in self.components.most_common()],
+            'own': [(name, percent(count)) for name, count in self.own.most_common(limit)],
+            'total': [(name, percent(count)) for name, count in self.total.most_common(limit)],
+        }
+
+    def collapsed(self):
+        """Returns the stacks in the collapsed format flame graph tools read."""
+        return ''.join('%s %d\n' % (stack, count) for stack, count in self.stacks.most_common())
+
+
+def start_sampling(seconds, interval=0.005):
+    """Starts a sampling profile of the process, unless one is running."""
+    global sampler
+    if sampler is not None and sampler.running:
+        return False
+    sampler = SamplingProfiler(interval)
+    sampler.start(seconds)
+    return True
+
+
+def stop_sampling():
+    if sampler is not None:
+        sampler.stop()
+
+
+class MemoryTracer(object):
+    """Compares tracemalloc snapshots to show where memory has grown since
+    the last snapshot.
+
+    """
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.previous = None
+        self.taken = None
+        self.rows = []
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+        self.taken = None
+        self.rows = []
+
+    def take(self):
+        self.start()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        return snapshot
+
+    def diff(self, limit=25):
+        """Takes a snapshot and returns the locations that grew the most since
+        the previous one, as (location, size diff, count diff, size) tuples.
+        The first call only sets the baseline.
+
+        """
+        snapshot = self.take()
+        previous, self.previous = self.previous, snapshot
+        self.taken = time.time()
+        if previous is None:
+            return []
+
+        rows = []
+        for stat in snapshot.compare_to(previous, 'lineno')[:limit]:
+            frame = stat.traceback[0]
+            rows.append(('%s:%d' % (frame.filename, frame.lineno), stat.size_diff, stat.count_diff, stat.size))
+        self.rows = rows
+        return rows
+
+
+def is_tracing():
+    return tracemalloc.is_tracing()
+
+
+def get_tracer():
+    global tracer
+    if tracer is None:
+        tracer = MemoryTracer()
+    return tracer
+
+
+def log_memory_growth(logger, limit=10):
+    """Logs where memory grew the most since the last call."""
+    current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+    rows = get_tracer().diff(limit)
+    if not rows:
+        logger.info("Tracing memory allocations, %d KiB allocated", current // 1024)
+        return
+    logger.info("Memory growth since the last snapshot (%d KiB allocated, peak %d KiB):", current // 1024, peak // 1024)
+    for location, size_diff, count_diff, size in rows:
+        logger.info("  %s: %+d KiB (%+d blocks), %d KiB total", location, size_diff // 1024, count_diff, size // 1024)
+
+
+def get_trace_interval(config):
+    """Returns the seconds between logging memory growth ([general]
+    trace_memory is in minutes), 0 when it is off.
+
+    """
+    try:
+        return max(config.getint('general', 'trace_memory'), 0) * 60
+    except Exception:
+        return 0
+
+
+def start_memory_logging(logger, interval):
+    """Logs memory growth every interval seconds in a greenlet, for the
+    listener. The passive loop calls log_memory_growth itself.
+
+    """
+    def run():
+        while True:
+            try:
+                log_memory_growth(logger)
+            except Exception as e:
+                logger.exception(e)
+            gevent.sleep(interval)
+
+    get_tracer().start()
+    return gevent.spawn(run)
@@ -6,54 +6,152 @@ import psutil as ps
 import re
 import time
 
-from listener.nodes import ParentNode, RunnableNode, RunnableParentNode, LazyNode
-from listener.pluginnodes import PluginAgentNode
-import listener.services as services
-import listener.processes as processes
+from listener.nodes import ParentNode, RunnableNode, RunnableParentNode, LazyNode, DoesNotExistNode, InvalidArgument
+from listener.snapshot import get_snapshot
+import listener.blocking as blocking
 import listener.environment as environment
+import listener.instrument as instrument
 import ncpa
 from ncpa import listener_logger as logging
 
-importables = ("windowscounters", "windowslogs")
+# Windows only modules and the name of the node they add to the API tree
+importables = (("windowscounters", "windowscounters"), ("windowslogs", "logs"))
 
 __SYSTEM__ = os.name
 __VERSION__ = ncpa.__VERSION__
 
+# The API tree is built as it is requested and kept up to date by refresh()
+root = None
+root_config = None
+root_subtrees = None
+
+# Splits an accessor path on / (but not if they are inside " or ')
+accessor_pattern = re.compile(r"""((?:[^/"']|"[^"]*"|'[^']*')+)""")
+
+# Nodes already looked up by their path in the tree, cleared when it changes
+resolved = {}
+max_resolved = 1024
+
+# Subtrees whose nodes depend on the request (arguments, counter paths), so
+# they are never resolved from the cache
+unresolvable = ("plugins", "windowscounters")
+
 def get_uptime():
     current_time = time.time()
     epoch_boot = int(current_time)
     return (epoch_boot - ps.boot_time(), "s")
 
 
+# The following helpers read the metrics through the request's snapshot, so
+# that all the nodes of one request share a single call per counter
+
+def get_disk_counters(disk_name, request_args):
+    return get_snapshot(request_args).get(ps.disk_io_counters, perdisk=True)[disk_name]
+
+
+def get_disk_usage(mountpoint, request_args):
+    return get_snapshot(request_args).get(ps.disk_usage, mountpoint)
+
+
+def get_statvfs(mountpoint, request_args):
+    return get_snapshot(request_args).get(os.statvfs, mountpoint)
+
+
+def get_if_counters(if_name, request_args):
+    return get_snapshot(request_args).get(ps.net_io_counters, pernic=True)[if_name]
+
+
+def get_cpu_times(request_args):
+    return get_snapshot(request_args).get(ps.cpu_times, percpu=True)
+
+
+def get_cpu_percent(request_args, cpu_interval=0.5):
+    """Returns the per-cpu percent averaged over the window (in seconds) given
+    in the request from the sampled cpu times, so the request doesn't have to
+    wait. When there is no sampler (sample_interval = 0), or it does not have
+    two samples yet, the request measures the cpu itself for cpu_interval
+    seconds instead, whatever the window.
+
+    """
+    window = request_args.get("window", None)
+    if isinstance(window, (list, tuple)):
+        window = window[0]
+    if window not in (None, ""):
+        try:
+            window = float(window)
+            if window <= 0:
+                raise ValueError
+        except ValueError:
+            raise InvalidArgument("The window must be a positive number of seconds.")
+
+    try:
+        return get_snapshot(request_args).cpu_percent(window)
+    except KeyError:
+        logging.debug("No sampled cpu times for cpu percent, measuring for %ss instead", cpu_interval)
+
+    return ps.cpu_percent(interval=cpu_interval, percpu=True)
+
+
+def get_virtual_memory(request_args):
+    return get_snapshot(request_args).get(ps.virtual_memory)
+
+
+def get_swap_memory(request_args):
+    return get_snapshot(request_args).get(ps.swap_memory)
+
+
+def get_user_names(request_args):
+    return [x.name for x in get_snapshot(request_args).get(ps.users)]
+
+
+def get_inodes_used(mountpoint, request_args):
+    st = get_statvfs(mountpoint, request_args)
+    return st.f_files - st.f_ffree
+
+
+def get_inodes_used_percent(mountpoint, request_args):
+    st = get_statvfs(mountpoint, request_args)
+    if st.f_files > 0:
+        return math.ceil(100 * float(st.f_files - st.f_ffree) / float(st.f_files))
+    return 0
+
+
 def make_disk_nodes(disk_name):
     read_time = RunnableNode(
         "read_time",
-        method=lambda: (ps.disk_io_counters(perdisk=True)[disk_name].read_time, "ms"),
+        method=lambda **kwargs: (get_disk_counters(disk_name, kwargs).read_time, "ms"),
+        counter=True,
     )
     write_time = RunnableNode(
         "write_time",
-        method=lambda: (ps.disk_io_counters(perdisk=True)[disk_name].write_time, "ms"),
+        method=lambda **kwargs: (get_disk_counters(disk_name, kwargs).write_time, "ms"),
+        counter=True,
     )
     read_count = RunnableNode(
         "read_count",
-        method=lambda: (ps.disk_io_counters(perdisk=True)[disk_name].read_count, "c"),
+        method=lambda **kwargs: (get_disk_counters(disk_name, kwargs).read_count, "c"),
+        counter=True,
     )
     write_count = RunnableNode(
         "write_count",
-        method=lambda: (ps.disk_io_counters(perdisk=True)[disk_name].write_count, "c"),
+        method=lambda **kwargs: (get_disk_counters(disk_name, kwargs).write_count, "c"),
+        counter=True,
     )
     read_bytes = RunnableNode(
         "read_bytes",
-        method=lambda: (ps.disk_io_counters(perdisk=True)[disk_name].read_bytes, "B"),
+        method=lambda **kwargs: (get_disk_counters(disk_name, kwargs).read_bytes, "B"),
+        counter=True,
     )
     write_bytes = RunnableNode(
         "write_bytes",
-        method=lambda: (ps.disk_io_counters(perdisk=True)[disk_name].write_bytes, "B"),
+        method=lambda **kwargs: (get_disk_counters(disk_name, kwargs).write_bytes, "B"),
+        counter=True,
     )
     if __SYSTEM__ == "posix" and platform.system() != "Darwin":
         busy_time = RunnableNode(
             "busy_time",
-            method=lambda: (ps.disk_io_counters(perdisk=True)[disk_name].busy_time, "ms"),
+            method=lambda **kwargs: (get_disk_counters(disk_name, kwargs).busy_time, "ms"),
+            counter=True,
         )
         return ParentNode(
             disk_name,
@@ -83,11 +181,18 @@ def make_disk_nodes(disk_name):
 def make_mountpoint_nodes(partition_name):
     mountpoint = partition_name.mountpoint
 
-    total = RunnableNode("total", method=lambda: (ps.disk_usage(mountpoint).total, "B"))
-    used = RunnableNode("used", method=lambda: (ps.disk_usage(mountpoint).used, "B"))
-    free = RunnableNode("free", method=lambda: (ps.disk_usage(mountpoint).free, "B"))
+    total = RunnableNode(
+        "total", method=lambda **kwargs: (get_disk_usage(mountpoint, kwargs).total, "B")
+    )
+    used = RunnableNode(
+        "used", method=lambda **kwargs: (get_disk_usage(mountpoint, kwargs).used, "B")
+    )
+    free = RunnableNode(
+        "free", method=lambda **kwargs: (get_disk_usage(mountpoint, kwargs).free, "B")
+    )
     used_percent = RunnableNode(
-        "used_percent", method=lambda: (ps.disk_usage(mountpoint).percent, "%")
+        "used_percent",
+        method=lambda **kwargs: (get_disk_usage(mountpoint, kwargs).percent, "%"),
     )
     device_name = RunnableNode(
         "device_name", method=lambda: ([partition_name.device], "")
@@ -141,18 +246,24 @@ def make_mountpoint_nodes(partition_name):
     # Unix specific inode counter ~ sorry Windows! :'(
     if __SYSTEM__ != "nt":
         try:
-            st = os.statvfs(mountpoint)
-            iu = st.f_files - st.f_ffree
-            iup = 0
-            if st.f_files > 0:
-                iup = math.ceil(100 * float(iu) / float(st.f_files))
-            inodes = RunnableNode("inodes", method=lambda: (st.f_files, "inodes"))
-            inodes_used = RunnableNode("inodes_used", method=lambda: (iu, "inodes"))
+            # Make sure the inodes can be counted before adding the nodes, the
+            # counts themselves are read each time the nodes are requested
+            blocking.call(os.statvfs, mountpoint)
+            inodes = RunnableNode(
+                "inodes",
+                method=lambda **kwargs: (get_statvfs(mountpoint, kwargs).f_files, "inodes"),
+            )
+            inodes_used = RunnableNode(
+                "inodes_used",
+                method=lambda **kwargs: (get_inodes_used(mountpoint, kwargs), "inodes"),
+            )
             inodes_free = RunnableNode(
-                "inodes_free", method=lambda: (st.f_ffree, "inodes")
+                "inodes_free",
+                method=lambda **kwargs: (get_statvfs(mountpoint, kwargs).f_ffree, "inodes"),
             )
             inodes_used_percent = RunnableNode(
-                "inodes_used_percent", method=lambda: (iup, "%")
+                "inodes_used_percent",
+                method=lambda **kwargs: (get_inodes_used_percent(mountpoint, kwargs), "%"),
             )
 
             node_children = [
@@ -208,20 +319,46 @@ def make_mount_other_nodes(partition):
 
 
 def make_if_nodes(if_name):
-    x = ps.net_io_counters(pernic=True)
-
-    bytes_sent = RunnableNode("bytes_sent", method=lambda: (x[if_name].bytes_sent, "B"))
-    bytes_recv = RunnableNode("bytes_recv", method=lambda: (x[if_name].bytes_recv, "B"))
+    bytes_sent = RunnableNode(
+        "bytes_sent",
+        method=lambda **kwargs: (get_if_counters(if_name, kwargs).bytes_sent, "B"),
+        counter=True,
+    )
+    bytes_recv = RunnableNode(
+        "bytes_recv",
+        method=lambda **kwargs: (get_if_counters(if_name, kwargs).bytes_recv, "B"),
+        counter=True,
+    )
     packets_sent = RunnableNode(
-        "packets_sent", method=lambda: (x[if_name].packets_sent, "packets")
+        "packets_sent",
+        method=lambda **kwargs: (get_if_counters(if_name, kwargs).packets_sent, "packets"),
+        counter=True,
     )
     packets_recv = RunnableNode(
-        "packets_recv", method=lambda: (x[if_name].packets_recv, "packets")
+        "packets_recv",
+        method=lambda **kwargs: (get_if_counters(if_name, kwargs).packets_recv, "packets"),
+        counter=True,
+    )
+    errin = RunnableNode(
+        "errin",
+        method=lambda **kwargs: (get_if_counters(if_name, kwargs).errin, "errors"),
+        counter=True,
+    )
+    errout = RunnableNode(
+        "errout",
+        method=lambda **kwargs: (get_if_counters(if_name, kwargs).errout, "errors"),
+        counter=True,
+    )
+    dropin = RunnableNode(
+        "dropin",
+        method=lambda **kwargs: (get_if_counters(if_name, kwargs).dropin, "packets"),
+        counter=True,
+    )
+    dropout = RunnableNode(
+        "dropout",
+        method=lambda **kwargs: (get_if_counters(if_name, kwargs).dropout, "packets"),
+        counter=True,
     )
-    errin = RunnableNode("errin", method=lambda: (x[if_name].errin, "errors"))
-    errout = RunnableNode("errout", method=lambda: (x[if_name].errout, "errors"))
-    dropin = RunnableNode("dropin", method=lambda: (x[if_name].dropin, "packets"))
-    dropout = RunnableNode("dropout", method=lambda: (x[if_name].dropout, "packets"))
 
     return RunnableParentNode(
         if_name,
@@ -279,16 +416,16 @@ def get_cpu_node(cpu_interval=0.5):
         "count", method=lambda:     ([len(ps.cpu_percent(percpu=True))], "cores")
     )
     cpu_percent = LazyNode(
-        "percent", method=lambda:   (ps.cpu_percent(interval=cpu_interval, percpu=True), "%")
+        "percent", method=lambda **kwargs: (get_cpu_percent(kwargs, cpu_interval), "%")
     )
     cpu_user = RunnableNode(
-        "user", method=lambda:      ([x.user for x in ps.cpu_times(percpu=True)], "ms")
+        "user", method=lambda **kwargs: ([x.user for x in get_cpu_times(kwargs)], "ms"), counter=True
     )
     cpu_system = RunnableNode(
-        "system", method=lambda:    ([x.system for x in ps.cpu_times(percpu=True)], "ms")
+        "system", method=lambda **kwargs: ([x.system for x in get_cpu_times(kwargs)], "ms"), counter=True
     )
     cpu_idle = RunnableNode(
-        "idle", method=lambda:      ([x.idle for x in ps.cpu_times(percpu=True)], "ms")
+        "idle", method=lambda **kwargs: ([x.idle for x in get_cpu_times(kwargs)], "ms"), counter=True
     )
     return ParentNode(
         "cpu", children=[cpu_count, cpu_idle, cpu_percent, cpu_system, cpu_user]
@@ -297,16 +434,20 @@ def get_cpu_node(cpu_interval=0.5):
 
 def get_memory_node():
     mem_virt_total = RunnableNode(
-        "total", method=lambda: (ps.virtual_memory().total, "B")
+        "total", method=lambda **kwargs: (get_virtual_memory(kwargs).total, "B")
     )
     mem_virt_available = RunnableNode(
-        "available", method=lambda: (ps.virtual_memory().available, "B")
+        "available", method=lambda **kwargs: (get_virtual_memory(kwargs).available, "B")
     )
     mem_virt_percent = RunnableNode(
-        "percent", method=lambda: (ps.virtual_memory().percent, "%")
+        "percent", method=lambda **kwargs: (get_virtual_memory(kwargs).percent, "%")
+    )
+    mem_virt_used = RunnableNode(
+        "used", method=lambda **kwargs: (get_virtual_memory(kwargs).used, "B")
+    )
+    mem_virt_free = RunnableNode(
+        "free", method=lambda **kwargs: (get_virtual_memory(kwargs).free, "B")
     )
-    mem_virt_used = RunnableNode("used", method=lambda: (ps.virtual_memory().used, "B"))
-    mem_virt_free = RunnableNode("free", method=lambda: (ps.virtual_memory().free, "B"))
     mem_virt = RunnableParentNode(
         "virtual",
         primary="percent",
@@ -322,20 +463,31 @@ def get_memory_node():
         # See https://github.com/NagiosEnterprises/ncpa/issues/783
         add_primary_node_to_perfdata=True,
     )
-    mem_swap_total = RunnableNode("total", method=lambda: (ps.swap_memory().total, "B"))
+    mem_swap_total = RunnableNode(
+        "total", method=lambda **kwargs: (get_swap_memory(kwargs).total, "B")
+    )
     mem_swap_percent = RunnableNode(
-        "percent", method=lambda: (ps.swap_memory().percent, "%")
+        "percent", method=lambda **kwargs: (get_swap_memory(kwargs).percent, "%")
+    )
+    mem_swap_used = RunnableNode(
+        "used", method=lambda **kwargs: (get_swap_memory(kwargs).used, "B")
+    )
+    mem_swap_free = RunnableNode(
+        "free", method=lambda **kwargs: (get_swap_memory(kwargs).free, "B")
     )
-    mem_swap_used = RunnableNode("used", method=lambda: (ps.swap_memory().used, "B"))
-    mem_swap_free = RunnableNode("free", method=lambda: (ps.swap_memory().free, "B"))
 
     # sin and sout on Windows are always set to 0 ~ sorry Windows! :'(
+    # They are the bytes swapped since boot, so they only go up
     if environment.SYSTEM != "Windows":
         mem_swap_in = RunnableNode(
-            "swapped_in", method=lambda: (ps.swap_memory().sin, "B")
+            "swapped_in",
+            method=lambda **kwargs: (get_swap_memory(kwargs).sin, "B"),
+            counter=True,
         )
         mem_swap_out = RunnableNode(
-            "swapped_out", method=lambda: (ps.swap_memory().sout, "B")
+            "swapped_out",
+            method=lambda **kwargs: (get_swap_memory(kwargs).sout, "B"),
+            counter=True,
         )
 
         node_children = [mem_swap_used, mem_swap_out, mem_swap_in, mem_swap_total, mem_swap_percent, mem_swap_free]
@@ -354,18 +506,88 @@ def get_memory_node():
     return ParentNode("memory", children=[mem_virt, mem_swap])
 
 
-def get_disk_node(config):
+def sync_children(parent, sources, make_node):
+    """Brings the children of a node in line with the given sources, which is a
+    dict of child name => the object (partition, disk or nic name) the child is
+    built from. Children whose source has not changed are kept as they are so
+    only added, removed or changed devices cause nodes to be built.
+
+    Returns True if any of the children changed.
+
+    The children are replaced with a new dict rather than changed in place,
+    since requests may be walking the old one.
+
+    """
+    changed = False
+    children = dict(parent.children)
+
+    for name in list(children.keys()):
+        if name not in sources or getattr(children[name], "source", None) != sources[name]:
+            del children[name]
+            changed = True
+
+    for name, source in sources.items():
+        if name in children:
+            continue
+        try:
+            node = make_node(source)
+        except OSError as ex:
+            logging.exception(ex)
+            continue
+        except Exception as e:
+            logging.exception("Unexpected error in %s: %s", make_node.__name__, e)
+            continue
+        node.source = source
+        children[node.name] = node
+        changed = True
+
+    if changed:
+        parent.children = children
+    return changed
+
+
+def get_disk_node(config, path=None):
+    disk_mount = ParentNode("mount")
+    disk_logical = ParentNode("logical")
+    disk_physical = ParentNode("physical")
+    disk = ParentNode("disk", children=[disk_mount, disk_logical, disk_physical])
+    update_disk_node(disk, config, path)
+    return disk
+
+
+def update_disk_node(disk, config, path=None):
+    """Brings the disk node in line with the disks and partitions on the
+    system. If a path is given only the branch it points to is updated.
+    Returns True if the node changed.
+
+    """
+    changed = False
+    branch = path[0] if path else None
+
+    if branch in (None, "physical") and update_disk_physical_node(disk):
+        changed = True
+    if branch in (None, "logical", "mount") and update_disk_partition_nodes(disk, config):
+        changed = True
+
+    return changed
+
+
+def update_disk_physical_node(disk):
     # Get all physical disk io counters
     try:
-        disk_counters = [
-            make_disk_nodes(x) for x in list(ps.disk_io_counters(perdisk=True).keys())
-        ]
+        disk_counters = dict((x, x) for x in ps.disk_io_counters(perdisk=True).keys())
     except IOError as ex:
         logging.exception(ex)
-        disk_counters = []
+        disk_counters = {}
     except Exception as e:
         logging.exception(e)
-        disk_counters = []
+        disk_counters = {}
+
+    return sync_children(disk.children["physical"], disk_counters, make_disk_nodes)
+
+
+def update_disk_partition_nodes(disk, config):
+    changed = False
 
     # Get exclude values from the config
     try:
@@ -384,10 +606,10 @@ def get_disk_node(config):
     except Exception as e:
         all_partitions = True
 
-    disk_mountpoints = []
-    disk_parts = []
+    disk_mountpoints = {}
+    disk_parts = {}
     try:
-        for x in ps.disk_partitions(all=all_partitions):
+        for x in blocking.call(ps.disk_partitions, all=all_partitions):
 
             # to check against fuse.<type> etc
             fstype = x.fstype
@@ -395,124 +617,102 @@ def get_disk_node(config):
                 fstype = x.fstype.split(".")[0]
 
             if fstype not in exclude_fs_types:
-                if os.path.isdir(x.mountpoint):
-                    try:
-                        tmp = make_mountpoint_nodes(x)
-                        disk_mountpoints.append(tmp)
-                    except OSError as ex:
-                        logging.exception(ex)
-                    except Exception as e:
-                        logging.exception("Unexpected error in make_mountpoint_nodes: %s", e)
+                safe_mountpoint = re.sub(r"[\\/]+", "|", x.mountpoint)
+                if blocking.apply(os.path.isdir, (x.mountpoint,)):
+                    disk_mountpoints[safe_mountpoint] = x
                 else:
-                    tmp = make_mount_other_nodes(x)
-                    disk_parts.append(tmp)
+                    disk_parts[safe_mountpoint] = x
     except IOError as ex:
         logging.exception(ex)
+        return changed
     except Exception as e:
         logging.exception(e)
+        return changed
 
-    disk_logical = ParentNode("logical", children=disk_mountpoints)
-    disk_physical = ParentNode("physical", children=disk_counters)
-    disk_mount = ParentNode("mount", children=disk_parts)
+    if sync_children(disk.children["logical"], disk_mountpoints, make_mountpoint_nodes):
+        changed = True
+    if sync_children(disk.children["mount"], disk_parts, make_mount_other_nodes):
+        changed = True
 
-    return ParentNode("disk", children=[disk_mount, disk_logical, disk_physical])
+    return changed
 
 
 def get_interface_node():
-    if_children = [
-        make_if_nodes(x) for x in list(ps.net_io_counters(pernic=True).keys())
-    ]
-    return ParentNode("interface", children=if_children)
+    interface = ParentNode("interface")
+    update_interface_node(interface)
+    return interface
 
 
-def get_plugins_node():
-    return PluginAgentNode("plugins")
+def update_interface_node(interface, config=None, path=None):
+    if_names = dict((x, x) for x in ps.net_io_counters(pernic=True).keys())
+    return sync_children(interface, if_names, make_if_nodes)
 
 
-def get_user_node():
-    user_count = RunnableNode(
-        "count", method=lambda: (len([x.name for x in ps.users()]), "users")
-    )
-    user_list = RunnableNode(
-        "list", method=lambda: ([x.name for x in ps.users()], "users")
-    )
-    unit_str = "[" + ",".join(map(str, [x.name for x in ps.users()])) + "] users"
-    user_countlist = RunnableNode(
-        "countlist", method=lambda: (len([x.name for x in ps.users()]), unit_str)
-    )
-    return ParentNode("user", children=[user_count, user_list, user_countlist])
+# The plugins, services and processes are imported when their subtree is
+# first requested, most calls never touch them
 
 
-def get_root_node(config):
-    try:
-        cpu = get_cpu_node()
-    except Exception as e:
-        cpu = ParentNode("N/A")
-        logging.exception(e)
+def get_plugins_node():
+    from listener.pluginnodes import PluginAgentNode
+    return PluginAgentNode("plugins")
 
-    try:
-        memory = get_memory_node()
-    except Exception as e:
-        memory = ParentNode("N/A")
-        logging.exception(e)
 
-    try:
-        disk = get_disk_node(config)
-    except Exception as e:
-        disk = ParentNode("N/A")
-        logging.exception(e)
+def get_services_node():
+    import listener.services as services
+    return services.get_node()
 
-    try:
-        interface = get_interface_node()
-    except Exception as e:
-        interface = ParentNode("N/A")
-        logging.exception(e)
 
-    try:
-        plugins = get_plugins_node()
-    except Exception as e:
-        plugins = ParentNode("N/A")
-        logging.exception(e)
+def get_processes_node():
+    import listener.processes as processes
+    return processes.get_node()
 
-    try:
-        user = get_user_node()
-    except Exception as e:
-        user = ParentNode("N/A")
-        logging.exception(e)
 
-    try:
-        system = get_system_node()
-    except Exception as e:
-        system = ParentNode("N/A")
-        logging.exception(e)
+def get_user_node():
+    def get_user_countlist(**kwargs):
+        users = get_user_names(kwargs)
+        return len(users), "[" + ",".join(map(str, users)) + "] users"
 
-    try:
-        service = services.get_node()
-    except Exception as e:
-        service = ParentNode("N/A")
-        logging.exception(e)
+    user_count = RunnableNode(
+        "count", method=lambda **kwargs: (len(get_user_names(kwargs)), "users")
+    )
+    user_list = RunnableNode(
+        "list", method=lambda **kwargs: (get_user_names(kwargs), "users")
+    )
+    user_countlist = RunnableNode("countlist", method=get_user_countlist)
+    return ParentNode("user", children=[user_count, user_list, user_countlist])
 
-    try:
-        process = processes.get_node()
-    except Exception as e:
-        process = ParentNode("N/A")
-        logging.exception(e)
 
-    children = [cpu, memory, disk, interface, plugins, user, system, service, process]
+def get_root_subtrees():
+    """Returns the subtrees of the root node in the order they are shown, as
+    (name, build, update) tuples. Build takes the config and the rest of the
+    path and returns the node, update takes the node, the config and the rest
+    of the path and returns True if it changed (None if the node never changes
+    once built).
+
+    """
+    global root_subtrees
+    if root_subtrees is not None:
+        return root_subtrees
+
+    subtrees = [
+        ("cpu", lambda config, path: get_cpu_node(), None),
+        ("memory", lambda config, path: get_memory_node(), None),
+        ("disk", get_disk_node, update_disk_node),
+        ("interface", lambda config, path: get_interface_node(), update_interface_node),
+        ("plugins", lambda config, path: get_plugins_node(), None),
+        ("user", lambda config, path: get_user_node(), None),
+        ("system", lambda config, path: get_system_node(), None),
+        ("services", lambda config, path: get_services_node(), None),
+        ("processes", lambda config, path: get_processes_node(), None),
+    ]
 
     if __SYSTEM__ == "nt":
-        for importable in importables:
+        for importable, name in importables:
             try:
                 relative_name = "listener." + importable
                 tmp = __import__(relative_name, fromlist=["get_node"])
                 get_node = getattr(tmp, "get_node")
-
-                try:
-                    node = get_node()
-                except Exception as e:
-                    node = ParentNode("N/A")
-                    logging.exception(e)
-                children.append(node)
+                subtrees.append((name, lambda config, path, get_node=get_node: get_node(), None))
                 logging.debug("Imported %s into the API tree.", importable)
             except ImportError:
                 logging.warning("Could not import %s, skipping.", importable)
@@ -522,15 +722,84 @@ def get_root_node(config):
                     importable,
                 )
 
-    return ParentNode("root", children=children)
+    root_subtrees = subtrees
+    return subtrees
 
 
-def refresh(config):
-    global root
-    root = get_root_node(config)
-    return True
+def materialize(node, config, path=None):
+    """Builds the subtrees of node (the root node) that the path goes through
+    and brings them up to date, without a path every subtree is. Returns True
+    if the tree changed.
+
+    """
+    changed = False
+    subtrees = get_root_subtrees()
+    children = dict(node.children)
+
+    # Unknown names build everything so the error can list the valid nodes
+    if path and path[0] in [name for name, build, update in subtrees]:
+        subtrees = [x for x in subtrees if x[0] == path[0]]
+        rest_path = path[1:]
+    else:
+        rest_path = None
+
+    for name, build, update in subtrees:
+        try:
+            if name not in children:
+                subtree = build(config, rest_path)
+                children[subtree.name] = subtree
+                changed = True
+            elif update is not None and update(children[name], config, rest_path):
+                changed = True
+        except Exception as e:
+            logging.exception(e)
+
+    # Keep the subtrees in order no matter which one was asked for first, the
+    # new dict replaces the old one in one step as requests may be walking it
+    if len(subtrees) > 1:
+        names = [x[0] for x in subtrees]
+        children = dict(sorted(children.items(),
+                               key=lambda x: names.index(x[0]) if x[0] in names else len(names)))
+    if changed or len(subtrees) > 1:
+        node.children = children
+
+    return changed
+
+
+def get_root_node(config):
+    root_node = ParentNode("root")
+    materialize(root_node, config)
+    return root_node
 
 
+def split_accessor(accessor):
+    return accessor_pattern.split(accessor)[1::2]
+
+
+def refresh(config, path=None):
+    """Makes sure the part of the root node that a request goes through is up
+    to date. Subtrees are only built the first time they are asked for (or
+    when the config changes), after that only the devices that were added or
+    removed are swapped in. Without a path the whole tree is refreshed.
+
+    The nodes resolved from the old tree are forgotten whenever it changes,
+    whoever asked for the refresh.
+
+    """
+    global root, root_config
+    changed = False
+    if root is None or config is not root_config:
+        root = ParentNode("root")
+        root_config = config
+        changed = True
+    if materialize(root, config, path):
+        changed = True
+    if changed:
+        resolved.clear()
+    return changed
+
+
+@instrument.timed_method('getter', lambda accessor, *args, **kwargs: instrument.get_prefix(accessor or ''))
 def getter(accessor, config, full_path, args, cache=False):
     global root
 
@@ -538,15 +807,26 @@ def getter(accessor, config, full_path, args, cache=False):
     if accessor is None:
         return
 
-    # Split the accessor path on / (but not if they are inside " or ')
-    pattern = re.compile(r"""((?:[^/"']|"[^"]*"|'[^']*')+)""")
-    path = pattern.split(accessor)[1::2]
+    path = split_accessor(accessor)
 
-    # Check if this should be a cached query or if we should reset the root
+    # Check if this should be a cached query or if we should refresh the root
     # node. This normally only happens on new API calls. When we are using
     # websockets we use the cached version while it makes requests.
     if not cache:
-        refresh(config)
+        refresh(config, path)
+
+    key = "/".join(path)
+    try:
+        return resolved[key].context()
+    except KeyError:
+        pass
 
     root.reset_valid_nodes()
-    return root.accessor(path, config, full_path, args)
+    node = root.accessor(path, config, full_path, args)
+
+    if path and path[0] not in unresolvable and not isinstance(node, DoesNotExistNode):
+        if len(resolved) >= max_resolved:
+            resolved.clear()
+        resolved[key] = node
+        return node.context()
+    return node
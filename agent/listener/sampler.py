@@ -0,0 +1,184 @@
+import collections
+import time
+import gevent
+import psutil as ps
+import listener.blocking as blocking
+from ncpa import listener_logger as logging
+
+# The background sampler collects the core metrics on an interval and keeps
+# them in a fixed size ring buffer. Snapshots read the latest sample instead
+# of calling psutil inline, which makes API latency independent of the time
+# it takes to collect the metrics.
+
+# The running sampler, this stays None unless the listener started one
+sampler = None
+
+# Collections that are sampled from the start, per-mount disk usage is added
+# the first time it is requested through a snapshot
+default_collections = (
+    (ps.cpu_times, (), {'percpu': True}),
+    (ps.virtual_memory, (), {}),
+    (ps.swap_memory, (), {}),
+    (ps.disk_io_counters, (), {'perdisk': True}),
+    (ps.net_io_counters, (), {'pernic': True}),
+)
+
+# Methods that may be added to the sampler when they are requested
+sampled_methods = (ps.cpu_times, ps.virtual_memory, ps.swap_memory,
+                   ps.disk_io_counters, ps.net_io_counters, ps.disk_usage)
+
+# Limit on the number of collections a sampler will watch
+max_collections = 256
+
+Sample = collections.namedtuple('Sample', ['time', 'timestamp', 'values'])
+
+
+def make_key(method, args, kwargs):
+    return (method, args, tuple(sorted(kwargs.items())))
+
+
+def cpu_total_time(times):
+    # On Linux guest times are already counted in user/nice
+    total = sum(times)
+    total -= getattr(times, 'guest', 0)
+    total -= getattr(times, 'guest_nice', 0)
+    return total
+
+
+def cpu_busy_time(times):
+    return cpu_total_time(times) - times.idle - getattr(times, 'iowait', 0)
+
+
+def cpu_busy_percent(before, after):
+    """Returns the percent of time the cpu was busy between two cpu_times, the
+    same way psutil.cpu_percent() calculates it.
+
+    """
+    total = cpu_total_time(after) - cpu_total_time(before)
+    busy = cpu_busy_time(after) - cpu_busy_time(before)
+    if total <= 0:
+        return 0.0
+    return round(min(max(busy / total * 100, 0.0), 100.0), 1)
+
+
+class Sampler(object):
+
+    def __init__(self, interval=1, history=900):
+        self.interval = float(interval)
+        self.samples = collections.deque(maxlen=max(int(history / self.interval), 2))
+        self.collections = {}
+        self.greenlet = None
+
+        for method, args, kwargs in default_collections:
+            self.watch(method, *args, **kwargs)
+
+    def watch(self, method, *args, **kwargs):
+        """Adds method(*args, **kwargs) to the collections taken each interval.
+        Returns False if the method can not be sampled.
+
+        """
+        if method not in sampled_methods:
+            return False
+        key = make_key(method, args, kwargs)
+        if key not in self.collections:
+            if len(self.collections) >= max_collections:
+                return False
+            self.collections[key] = (method, args, kwargs)
+        return True
+
+    def collect(self):
+        values = {}
+        for key, (method, args, kwargs) in list(self.collections.items()):
+            try:
+                values[key] = blocking.call(method, *args, **kwargs)
+            except Exception as e:
+                # Normally means the device is gone (unmounted, unplugged) or
+                # hung, it is added again the next time it is requested
+                logging.debug("Removing %s%r from the sampler: %r", method.__name__, args, e)
+                del self.collections[key]
+        sample = Sample(time.monotonic(), time.time(), values)
+        self.samples.append(sample)
+        return sample
+
+    def latest(self, method, *args, **kwargs):
+        """Returns the latest sampled value of method(*args, **kwargs). Raises
+        KeyError if it is not being sampled or the last sample is stale.
+
+        """
+        key = make_key(method, args, kwargs)
+        if not self.samples:
+            raise KeyError(key)
+        sample = self.samples[-1]
+        if time.monotonic() - sample.time > 2 * self.interval:
+            raise KeyError(key)
+        return sample.values[key]
+
+    def sample_before(self, seconds):
+        """Returns the newest sample taken at least seconds before the latest
+        one, or the oldest sample if there is not that much history yet.
+
+        """
+        latest = self.samples[-1]
+        for sample in reversed(self.samples):
+            if latest.time - sample.time >= seconds:
+                return sample
+        return self.samples[0]
+
+    def cpu_percent(self, window=None):
+        """Returns the per-cpu busy percent over the last window seconds (one
+        interval by default) from the sampled cpu times, without blocking.
+        Raises KeyError if there are not two usable samples.
+
+        """
+        key = make_key(ps.cpu_times, (), {'percpu': True})
+        after = self.latest(ps.cpu_times, percpu=True)
+        if window is None:
+            window = self.interval
+        before = self.sample_before(window)
+        if before is self.samples[-1] or key not in before.values:
+            raise KeyError(key)
+        return [cpu_busy_percent(b, a) for b, a in zip(before.values[key], after)]
+
+    def run(self):
+        next_run = time.monotonic()
+        while True:
+            next_run = max(next_run + self.interval, time.monotonic())
+            gevent.sleep(next_run - time.monotonic())
+            try:
+                self.collect()
+            except Exception as e:
+                logging.exception(e)
+
+    def start(self):
+        self.collect()
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+
+def start(config):
+    """Starts the sampler for the listener based on the config, a sample
+    interval of 0 turns the sampler off.
+
+    """
+    global sampler
+
+    try:
+        interval = config.getfloat('listener', 'sample_interval')
+        history = config.getint('listener', 'sample_history')
+    except Exception as e:
+        interval, history = 1, 900
+
+    if sampler is not None:
+        sampler.stop()
+        sampler = None
+
+    if interval > 0:
+        sampler = Sampler(interval, history)
+        sampler.start()
+        logging.info("Started metric sampler (interval %ss, history %ss)", interval, history)
+
+    return sampler
@@ -1,16 +1,25 @@
-from flask import Flask, render_template, redirect, request, url_for, jsonify, Response, session, make_response, abort
+from flask import Flask, render_template, redirect, request, url_for, jsonify, Response, session, make_response, abort, stream_with_context
+from werkzeug.datastructures import MultiDict
 import os
 import sys
 import ssl
 from zlib import ZLIB_VERSION as zlib_version
 import platform
-import requests
 import functools
 import datetime
 import json
+import time
 import psutil
 import listener.psapi as psapi
-import listener.processes as processes
+import listener.cache as cache
+import listener.compression as compression
+import listener.metrics as metrics
+import listener.instrument as instrument
+import listener.profiler as profiler
+import listener.workers as workers
+import listener.blocking as blocking
+import listener.nodes as nodes
+from listener.snapshot import Snapshot
 import listener.database as database
 import math
 import re
@@ -104,7 +113,10 @@ def make_info_dict():
              'release': uname[2],
              'version': uname[3],
              'total_checks': format(total_checks, ",d"),
-             'check_logging_time': check_logging_time }
+             'check_logging_time': check_logging_time,
+             'compressed_count': format(compression.stats['responses'] + compression.stats['messages'], ",d"),
+             'compression_saved': format(compression.get_bytes_saved() // 1024, ",d"),
+             'api_timings': instrument.get_summary('api') }
 
 
 def get_unmapped_ip(ip):
@@ -261,7 +273,8 @@ def apply_headers(response):
     response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
     response.headers['X-Content-Type-Options'] = 'nosniff'
 
-    return response
+    workers.count_request(response.status_code >= 500)
+    return compression.compress_response(response, request.accept_encodings, request.path)
 
 
 # Variable injection for all pages that flask creates
@@ -366,6 +379,20 @@ def requires_admin_auth(f):
     return admin_auth_decoration
 
 
+# Whether the request is from a logged in admin, for features of the API that
+# are only for admins (the API itself also takes the token)
+def is_admin():
+    if __INTERNAL__ is True:
+        return True
+    if not session.get('logged', False):
+        return False
+    if not int(get_config_value('listener', 'admin_gui_access', 0)):
+        return False
+    if get_config_value('listener', 'admin_password', None) is None:
+        return True
+    return session.get('admin_logged', False)
+
+
 # ------------------------------
 # Authentication
 # ------------------------------
@@ -791,6 +818,49 @@ def admin_clear_check_log():
     return redirect(url_for('admin_global'))
 
 
+@listener.route('/gui/admin/profile', methods=['GET', 'POST'], provide_automatic_options = False)
+@requires_admin_auth
+def admin_profile():
+    tracer = profiler.get_tracer()
+
+    if request.method == 'POST':
+        action = request.form.get('action', '')
+        if action == 'start':
+            try:
+                seconds = min(max(int(request.form.get('seconds', 10)), 1), 300)
+                profiler.start_sampling(seconds)
+            except ValueError:
+                session['flash_msg_type'] = 'danger'
+                session['flash_msg_text'] = 'The number of seconds to profile for must be a number.'
+        elif action == 'stop':
+            profiler.stop_sampling()
+        elif action == 'snapshot':
+            tracer.diff()
+        elif action == 'stop-tracing':
+            tracer.stop()
+        return redirect(url_for('admin_profile'))
+
+    # Stacks for flame graph tools
+    if request.args.get('format', None) == 'collapsed' and profiler.sampler is not None:
+        return Response(profiler.sampler.collapsed(), mimetype='text/plain')
+
+    tmp_args = { 'no_nav': True }
+
+    # Check session for flash message
+    flash_msg_text = session.get('flash_msg_text', '')
+    if flash_msg_text != '':
+        tmp_args['flash_msg_text'] = flash_msg_text
+        tmp_args['flash_msg_type'] = session.get('flash_msg_type', 'info')
+        tmp_args['flash_msg'] = True
+        session['flash_msg_text'] = ''
+
+    tmp_args['report'] = profiler.sampler.report() if profiler.sampler is not None else None
+    tmp_args['tracing'] = profiler.is_tracing()
+    tmp_args['memory_taken'] = tracer.taken
+    tmp_args['memory_rows'] = tracer.rows
+    return render_template('admin/profile.html', **tmp_args)
+
+
 # ------------------------------
 # Web Sockets
 # ------------------------------
@@ -818,7 +888,7 @@ def api_websocket(accessor=None):
         encoding = sys.getdefaultencoding()
 
     # Refresh the root node before creating the websocket
-    psapi.refresh(config)
+    psapi.refresh(config, psapi.split_accessor(accessor))
 
     if request.environ.get('wsgi.websocket'):
         ws = request.environ['wsgi.websocket']
@@ -865,7 +935,7 @@ def top_websocket():
             load = psutil.cpu_percent()
             vir_mem = psutil.virtual_memory().percent
             swap_mem = psutil.swap_memory().percent
-            pnode = processes.get_node()
+            pnode = psapi.get_processes_node()
             procs = pnode.get_process_dict()
 
             process_list = []
@@ -985,7 +1055,7 @@ def graph(accessor=None):
     config = listener.config['iconfig']
 
     # Refresh the root node before creating the websocket
-    psapi.refresh(config)
+    psapi.refresh(config, psapi.split_accessor(accessor))
 
     node = psapi.getter(accessor, config, request.path, request.args, cache=True)
     prop = node.name
@@ -1050,6 +1120,9 @@ def nrdp():
 
     :rtype: flask.Response
     """
+    # Only the forwarder needs requests, so it is not imported at startup
+    import requests
+
     try:
         forward_to = listener.config['iconfig'].get('nrdp', 'parent')
         if request.method == 'get':
@@ -1452,32 +1525,35 @@ def add_check():
 # ------------------------------
 
 
-@listener.route('/api/', methods=['GET', 'POST'], provide_automatic_options = False)
-@listener.route('/api/<path:accessor>', methods=['GET', 'POST'], provide_automatic_options = False)
-@requires_token_or_auth
-def api(accessor=''):
+def get_api_value(accessor, full_path, args, keys=None, snapshot=None, stream=False, cached=True):
     """
-    The function that serves up all the metrics. Given some path/to/a/metric it will
-    retrieve the metric and do the necessary walking of the tree.
+    Gets the node at accessor and walks it, or runs a check on it if asked to.
 
     :param accessor: The path/to/the/desired/metric
-    :rtype: flask.Response
+    :param full_path: The requested path, used in error messages
+    :param args: The arguments of the call (a MultiDict)
+    :param keys: The names of the arguments to use, defaults to all of args
+    :param snapshot: The snapshot of the metrics to use, if it is shared
+    :param stream: Return a generator of JSON pieces for nodes that stream their walk
+    :param cached: Share the result with identical calls, False always walks the node
+    :rtype: dict or generator
     """
 
     # Setup sane/safe arguments for actually getting the data. We take in all
     # arguments that were passed via GET/POST. If they passed a config variable
     # we clobber it, as we trust what is in the config.
+    if keys is None:
+        keys = args
     sane_args = {}
-    for value in request.values:
-        sane_args[value] = request.args.getlist(value)
-
-    # Set the full requested path
-    full_path = request.path
+    for value in keys:
+        sane_args[value] = args.getlist(value)
 
     # Set the accessor and variables
-    sane_args['debug'] = request.args.get('debug', True)
+    sane_args['debug'] = args.get('debug', True)
     sane_args['remote_addr'] = request.remote_addr
     sane_args['accessor'] = accessor
+    if snapshot is not None:
+        sane_args['snapshot'] = snapshot
 
     # Add config to sane_args
     config = listener.config['iconfig']
@@ -1485,17 +1561,7 @@ def api(accessor=''):
 
     # Check if we are running a check or not
     if not 'check' in sane_args:
-        sane_args['check'] = request.args.get('check', False)
-
-    # Try to get the node that was specified
-    try:
-        node = psapi.getter(accessor, config, full_path, request.args)
-    except ValueError as exc:
-        logging.exception(exc)
-        return error(msg='Referencing node that does not exist: %s' % accessor)
-    except IndexError as exc:
-        # Hide the actual exception and just show nice output to users about changes in the API functionality
-        return error(msg='Could not access location specified. Changes to API calls were made in NCPA v1.7, check documentation on making API calls.')
+        sane_args['check'] = args.get('check', False)
 
     # Check for default unit in the config values
     default_units = get_config_value('general', 'default_units')
@@ -1503,12 +1569,206 @@ def api(accessor=''):
         if not 'units' in sane_args:
             sane_args['units'] = default_units
 
-    if sane_args['check']:
-        value = node.run_check(**sane_args)
-    else:
-        value = node.walk(**sane_args)
+    def get_node():
+        # Try to get the node that was specified
+        try:
+            return psapi.getter(accessor, config, full_path, args), None
+        except ValueError as exc:
+            logging.exception(exc)
+            return None, {'error': 'Referencing node that does not exist: %s' % accessor}
+        except IndexError as exc:
+            # Hide the actual exception and just show nice output to users about changes in the API functionality
+            return None, {'error': 'Could not access location specified. Changes to API calls were made in NCPA v1.7, check documentation on making API calls.'}
+
+    def get_value(node=None):
+        if node is None:
+            node, err = get_node()
+            if err is not None:
+                return err
+
+        if sane_args['check']:
+            value = node.run_check(**sane_args)
+        else:
+            value = node.walk(**sane_args)
+        return dict(value)
+
+    # Deltas depend on the caller's previous request so they are never shared
+    if sane_args.get('delta', False) or not cached:
+        return get_value()
+
+    path = psapi.split_accessor(accessor)
+    ttl = cache.get_ttl(config, path)
+    max_age = args.get('max_age', None)
+    if max_age is not None:
+        try:
+            ttl = float(max_age)
+        except ValueError:
+            pass
+    key = cache.make_key(path, sane_args)
+
+    # Large walks (processes) are sent in pieces as they are collected
+    if stream and not sane_args['check']:
+        node, err = get_node()
+        if err is not None:
+            return err
+        if getattr(node, 'streaming', False):
+            return cache.get_stream(key, ttl, lambda: nodes.join_chunks(node.walk_stream(**sane_args)))
+        return cache.get(key, ttl, lambda: get_value(node))
+
+    return cache.get(key, ttl, get_value)
+
+
+@listener.route('/metrics', provide_automatic_options = False)
+@requires_token_or_auth
+def api_metrics():
+    """
+    Renders the cpu, memory, disk, interface, system and user nodes from one
+    snapshot for OpenMetrics/Prometheus scrapers. The processes and services
+    are only added when asked for with ?include=processes,services
+
+    :rtype: flask.Response
+    """
+    config = listener.config['iconfig']
+    include = ','.join(request.args.getlist('include')).split(',')
+    openmetrics = 'application/openmetrics-text' in request.headers.get('Accept', '')
+
+    try:
+        families = metrics.get_families(config, include)
+    except Exception as exc:
+        logging.exception(exc)
+        return error(msg='Error occurred during processing request.')
+
+    content_type = metrics.openmetrics_type if openmetrics else metrics.prometheus_type
+    return Response(metrics.render(families, openmetrics), content_type=content_type)
+
+
+# Bulk arguments that are switched on by being given at all (?check=1)
+bulk_flags = ('check', 'delta')
+
+
+@listener.route('/api/_bulk', methods=['POST'], provide_automatic_options = False)
+@requires_token_or_auth
+def api_bulk():
+    """
+    Runs several API calls in one request. The body is a JSON list of
+    {"accessor": "path/to/a/metric", "args": {"check": 1, "warning": 80, ...}}
+    entries, all of them are evaluated against one snapshot of the metrics.
+
+    :rtype: flask.Response
+    """
+    queries = request.get_json(force=True, silent=True)
+    if not isinstance(queries, list):
+        return error(msg='The body must be a JSON list of {"accessor": ..., "args": {...}} entries.')
+
+    snapshot = Snapshot()
+    results = []
+    for query in queries:
+        if not isinstance(query, dict) or not isinstance(query.get('accessor', None), str):
+            results.append({'error': 'Each entry must have an accessor.'})
+            continue
+
+        accessor = query['accessor'].strip('/')
+        if accessor.startswith('api/'):
+            accessor = accessor[4:]
+
+        # Arguments are given as single values or lists, like in a query string
+        args = MultiDict()
+        query_args = query.get('args', None) or {}
+        if not isinstance(query_args, dict):
+            results.append({'error': 'The args of an entry must be an object.'})
+            continue
+        for name, value in query_args.items():
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for x in value:
+                # JSON true is the 1 of a query string, false, null and a 0
+                # for a flag leave the argument out
+                if x is None or x is False or (name in bulk_flags and x in (0, '0')):
+                    continue
+                args.add(name, '1' if x is True else str(x))
+
+        try:
+            results.append(get_api_value(accessor, '/api/' + accessor, args, snapshot=snapshot))
+        except Exception as exc:
+            logging.exception(exc)
+            results.append({'error': 'Error occurred during processing request.'})
+
+    # Generate page and add cross-domain loading
+    response = Response(json.dumps(results, ensure_ascii=False), mimetype='application/json')
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+@listener.route('/api/agent/stats', provide_automatic_options = False)
+@requires_token_or_auth
+def api_agent_stats():
+    """
+    Returns the listener's own timings (latency histograms, call and error
+    counts by subsystem and key), compression totals and the state of the
+    blocking call thread pool. With more than one
+    worker these are of the worker that answered, and the request counts,
+    CPU and memory of every worker are added.
+
+    :rtype: flask.Response
+    """
+    stats = {
+        'timings': instrument.get_stats(),
+        'compression': dict(compression.stats, bytes_saved=compression.get_bytes_saved()),
+        'blocking': blocking.get_stats(),
+    }
+    worker_stats = workers.get_stats()
+    if worker_stats is not None:
+        stats['workers'] = worker_stats
+    response = Response(json.dumps({'stats': stats}, ensure_ascii=False), mimetype='application/json')
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+@listener.route('/api/', methods=['GET', 'POST'], provide_automatic_options = False)
+@listener.route('/api/<path:accessor>', methods=['GET', 'POST'], provide_automatic_options = False)
+@requires_token_or_auth
+def api(accessor=''):
+    """
+    The function that serves up all the metrics. Given some path/to/a/metric it will
+    retrieve the metric and do the necessary walking of the tree.
+
+    :param accessor: The path/to/the/desired/metric
+    :rtype: flask.Response
+    """
+    prefix = instrument.get_prefix(accessor)
+
+    # Admins can run the request under cProfile with ?profile=cpu
+    if request.args.get('profile', None) == 'cpu':
+        if not is_admin():
+            return error(msg='Profiling requires admin access.')
+        try:
+            limit = int(request.args.get('profile_limit', 30))
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            return error(msg='Invalid profile_limit, it must be a number of 1 or more.')
+
+        # Not from the cache, or there would be nothing to profile
+        method = lambda: get_api_value(accessor, request.path, request.args, keys=request.values, cached=False)
+        value, profile = profiler.profile_call(method, limit)
+        response = Response(json.dumps({'value': value, 'profile': profile}, ensure_ascii=False), mimetype='application/json')
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        return response
+
+    start = time.perf_counter()
+    try:
+        value = get_api_value(accessor, request.path, request.args, keys=request.values, stream=True)
+    except Exception:
+        instrument.observe('api', prefix, time.perf_counter() - start, True)
+        raise
 
     # Generate page and add cross-domain loading
-    response = Response(json.dumps(dict(value), ensure_ascii=False), mimetype='application/json')
+    if isinstance(value, dict):
+        instrument.observe('api', prefix, time.perf_counter() - start, 'error' in value)
+        response = Response(json.dumps(value, ensure_ascii=False), mimetype='application/json')
+    else:
+        # Streamed walks are timed until the last piece is sent
+        value = instrument.timed_iter('api', prefix, value, start)
+        response = Response(stream_with_context(value), mimetype='application/json')
     response.headers['Access-Control-Allow-Origin'] = '*'
     return response
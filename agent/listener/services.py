@@ -7,6 +7,7 @@ import os
 import psutil
 import listener.server
 import listener.database as database
+import listener.blocking as blocking
 import time
 from ncpa import listener_logger as logging
 from stat import ST_MODE,S_IXUSR,S_IXGRP,S_IXOTH
@@ -222,9 +223,7 @@ class ServiceNode(listener.nodes.LazyNode):
             pass
 
         services = {}
-        processes = []
-        for p in psutil.process_iter(attrs=['name']):
-            processes.append(p.info['name'])
+        processes = blocking.apply(lambda: [p.info['name'] for p in psutil.process_iter(attrs=['name'])])
 
         for service in possible_services:
             status = 'unknown'
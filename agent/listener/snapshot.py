@@ -0,0 +1,110 @@
+import time
+import listener.blocking as blocking
+import listener.sampler as sampler
+
+# A snapshot memoizes the calls used to collect metrics (psutil, statvfs, etc)
+# for the lifetime of one request, so sibling nodes reading the same counters
+# make the call only once and the values in a response are consistent. When
+# the listener runs the background sampler, the latest sample is used instead
+# of calling psutil inline.
+
+
+class Snapshot(object):
+
+    def __init__(self):
+        self.results = {}
+        self.times = {}
+
+        # The monotonic time the value last returned by get() was collected
+        # at, rates (deltas) are worked out over these times
+        self.last_time = None
+
+    def get(self, method, *args, **kwargs):
+        """Returns the result of method(*args, **kwargs), calling the method
+        only the first time it is asked for during this snapshot.
+
+        """
+        key = sampler.make_key(method, args, kwargs)
+        try:
+            result = self.results[key]
+            self.last_time = self.times[key]
+            return result
+        except KeyError:
+            pass
+
+        current = sampler.sampler
+        if current is not None:
+            try:
+                result = current.latest(method, *args, **kwargs)
+                self.keep(key, result, current.samples[-1].time)
+                return result
+            except KeyError:
+                current.watch(method, *args, **kwargs)
+
+        result = blocking.call(method, *args, **kwargs)
+        self.keep(key, result, time.monotonic())
+        return result
+
+    def keep(self, key, result, collected):
+        self.results[key] = result
+        self.times[key] = collected
+        self.last_time = collected
+
+    def cpu_percent(self, window=None):
+        """Returns the per-cpu percent over the window from the sampler. Raises
+        KeyError if it can not be calculated from the samples.
+
+        """
+        current = sampler.sampler
+        if current is None:
+            raise KeyError('cpu_percent')
+        return current.cpu_percent(window)
+
+
+class NotSampled(Exception):
+    pass
+
+
+class HistorySnapshot(Snapshot):
+    """A snapshot of the metrics as they were at one of the sampler's samples,
+    used to evaluate nodes over their history. It never calls psutil, reading
+    anything that was not sampled raises NotSampled.
+
+    """
+
+    def __init__(self, sample, previous=None):
+        super(HistorySnapshot, self).__init__()
+        self.sample = sample
+        self.previous = previous
+        self.used = False
+
+    def get(self, method, *args, **kwargs):
+        key = sampler.make_key(method, args, kwargs)
+        try:
+            result = self.sample.values[key]
+        except KeyError:
+            # Start sampling it so there is history the next time
+            if sampler.sampler is not None:
+                sampler.sampler.watch(method, *args, **kwargs)
+            raise NotSampled(method.__name__)
+        self.used = True
+        return result
+
+    def cpu_percent(self, window=None):
+        key = sampler.make_key(sampler.ps.cpu_times, (), {'percpu': True})
+        if self.previous is None or key not in self.previous.values or key not in self.sample.values:
+            raise NotSampled('cpu_percent')
+        self.used = True
+        return [sampler.cpu_busy_percent(b, a) for b, a in
+                zip(self.previous.values[key], self.sample.values[key])]
+
+
+def get_snapshot(request_args):
+    """Returns the snapshot carried in the request arguments, or a new one
+    when a node is run outside of a request.
+
+    """
+    snapshot = request_args.get('snapshot', None)
+    if snapshot is None:
+        snapshot = Snapshot()
+    return snapshot
@@ -3,14 +3,13 @@
 import listener.nodes
 import win32pdh
 import time
-import copy
 import re
 from ncpa import listener_logger as logging
 
 class WindowsCountersNode(listener.nodes.LazyNode):
 
     def accessor(self, path, config, full_path, args):
-        new_node = copy.deepcopy(self)
+        new_node = self.context()
         new_node.path = path
         new_node.config = config
         return new_node
@@ -0,0 +1,246 @@
+import atexit
+import multiprocessing
+import os
+import signal
+import time
+import gevent
+import psutil
+from ncpa import listener_logger as logging
+
+# Pre-forked listener workers. With [listener] workers = N (more than 1, and
+# only on posix systems) the listener process binds the socket and forks N
+# workers that all accept connections on it, so requests are spread over N
+# cores. The listener process stays as the supervisor: it restarts workers
+# that exit and stops them when it is stopped. Counters for each worker are
+# kept in shared memory so any worker can report on all of them.
+
+# Counters kept for each worker
+fields = ('pid', 'started', 'restarts', 'requests', 'errors')
+
+# Shared memory with the counters of all workers, None with one process
+table = None
+
+# The slot of this worker in the table, None in the supervisor or with one
+# process
+slot = None
+
+# Methods to run when this worker exits (workers skip atexit)
+exit_methods = []
+
+# Workers that exit sooner than this many seconds after starting are
+# restarted after a delay that doubles each time, up to max_restart_delay
+min_uptime = 10
+max_restart_delay = 60
+
+
+def get_count(config):
+    """Returns the number of workers to run, 1 means the listener process
+    serves requests itself.
+
+    """
+    try:
+        count = config.getint('listener', 'workers')
+    except Exception:
+        return 1
+    if count > 1 and os.name != 'posix':
+        logging.warning("Listener workers are only supported on Linux and Unix, starting one process.")
+        return 1
+    return max(count, 1)
+
+
+def at_exit(method):
+    """Runs method when the process exits, in workers as well."""
+    if slot is None:
+        atexit.register(method)
+    else:
+        exit_methods.append(method)
+
+
+def get_value(index, name):
+    return table[index * len(fields) + fields.index(name)]
+
+
+def set_value(index, name, value):
+    table[index * len(fields) + fields.index(name)] = value
+
+
+def count_request(error=False):
+    """Counts a request served by this worker."""
+    if slot is None:
+        return
+    set_value(slot, 'requests', get_value(slot, 'requests') + 1)
+    if error:
+        set_value(slot, 'errors', get_value(slot, 'errors') + 1)
+
+
+def get_stats():
+    """Returns the counters, uptime, CPU time and memory of each worker, or
+    None when the listener runs as one process.
+
+    """
+    if table is None:
+        return None
+
+    now = time.time()
+    stats = []
+    for index in range(len(table) // len(fields)):
+        pid = int(get_value(index, 'pid'))
+        worker = {
+            'worker': index,
+            'pid': pid,
+            'current': index == slot,
+            'uptime': round(now - get_value(index, 'started'), 1) if pid else 0,
+            'restarts': int(get_value(index, 'restarts')),
+            'requests': int(get_value(index, 'requests')),
+            'errors': int(get_value(index, 'errors')),
+        }
+        try:
+            process = psutil.Process(pid)
+            with process.oneshot():
+                times = process.cpu_times()
+                worker['cpu_seconds'] = round(times.user + times.system, 2)
+                worker['memory_rss'] = process.memory_info().rss
+        except Exception:
+            worker['cpu_seconds'] = None
+            worker['memory_rss'] = None
+        stats.append(worker)
+    return stats
+
+
+class Supervisor(object):
+    """Forks the workers for a server and keeps them running. setup is run
+    in each worker before it starts serving (for the greenlets and state
+    that each process needs its own of).
+
+    """
+
+    def __init__(self, server, count, setup=None):
+        self.server = server
+        self.count = count
+        self.setup = setup
+        self.workers = {}
+        self.delays = [0] * count
+        self.restart_at = {}
+        self.stopping = False
+
+    def run(self):
+        global table
+        table = multiprocessing.RawArray('d', self.count * len(fields))
+
+        # Bind before forking so all workers accept on the same socket
+        self.server.init_socket()
+
+        signal.signal(signal.SIGTERM, self.on_signal)
+        signal.signal(signal.SIGINT, self.on_signal)
+
+        for index in range(self.count):
+            self.start_worker(index)
+        logging.info("Started %d listener workers", self.count)
+
+        while not self.stopping:
+            self.reap()
+            now = time.monotonic()
+            for index, restart_at in list(self.restart_at.items()):
+                if restart_at <= now:
+                    del self.restart_at[index]
+                    self.start_worker(index)
+            time.sleep(0.5)
+
+        self.stop_workers()
+
+    def on_signal(self, signalnum, frame):
+        self.stopping = True
+
+    def start_worker(self, index):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(index)
+
+        if get_value(index, 'pid'):
+            set_value(index, 'restarts', get_value(index, 'restarts') + 1)
+        set_value(index, 'pid', pid)
+        set_value(index, 'started', time.time())
+        self.workers[pid] = (index, time.monotonic())
+        logging.debug("Started listener worker %d (pid %d)", index, pid)
+
+    def run_worker(self, index):
+        global slot
+        slot = index
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, lambda *args: gevent.spawn(self.server.stop, 5))
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            gevent.spawn(self.watch_parent, os.getppid())
+            if self.setup is not None:
+                self.setup()
+            self.server.serve_forever()
+        except Exception as e:
+            logging.exception("Listener worker %d failed: %s", index, e)
+            code = 1
+        finally:
+            for method in exit_methods:
+                try:
+                    method()
+                except Exception as e:
+                    logging.exception(e)
+            os._exit(code)
+
+    def watch_parent(self, ppid):
+        # Stop if the supervisor is gone (killed without passing it on)
+        while True:
+            gevent.sleep(1)
+            if os.getppid() != ppid:
+                self.server.stop(5)
+                return
+
+    def reap(self):
+        """Schedules the restart of workers that have exited."""
+        for pid, (index, started) in list(self.workers.items()):
+            try:
+                exited, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                exited, status = pid, 0
+            if not exited:
+                continue
+
+            del self.workers[pid]
+            if self.stopping:
+                continue
+
+            uptime = time.monotonic() - started
+            if uptime < min_uptime:
+                self.delays[index] = min(max(self.delays[index] * 2, 1), max_restart_delay)
+            else:
+                self.delays[index] = 0
+            if os.WIFSIGNALED(status):
+                reason = 'was killed by signal %d' % os.WTERMSIG(status)
+            else:
+                reason = 'exited with status %d' % os.WEXITSTATUS(status)
+            logging.warning("Listener worker %d (pid %d) %s after %ds, restarting in %ds",
+                            index, pid, reason, uptime, self.delays[index])
+            self.restart_at[index] = time.monotonic() + self.delays[index]
+
+    def stop_workers(self, timeout=10):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        end = time.monotonic() + timeout
+        while self.workers and time.monotonic() < end:
+            for pid in list(self.workers):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        del self.workers[pid]
+                except ChildProcessError:
+                    del self.workers[pid]
+            time.sleep(0.1)
+
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.server.close()
+        logging.info("Stopped the listener workers")
@@ -29,7 +29,6 @@ import logging
 import ssl
 from zlib import ZLIB_VERSION as zlib_version
 import sys
-import tempfile
 import time
 import psutil
 
@@ -40,7 +39,6 @@ from argparse import ArgumentParser
 from configparser import ConfigParser
 from gevent.pool import Pool
 from gevent.pywsgi import WSGIServer
-from geventwebsocket.handler import WebSocketHandler
 from socket import error as SocketError
 from io import open
 from logging.handlers import RotatingFileHandler
@@ -68,13 +66,6 @@ def tokenFilter(record):
             return f"Error filtering log record: {e}"
     return record
 
-
-# NCPA-specific module imports
-import listener.server
-import listener.psapi
-import listener.certificate as certificate
-import listener.database as database
-
 # Imports for different system types
 if os.name == 'posix':
     import grp
@@ -138,6 +129,7 @@ cfg_defaults = {
                 'exclude_fs_types': 'aufs,autofs,binfmt_misc,cifs,cgroup,configfs,debugfs,devpts,devtmpfs,encryptfs,efivarfs,fuse,fusectl,hugetlbfs,mqueue,nfs,overlayfs,proc,pstore,rpc_pipefs,securityfs,selinuxfs,smb,sysfs,tmpfs,tracefs,nfsd,xenfs',
                 'default_units': 'Gi',
                 'allow_remote_restart': '0',
+                'trace_memory': '0',
             },
             'listener': {
                 'ip': address,
@@ -152,12 +144,24 @@ cfg_defaults = {
                 'admin_auth_only': '0',
                 'allowed_hosts': '',
                 'max_connections': '200',
+                'workers': '1',
+                'blocking_threads': '4',
+                'blocking_timeout': '10',
                 'allowed_sources': '',
                 'allow_config_edit': '1', # Note: this is limited to non-sensitive settings
+                'sample_interval': '1',
+                'sample_history': '900',
+                'delta_store_size': '4096',
+                'delta_store_file': '',
+                'compression': '1',
+                'compression_min_size': '1024',
             },
             'api': {
                 'community_string': 'mytoken',
+                'walk_concurrency': '16',
+                'walk_timeout': '30',
             },
+            'api cache': {},
             'passive': {
                 'handlers': 'None',
                 'sleep': '300',
@@ -232,6 +236,16 @@ class Listener(Base):
     to run the listener so all of NCPA is bundled in a single service
     """
     def run(self):
+        # The listener modules (Flask, OpenSSL, the API tree) are only imported
+        # by the listener process, so the command line starts quickly
+        import listener.server
+        import listener.sampler
+        import listener.deltas
+        import listener.compression
+        import listener.profiler
+        import listener.workers
+        import listener.blocking
+
         self.init_logger('listener')
         logger = self.logger
         logger.info("run()")
@@ -269,6 +283,11 @@ class Listener(Base):
 
                 user_cert = self.config.get('listener', 'certificate')
 
+                workers = listener.workers.get_count(self.config)
+                logger.debug("workers: %s", workers)
+
+                listener.blocking.setup(self.config)
+
             except Exception as e:
                 logger.exception("run() - config exception: %s", e)
                 self.send_error()
@@ -276,6 +295,7 @@ class Listener(Base):
 
             # Set up certs and start http server
             if user_cert == 'adhoc':
+                import listener.certificate as certificate
                 logger.debug('Start create cert')
                 cert, key = certificate.create_self_signed_cert(get_filename('var'), 'ncpa.crt', 'ncpa.key')
                 logger.debug('Cert created')
@@ -289,17 +309,37 @@ class Listener(Base):
             # Pass config to Flask instance
             listener.server.listener.config['iconfig'] = self.config
 
+            # The API tree is not built here, each subtree is built the first
+            # time a request asks for it
+
+            # Compress large responses and websocket messages
+            listener.compression.setup(self.config)
+
+            # Each process that serves requests has its own sampler, deltas
+            # and memory tracing
+            def setup_process():
+                # Start sampling the core metrics in the background
+                listener.sampler.start(self.config)
+
+                # Keep the values used for delta requests in memory
+                listener.deltas.setup(self.config)
+
+                # Log where memory grows, if asked to
+                trace_interval = listener.profiler.get_trace_interval(self.config)
+                if trace_interval:
+                    listener.profiler.start_memory_logging(logger, trace_interval)
+
             # Create connection pool
             listener.server.listener.secret_key = os.urandom(24)
             logger.debug("run() - define http_server")
             http_server = WSGIServer(listener=(address, port),
                                         application=listener.server.listener,
-                                        handler_class=WebSocketHandler,
+                                        handler_class=listener.compression.DeflateWebSocketHandler,
                                         log=listener_logger,
                                         spawn=Pool(max_connections),
                                         **ssl_context)
             logger.debug("run() - start http_server")
-            http_server.serve_forever()
+            self.serve(http_server, workers, setup_process)
             logger.debug("run() - http_server running")
 
         # If we fail to start in dual stack mode, try IPv4 only
@@ -312,17 +352,30 @@ class Listener(Base):
             address = '0.0.0.0'
             http_server = WSGIServer(listener=(address, port),
                                         application=listener.server.listener,
-                                        handler_class=WebSocketHandler,
+                                        handler_class=listener.compression.DeflateWebSocketHandler,
                                         log=listener_logger,
                                         spawn=Pool(max_connections),
                                         **ssl_context)
-            http_server.serve_forever()
+            self.serve(http_server, workers, setup_process)
 
         except Exception as e:
             logger.exception("exception: %s", e)
             self.send_error()
             return
 
+    def serve(self, http_server, workers, setup_process):
+        """Serves requests in this process, or in pre-forked workers that
+        share the server's socket."""
+        import listener.workers
+
+        if workers > 1:
+            listener.workers.Supervisor(http_server, workers, setup_process).run()
+        else:
+            # Bind first so a failed bind does not set the process up twice
+            http_server.init_socket()
+            setup_process()
+            http_server.serve_forever()
+
 class Passive(Base):
     """
     The passive service that runs in the background - this is run in a
@@ -365,6 +418,10 @@ class Passive(Base):
                     return
 
     def run(self):
+        import listener.database as database
+        import listener.profiler
+        import listener.blocking
+
         self.init_logger('passive')
         logger = self.logger
         logger.info("run()")
@@ -378,15 +435,27 @@ class Passive(Base):
             logger.exception("run() - exception: %s", e)
             pass
 
+        listener.blocking.setup(self.config)
+
         # Set next DB maintenance period to +1 day
         self.db = database.DB()
         self.db.run_db_maintenance(self.config)
         next_db_maintenance = datetime.datetime.now() + datetime.timedelta(days=1)
 
+        # Log where memory grows, if asked to
+        trace_interval = listener.profiler.get_trace_interval(self.config)
+        if trace_interval:
+            listener.profiler.get_tracer().start()
+        next_memory_trace = time.time()
+
         try:
             while not self.has_error.value:
                 self.run_all_handlers()
 
+                if trace_interval and time.time() >= next_memory_trace:
+                    listener.profiler.log_memory_growth(logger)
+                    next_memory_trace = time.time() + trace_interval
+
                 # Do DB maintenance if the time is greater than next DB maintenance run
                 if datetime.datetime.now() > next_db_maintenance:
                     logger.info("run() - doing DB maintenance")
@@ -457,18 +526,6 @@ class Daemon():
         """
         self.logger.debug("Daemon init - setup_root()")
 
-        # We need to chown any temp files we wrote out as root (or any other user)
-        # to the currently set user and group so checks don't error out
-        try:
-            tmpdir = os.path.join(tempfile.gettempdir())
-            for file in os.listdir(tmpdir):
-                if os.path.isfile(file):
-                    if 'ncpa-' in file:
-                        self.chown(os.path.join(tmpdir, file))
-        except OSError as e:
-            self.logger.exception(e)
-            pass
-
     def user_setup_tasks(self):
         pass
 
@@ -1047,6 +1104,8 @@ def setup_logger(config, loggerinstance, logfile):
 
 def start_processes(options, config, has_error):
     """Start the processes for the listener and passive components"""
+    import listener.database as database
+
     try:
         # Create the database structure for checks
         db = database.DB()
@@ -0,0 +1,293 @@
+"""
+Benchmarks of the listener's hot paths: looking up and walking nodes, running
+checks with thresholds and the same requests through the Flask test client.
+
+The metrics come from a fake psutil with fixed values (a set number of cpus,
+disks, interfaces and processes), so the results depend on NCPA and the
+Python it runs on and can be compared between releases. Each benchmark
+reports ops/sec, latency and the memory it allocates per call, and the
+results are saved as JSON.
+
+    python test/benchmark.py
+    python test/benchmark.py --output 3.1.1.json
+    python test/benchmark.py --compare 3.1.0.json --filter walk
+"""
+
+import includes_for_tests
+import argparse
+import collections
+import configparser
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.psapi as psapi
+import ncpa
+import psutil
+
+
+# The size of the fake system
+cpus = 8
+interfaces = 4
+processes = 300
+mountpoints = ('/', '/var', '/home')
+
+
+scputimes = collections.namedtuple('scputimes', 'user nice system idle iowait irq softirq steal guest guest_nice')
+svmem = collections.namedtuple('svmem', 'total available percent used free active inactive buffers cached shared slab')
+sswap = collections.namedtuple('sswap', 'total used free percent sin sout')
+sdiskio = collections.namedtuple('sdiskio', 'read_count write_count read_bytes write_bytes read_time write_time busy_time')
+sdiskpart = collections.namedtuple('sdiskpart', 'device mountpoint fstype opts maxfile maxpath')
+sdiskusage = collections.namedtuple('sdiskusage', 'total used free percent')
+snetio = collections.namedtuple('snetio', 'bytes_sent bytes_recv packets_sent packets_recv errin errout dropin dropout')
+suser = collections.namedtuple('suser', 'name terminal host started pid')
+pmem = collections.namedtuple('pmem', 'rss vms')
+statvfs_result = collections.namedtuple('statvfs_result', 'f_bsize f_frsize f_blocks f_bfree f_bavail f_files f_ffree f_favail f_flag f_namemax')
+
+
+class FakeProcess(object):
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.info = {}
+        self._name = 'proc%d' % (pid % 40)
+
+    def name(self):
+        return self._name
+
+    def exe(self):
+        return '/usr/bin/' + self._name
+
+    def username(self):
+        return 'nagios' if self.pid % 3 else 'root'
+
+    def cmdline(self):
+        return ['/usr/bin/' + self._name, '--id', str(self.pid)]
+
+    def cpu_percent(self, interval=None):
+        return float(self.pid % 7)
+
+    def memory_percent(self):
+        return (self.pid % 11) / 10.0
+
+    def memory_info(self):
+        return pmem(self.pid * 4096, self.pid * 16384)
+
+    @contextlib.contextmanager
+    def oneshot(self):
+        yield
+
+    def as_dict(self, attrs=None, ad_value=None):
+        values = {}
+        for attr in attrs or ('pid', 'name', 'exe', 'username', 'cmdline', 'cpu_percent', 'memory_percent', 'memory_info'):
+            value = getattr(self, attr)
+            values[attr] = value if attr == 'pid' else value()
+        return values
+
+
+def process_iter(attrs=None, ad_value=None):
+    for pid in range(1, processes + 1):
+        process = FakeProcess(pid)
+        if attrs is not None:
+            process.info = process.as_dict(attrs, ad_value)
+        yield process
+
+
+def disk_partitions(all=False):
+    return [sdiskpart('/dev/sda%d' % i, x, 'ext4', 'rw,relatime', 255, 4096) for i, x in enumerate(mountpoints)]
+
+
+def statvfs(path):
+    return statvfs_result(4096, 4096, 25000000, 10000000, 9000000, 6000000, 5000000, 5000000, 0, 255)
+
+
+# Replacements for the psutil (and os) calls the API makes
+fakes = {
+    'cpu_times': lambda percpu=False: [scputimes(1000.0 + i, 5.0, 300.0, 9000.0, 20.0, 0.0, 1.0, 0.0, 0.0, 0.0) for i in range(cpus)],
+    'cpu_percent': lambda interval=None, percpu=False: [12.5] * cpus if percpu else 12.5,
+    'cpu_count': lambda logical=True: cpus,
+    'virtual_memory': lambda: svmem(16 * 2**30, 10 * 2**30, 37.5, 6 * 2**30, 4 * 2**30, 5 * 2**30, 3 * 2**30, 2**28, 2**30, 2**27, 2**27),
+    'swap_memory': lambda: sswap(4 * 2**30, 2**28, 4 * 2**30 - 2**28, 6.2, 0, 0),
+    'disk_io_counters': lambda perdisk=False: dict(('sda%d' % i, sdiskio(1000, 2000, 2**30, 2**31, 500, 900, 1200)) for i in range(len(mountpoints))),
+    'disk_partitions': disk_partitions,
+    'disk_usage': lambda path: sdiskusage(100 * 2**30, 60 * 2**30, 40 * 2**30, 60.0),
+    'net_io_counters': lambda pernic=False: dict(('eth%d' % i, snetio(2**30, 2**31, 10**6, 2 * 10**6, 0, 0, 0, 0)) for i in range(interfaces)),
+    'users': lambda: [suser('nagios', 'pts/0', 'localhost', 1700000000.0, 1000)],
+    'boot_time': lambda: 1700000000.0,
+    'process_iter': process_iter,
+}
+
+
+@contextlib.contextmanager
+def fake_metrics():
+    with contextlib.ExitStack() as stack:
+        for name, method in fakes.items():
+            stack.enter_context(mock.patch.object(psutil, name, method))
+        stack.enter_context(mock.patch.object(os, 'statvfs', statvfs))
+        yield
+
+
+def get_config():
+    config = configparser.ConfigParser()
+    config.read_dict(ncpa.cfg_defaults)
+    config.set('api', 'community_string', 'mytoken')
+    return config
+
+
+def make_kwargs(config, accessor, **values):
+    """Returns the arguments the API passes to walk and run_check."""
+    kwargs = dict((key, [value]) for key, value in values.items())
+    kwargs.update({'debug': True, 'remote_addr': '127.0.0.1', 'accessor': accessor,
+                   'config': config, 'units': 'Gi', 'check': 'warning' in values})
+    return kwargs
+
+
+def walk(config, accessor, **values):
+    kwargs = make_kwargs(config, accessor, **values)
+
+    def run():
+        node = psapi.getter(accessor, config, '/api/' + accessor, {})
+        return node.walk(**kwargs)
+    return run
+
+
+def check(config, accessor, **values):
+    kwargs = make_kwargs(config, accessor, **values)
+
+    def run():
+        node = psapi.getter(accessor, config, '/api/' + accessor, {})
+        return node.run_check(**kwargs)
+    return run
+
+
+def request(client, url):
+    def run():
+        response = client.get(url)
+        response.get_data()
+        response.close()
+        return response.status_code
+    return run
+
+
+def get_benchmarks(config):
+    listener.server.listener.config['iconfig'] = config
+    listener.server.__INTERNAL__ = True
+    client = listener.server.listener.test_client()
+
+    return collections.OrderedDict([
+        ('walk_root', walk(config, '')),
+        ('walk_cpu_percent', walk(config, 'cpu/percent')),
+        ('walk_disk_logical', walk(config, 'disk/logical')),
+        ('walk_processes', walk(config, 'processes')),
+        ('check_cpu_percent', check(config, 'cpu/percent', warning='80', critical='90', aggregate='avg')),
+        ('check_memory_virtual', check(config, 'memory/virtual/percent', warning='80:', critical='@90:100')),
+        ('check_processes', check(config, 'processes', name='proc1', warning='5', critical='10')),
+        ('http_root', request(client, '/api/')),
+        ('http_cpu_percent', request(client, '/api/cpu/percent')),
+        ('http_disk_logical', request(client, '/api/disk/logical')),
+        ('http_processes', request(client, '/api/processes')),
+        ('http_check_cpu_percent', request(client, '/api/cpu/percent?check=1&warning=80&critical=90&aggregate=avg')),
+    ])
+
+
+def run_benchmark(method, min_time, min_iterations, memory_iterations):
+    # Warm up, the first call builds the nodes
+    method()
+
+    times = []
+    end = time.perf_counter() + min_time
+    while len(times) < min_iterations or time.perf_counter() < end:
+        start = time.perf_counter()
+        method()
+        times.append(time.perf_counter() - start)
+
+    # Memory is measured apart from the timings since tracing slows it down
+    tracemalloc.start()
+    peaks = []
+    start_size = tracemalloc.get_traced_memory()[0]
+    for i in range(memory_iterations):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        method()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    retained = tracemalloc.get_traced_memory()[0] - start_size
+    tracemalloc.stop()
+
+    times.sort()
+    total = sum(times)
+    return {
+        'iterations': len(times),
+        'ops_per_sec': round(len(times) / total, 1),
+        'mean_ms': round(total / len(times) * 1000, 4),
+        'p50_ms': round(times[len(times) // 2] * 1000, 4),
+        'p95_ms': round(times[int(len(times) * 0.95)] * 1000, 4),
+        'peak_bytes': max(peaks) if peaks else 0,
+        'retained_bytes': retained // memory_iterations if memory_iterations else 0,
+    }
+
+
+def print_results(results, baseline=None):
+    header = '%-26s %12s %10s %10s %12s' % ('benchmark', 'ops/sec', 'p50 ms', 'p95 ms', 'peak KiB')
+    if baseline:
+        header += ' %10s' % 'change'
+    print(header)
+    for name, result in results.items():
+        line = '%-26s %12.1f %10.3f %10.3f %12.1f' % (name, result['ops_per_sec'], result['p50_ms'],
+                                                     result['p95_ms'], result['peak_bytes'] / 1024.0)
+        old = baseline.get(name, None) if baseline else None
+        if old:
+            line += ' %+9.1f%%' % ((result['ops_per_sec'] / old['ops_per_sec'] - 1) * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the NCPA listener against fixed fake metrics.')
+    parser.add_argument('-o', '--output', help='file to save the results in (default: benchmark-<version>.json)')
+    parser.add_argument('-c', '--compare', help='results of an earlier run to compare against')
+    parser.add_argument('-f', '--filter', default='', help='only run benchmarks with this in their name')
+    parser.add_argument('-t', '--min-time', type=float, default=1.0, help='seconds to run each benchmark for')
+    parser.add_argument('-n', '--min-iterations', type=int, default=20)
+    parser.add_argument('-m', '--memory-iterations', type=int, default=20)
+    options = parser.parse_args()
+
+    with fake_metrics():
+        config = get_config()
+        results = collections.OrderedDict()
+        for name, method in get_benchmarks(config).items():
+            if options.filter in name:
+                results[name] = run_benchmark(method, options.min_time, options.min_iterations,
+                                              options.memory_iterations)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    output = options.output or 'benchmark-%s.json' % ncpa.__VERSION__
+    with open(output, 'w') as f:
+        json.dump({
+            'version': ncpa.__VERSION__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.now().isoformat(),
+            'fake_system': {'cpus': cpus, 'interfaces': interfaces, 'processes': processes,
+                            'mountpoints': len(mountpoints)},
+            'options': {'min_time': options.min_time, 'min_iterations': options.min_iterations,
+                        'memory_iterations': options.memory_iterations},
+            'results': results,
+        }, f, indent=4)
+    print('Saved the results to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,467 @@
+"""
+Load test of the listener as it runs in production: the listener process is
+started with Listener.run() (the same WSGIServer, websocket handler and
+connection pool) on a self-signed certificate, then driven by concurrent
+keep-alive clients making a mix of API walks, checks and plugin calls while
+websocket clients stay subscribed to /ws/top.
+
+It reports throughput, error rates and p50/p99 latency by kind of request,
+which is what max_connections should be sized by and what shows regressions
+in how the listener handles concurrent requests.
+
+    python test/loadtest.py --clients 50 --duration 30
+    python test/loadtest.py --clients 200 --max-connections 100 --ws 20
+    python test/loadtest.py --clients 200 --workers 4
+    python test/loadtest.py --mix walk=1 --url https://agent:5693 --token mytoken
+"""
+
+import includes_for_tests
+import argparse
+import base64
+import collections
+import configparser
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import ssl
+import struct
+import sys
+import tempfile
+import time
+import urllib.parse
+import zlib
+import gevent
+import requests
+import urllib3
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.certificate as certificate
+import ncpa
+
+
+# The requests made for each kind in the mix
+urls = {
+    'walk': (
+        '/api/',
+        '/api/cpu/percent',
+        '/api/memory/virtual',
+        '/api/disk/logical',
+        '/api/interface',
+        '/api/system',
+        '/api/processes',
+    ),
+    'check': (
+        '/api/cpu/percent?check=1&warning=80&critical=90&aggregate=avg',
+        '/api/memory/virtual/percent?check=1&warning=80&critical=90',
+        '/api/memory/swap/percent?check=1&warning=50&critical=75',
+        '/api/processes?check=1&name=python3&warning=0:100&critical=0:200',
+    ),
+    'plugin': (
+        '/api/plugins/%(plugin)s?args=-w&args=80',
+    ),
+}
+
+default_mix = 'walk=60,check=35,plugin=5'
+
+plugin_name = 'check_loadtest.sh'
+plugin_script = '#!/bin/sh\necho "OK: load test | value=1;80;90"\nexit 0\n'
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.error_types = collections.Counter()
+
+    def add(self, kind, seconds, error=None):
+        self.latencies[kind].append(seconds)
+        if error is not None:
+            self.errors[kind] += 1
+            self.error_types[error] += 1
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+def parse_mix(mix):
+    weights = collections.OrderedDict()
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        if kind not in urls:
+            raise ValueError('Unknown kind of request in the mix: %s' % kind)
+        weights[kind] = float(weight)
+    return weights
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# ------------------------------
+# Listener
+# ------------------------------
+
+
+def make_config(tmp_dir, options):
+    """Returns the config the listener is started with, everything it writes
+    goes in tmp_dir.
+
+    """
+    config = configparser.ConfigParser()
+    config.read_dict(ncpa.cfg_defaults)
+    if options.config:
+        config.read(options.config)
+
+    cert, key = certificate.create_self_signed_cert(tmp_dir, 'ncpa.crt', 'ncpa.key')
+    config.set('listener', 'ip', '127.0.0.1')
+    config.set('listener', 'port', str(options.port))
+    config.set('listener', 'certificate', '%s,%s' % (cert, key))
+    config.set('listener', 'logfile', os.path.join(tmp_dir, 'ncpa_listener.log'))
+    config.set('listener', 'delay_start', '0')
+    config.set('listener', 'allowed_hosts', '')
+    config.set('api', 'community_string', options.token)
+    if options.max_connections:
+        config.set('listener', 'max_connections', str(options.max_connections))
+    if options.workers:
+        config.set('listener', 'workers', str(options.workers))
+
+    # The log is written as the user running the test
+    if os.name == 'posix':
+        import grp
+        import pwd
+        config.set('general', 'uid', pwd.getpwuid(os.getuid()).pw_name)
+        config.set('general', 'gid', grp.getgrgid(os.getgid()).gr_name)
+
+    # Keep the checks out of the agent's database
+    if not options.check_logging:
+        config.set('general', 'check_logging', '0')
+
+    plugin_dir = os.path.join(tmp_dir, 'plugins')
+    os.mkdir(plugin_dir)
+    with open(os.path.join(plugin_dir, plugin_name), 'w') as f:
+        f.write(plugin_script)
+    os.chmod(os.path.join(plugin_dir, plugin_name), 0o755)
+    config.set('plugin directives', 'plugin_path', plugin_dir + os.sep)
+    return config
+
+
+def run_listener(config):
+    has_error = multiprocessing.Value('i', False)
+    ncpa.Listener(None, config, has_error).run()
+
+
+def get_client_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def wait_for_listener(port, timeout=30):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 1)
+            get_client_context().wrap_socket(sock).close()
+            return True
+        except (socket.error, ssl.SSLError):
+            gevent.sleep(0.1)
+    return False
+
+
+# ------------------------------
+# HTTP clients
+# ------------------------------
+
+
+def run_client(stats, base_url, token, weights, plugin, end, timeout, seed):
+    rng = random.Random(seed)
+    kinds = list(weights.keys())
+    session = requests.Session()
+
+    while time.monotonic() < end:
+        kind = rng.choices(kinds, weights=list(weights.values()))[0]
+        url = rng.choice(urls[kind]) % {'plugin': plugin}
+
+        error = None
+        start = time.perf_counter()
+        try:
+            response = session.get(base_url + url, params={'token': token}, timeout=timeout, verify=False)
+            if response.status_code != 200:
+                error = 'HTTP %d' % response.status_code
+            else:
+                value = response.json()
+                if 'error' in value:
+                    error = 'API error'
+                elif value.get('returncode', 0) == 3:
+                    error = 'UNKNOWN check result'
+        except requests.exceptions.Timeout:
+            error = 'timeout'
+        except (requests.exceptions.RequestException, ValueError) as e:
+            error = e.__class__.__name__
+            # Start over on a new connection, like a poller would
+            session.close()
+            session = requests.Session()
+        stats.add(kind, time.perf_counter() - start, error)
+
+    session.close()
+
+
+# ------------------------------
+# Websocket clients
+# ------------------------------
+
+
+class WebSocketClient(object):
+    """Just enough of a websocket client to subscribe to the listener's
+    websockets: it offers permessage-deflate (as browsers do) and reads
+    text messages.
+
+    """
+
+    def __init__(self, host, port, path, timeout=10):
+        sock = socket.create_connection((host, port), timeout)
+        self.sock = get_client_context().wrap_socket(sock, server_hostname=host)
+        self.buffer = b''
+        self.inflater = None
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((
+            'GET %s HTTP/1.1\r\n'
+            'Host: %s:%d\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: %s\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            'Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n'
+            '\r\n' % (path, host, port, key)
+        ).encode())
+
+        while b'\r\n\r\n' not in self.buffer:
+            self.fill()
+        head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        if ' 101 ' not in lines[0] + ' ':
+            raise IOError('Websocket upgrade failed: %s' % lines[0])
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            if name.strip().lower() == 'sec-websocket-extensions' and 'permessage-deflate' in value:
+                self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise IOError('Connection closed')
+        self.buffer += data
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            self.fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_frame(self):
+        first, second = struct.unpack('!BB', self.read(2))
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read(8))[0]
+        if second & 0x80:
+            mask = self.read(4)
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.read(length)))
+        else:
+            payload = self.read(length)
+        return first & 0x80, first & 0x40, first & 0x0f, payload
+
+    def receive(self):
+        """Returns the next message, or None when the listener closes."""
+        parts = []
+        compressed = False
+        while True:
+            fin, rsv1, opcode, payload = self.read_frame()
+            if opcode == 0x8:
+                return None
+            if opcode in (0x9, 0xa):
+                continue
+            if opcode != 0x0:
+                compressed = bool(rsv1)
+            parts.append(payload)
+            if fin:
+                break
+
+        message = b''.join(parts)
+        if compressed:
+            message = self.inflater.decompress(message + b'\x00\x00\xff\xff')
+        return message.decode('utf-8')
+
+    def close(self):
+        try:
+            # Client frames have to be masked
+            mask = os.urandom(4)
+            self.sock.sendall(b'\x88\x80' + mask)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+def run_ws_client(stats, host, port, token, end, timeout):
+    path = '/ws/top?' + urllib.parse.urlencode({'token': token})
+    start = time.perf_counter()
+    try:
+        ws = WebSocketClient(host, port, path, timeout)
+    except Exception as e:
+        stats.add('ws connect', time.perf_counter() - start, e.__class__.__name__)
+        return
+    stats.add('ws connect', time.perf_counter() - start)
+
+    # The time between messages, /ws/top sends one about every second
+    last = time.perf_counter()
+    try:
+        while time.monotonic() < end:
+            message = ws.receive()
+            now = time.perf_counter()
+            if message is None:
+                stats.add('ws top', now - last, 'websocket closed')
+                break
+            json.loads(message)
+            stats.add('ws top', now - last)
+            last = now
+    except Exception as e:
+        stats.add('ws top', time.perf_counter() - last, e.__class__.__name__)
+    finally:
+        ws.close()
+
+
+# ------------------------------
+# Report
+# ------------------------------
+
+
+def get_results(stats, duration):
+    results = collections.OrderedDict()
+    for kind in sorted(stats.latencies):
+        latencies = stats.latencies[kind]
+        errors = stats.errors[kind]
+        results[kind] = {
+            'count': len(latencies),
+            'errors': errors,
+            'error_rate': round(errors * 100.0 / len(latencies), 2) if latencies else 0,
+            'per_sec': round(len(latencies) / duration, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'max_ms': round(max(latencies) * 1000, 1) if latencies else 0,
+        }
+    return results
+
+
+def print_results(results, stats):
+    print('%-12s %9s %8s %8s %9s %10s %10s %10s' % ('kind', 'count', 'errors', 'error %', 'per sec', 'p50 ms', 'p99 ms', 'max ms'))
+    for kind, result in results.items():
+        print('%-12s %9d %8d %8.2f %9.1f %10.1f %10.1f %10.1f' % (
+            kind, result['count'], result['errors'], result['error_rate'], result['per_sec'],
+            result['p50_ms'], result['p99_ms'], result['max_ms']))
+    if stats.error_types:
+        print('\nErrors:')
+        for error, count in stats.error_types.most_common():
+            print('  %-40s %d' % (error, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tests the NCPA listener.')
+    parser.add_argument('-c', '--clients', type=int, default=20, help='concurrent keep-alive HTTP clients')
+    parser.add_argument('-w', '--ws', type=int, default=2, help='websocket clients subscribed to /ws/top')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds to run for')
+    parser.add_argument('-m', '--mix', default=default_mix, help='weights of the kinds of requests (default: %s)' % default_mix)
+    parser.add_argument('--max-connections', type=int, help='max_connections of the listener started for the test')
+    parser.add_argument('--workers', type=int, help='workers of the listener started for the test')
+    parser.add_argument('--config', help='ncpa.cfg to start the listener with (the port, cert and logs are overridden)')
+    parser.add_argument('--check-logging', action='store_true', help='keep check logging on (writes to var/ncpa.db)')
+    parser.add_argument('--url', help='test a listener that is already running instead of starting one')
+    parser.add_argument('--token', default='loadtest', help='API token')
+    parser.add_argument('--plugin', default=plugin_name, help='plugin to call for the plugin part of the mix')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds before a request times out')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the request mix')
+    parser.add_argument('-o', '--output', help='file to save the results in as JSON')
+    options = parser.parse_args()
+    weights = parse_mix(options.mix)
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    process = None
+    tmp_dir = None
+    if options.url:
+        url = urllib.parse.urlsplit(options.url)
+        host, port = url.hostname, url.port or 5693
+    else:
+        host, port = '127.0.0.1', get_free_port()
+        options.port = port
+        tmp_dir = tempfile.mkdtemp(prefix='ncpa-loadtest-')
+        config = make_config(tmp_dir, options)
+        process = multiprocessing.Process(target=run_listener, args=(config,))
+        process.start()
+        if not wait_for_listener(port) or not process.is_alive():
+            process.terminate()
+            sys.exit('The listener did not start, see %s' % os.path.join(tmp_dir, 'ncpa_listener.log'))
+
+    base_url = 'https://%s:%d' % (host, port)
+    print('Testing %s with %d clients and %d websockets for %gs (%s)' % (
+        base_url, options.clients, options.ws, options.duration, options.mix))
+
+    stats = Stats()
+    start = time.monotonic()
+    end = start + options.duration
+    greenlets = []
+    try:
+        for i in range(options.ws):
+            greenlets.append(gevent.spawn(run_ws_client, stats, host, port, options.token, end, options.timeout))
+        for i in range(options.clients):
+            greenlets.append(gevent.spawn(run_client, stats, base_url, options.token, weights,
+                                          options.plugin, end, options.timeout, options.seed + i))
+        gevent.joinall(greenlets, timeout=options.duration + options.timeout + 5)
+        gevent.killall(greenlets)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+    duration = time.monotonic() - start
+
+    results = get_results(stats, duration)
+    print_results(results, stats)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({
+                'version': ncpa.__VERSION__,
+                'url': base_url,
+                'clients': options.clients,
+                'ws': options.ws,
+                'duration': round(duration, 1),
+                'mix': weights,
+                'max_connections': options.max_connections,
+                'workers': options.workers,
+                'results': results,
+                'errors': dict(stats.error_types),
+            }, f, indent=4)
+        print('Saved the results to %s' % options.output)
+
+    if tmp_dir is not None:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
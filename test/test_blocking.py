@@ -0,0 +1,103 @@
+import includes_for_tests
+import os
+import sys
+import unittest
+import gevent
+from gevent.monkey import get_original
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.blocking as blocking
+import listener.processes as processes
+
+# Sleeps without yielding to the hub, like a stat on a hung mount
+block = get_original('time', 'sleep')
+
+
+class TestBlocking(unittest.TestCase):
+
+    def setUp(self):
+        blocking.size = 2
+        blocking.default_timeout = 10
+
+    def tearDown(self):
+        blocking.size = 4
+
+    def test_apply_runs_in_thread(self):
+        ident = blocking.apply(blocking.get_ident)
+        self.assertNotEqual(ident, blocking.get_ident())
+
+    def test_inline_without_threads(self):
+        blocking.size = 0
+        self.assertEqual(blocking.apply(blocking.get_ident), blocking.get_ident())
+
+    def test_other_greenlets_run(self):
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(1)
+                gevent.sleep(0.01)
+
+        greenlet = gevent.spawn(tick)
+        blocking.apply(block, (0.3,))
+        greenlet.kill()
+        self.assertGreater(len(ticks), 5)
+
+    def test_timeout(self):
+        timeouts = blocking.timeouts
+        with self.assertRaises(blocking.BlockingTimeout):
+            blocking.apply(block, (0.5,), timeout=0.1)
+        self.assertEqual(blocking.timeouts, timeouts + 1)
+
+    def test_offload_has_no_timeout(self):
+        # Offloaded methods (the database) wait as long as sqlite does
+        blocking.default_timeout = 0.1
+        slow = blocking.offload(lambda: block(0.3) or 'done')
+        self.assertEqual(slow(), 'done')
+
+    def test_same_call_shared(self):
+        calls = []
+
+        def slow(value):
+            calls.append(value)
+            block(0.2)
+            return value
+
+        greenlets = [gevent.spawn(blocking.apply, slow, (1,)) for i in range(3)]
+        gevent.joinall(greenlets)
+        self.assertEqual([x.value for x in greenlets], [1, 1, 1])
+        self.assertEqual(calls, [1])
+        self.assertEqual(blocking.pending, {})
+
+    def test_iterate(self):
+        self.assertEqual(list(blocking.iterate(range(250), count=100)), list(range(250)))
+        self.assertEqual(list(blocking.iterate([])), [])
+
+    def test_call(self):
+        self.assertEqual(blocking.call(blocking.get_ident), blocking.get_ident())
+        blocking.methods.add(blocking.get_ident)
+        try:
+            self.assertNotEqual(blocking.call(blocking.get_ident), blocking.get_ident())
+        finally:
+            blocking.methods.discard(blocking.get_ident)
+
+    def test_processes(self):
+        node = processes.get_node()
+        procs = node.get_process_dict()
+        self.assertIn(os.getpid(), [x['pid'] for x in procs])
+
+
+    def test_processes_with_sleep(self):
+        # The cpu usage is measured over one sleep for all of the processes,
+        # not a sleep for each one in its batch
+        blocking.default_timeout = 1
+        node = processes.get_node()
+        procs = node.get_process_dict(sleep=['0.2'])
+        self.assertGreater(len(procs), 10)
+        self.assertIn(os.getpid(), [x['pid'] for x in procs])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import includes_for_tests
+import os
+import sys
+import unittest
+import configparser
+import gevent
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.cache
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        listener.cache.results.clear()
+
+    def method(self):
+        self.calls += 1
+        gevent.sleep(0.05)
+        return {'value': self.calls}
+
+    def test_get_ttl(self):
+        config = configparser.ConfigParser()
+        config.add_section('api cache')
+        config.set('api cache', 'system/*', '60')
+        config.set('api cache', 'disk', '10')
+        config.set('api cache', 'disk/logical', '5')
+
+        self.assertEqual(listener.cache.get_ttl(config, ['system', 'uptime']), 60)
+        self.assertEqual(listener.cache.get_ttl(config, ['system']), 0)
+        self.assertEqual(listener.cache.get_ttl(config, ['disk', 'physical']), 10)
+        self.assertEqual(listener.cache.get_ttl(config, ['disk', 'logical', '|']), 5)
+        self.assertEqual(listener.cache.get_ttl(config, ['cpu']), 0)
+        self.assertEqual(listener.cache.get_ttl([], ['cpu']), 0)
+
+    def test_make_key(self):
+        key = listener.cache.make_key(['cpu', 'percent'], {'token': ['a'], 'aggregate': ['avg'], 'check': ['1']})
+        other = listener.cache.make_key(['cpu', 'percent'], {'check': ['1'], 'aggregate': ['avg'], 'token': ['b']})
+        self.assertEqual(key, other)
+        self.assertNotEqual(key, listener.cache.make_key(['cpu', 'percent'], {}))
+
+    def test_concurrent_calls_share_result(self):
+        greenlets = [gevent.spawn(listener.cache.get, 'key', 0, self.method) for x in range(5)]
+        gevent.joinall(greenlets)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([x.value for x in greenlets], [{'value': 1}] * 5)
+        self.assertEqual(listener.cache.in_flight, {})
+
+    def test_ttl(self):
+        self.assertEqual(listener.cache.get('key', 0, self.method), {'value': 1})
+        self.assertEqual(listener.cache.get('key', 0, self.method), {'value': 2})
+        self.assertEqual(listener.cache.get('key', 60, self.method), {'value': 3})
+        self.assertEqual(listener.cache.get('key', 60, self.method), {'value': 3})
+
+    def test_stream_shared(self):
+        def method():
+            # Getting ready to walk, like the ?sleep= of processes
+            self.calls += 1
+            gevent.sleep(0.05)
+            return iter(('{"a": ', '1', '}'))
+
+        greenlets = [gevent.spawn(lambda: ''.join(listener.cache.get_stream(('key',), 0, method)))
+                     for x in range(3)]
+        gevent.joinall(greenlets)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([x.value for x in greenlets], ['{"a": 1}'] * 3)
+        self.assertEqual(listener.cache.in_flight, {})
+
+        self.assertEqual(''.join(listener.cache.get_stream(('key',), 60, method)), '{"a": 1}')
+        self.assertEqual(listener.cache.get_stream(('key',), 60, method), ['{"a": 1}'])
+        self.assertEqual(self.calls, 2)
+
+    def test_stream_not_kept(self):
+        stream = listener.cache.get_stream(('key',), 0, lambda: iter(('{"a": ', '1', '}')))
+        self.assertIn(('key', 'stream'), listener.cache.in_flight)
+
+        # Nobody is waiting and it is not cached, so the pieces are passed
+        # on without keeping them
+        self.assertEqual(next(stream), '{"a": ')
+        self.assertEqual(listener.cache.in_flight, {})
+        self.assertEqual(''.join(stream), '1}')
+        self.assertEqual(listener.cache.results, {})
+
+    def test_killed_call_releases_waiters(self):
+        leader = gevent.spawn(listener.cache.get, 'key', 0, self.method)
+        waiter = gevent.spawn(listener.cache.get, 'key', 0, self.method)
+        gevent.sleep(0)
+        leader.kill()
+        waiter.join(1)
+
+        self.assertTrue(waiter.ready())
+        self.assertIsInstance(waiter.exception, Exception)
+        self.assertEqual(listener.cache.in_flight, {})
+
+    def test_wait_timeout(self):
+        listener.cache.wait_timeout = 0.01
+        try:
+            greenlets = [gevent.spawn(listener.cache.get, 'key', 0, self.method) for x in range(2)]
+            gevent.joinall(greenlets)
+        finally:
+            listener.cache.wait_timeout = 60
+        self.assertEqual(greenlets[0].value, {'value': 1})
+        self.assertIsInstance(greenlets[1].exception, listener.cache.WaitTimeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import includes_for_tests
+import configparser
+import gzip
+import io
+import json
+import os
+import sys
+import unittest
+import zlib
+import flask
+import werkzeug.datastructures
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.compression
+from geventwebsocket.websocket import Header
+
+
+class FakeStream(object):
+
+    def __init__(self, data=b''):
+        self.input = io.BytesIO(data)
+        self.output = io.BytesIO()
+        self.read = self.input.read
+        self.write = self.output.write
+
+
+class TestResponses(unittest.TestCase):
+
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.add_section('api')
+        config.set('api', 'community_string', 'mytoken')
+        config.add_section('general')
+        config.set('general', 'check_logging', '0')
+
+        listener.server.__INTERNAL__ = True
+        listener.server.listener.config['iconfig'] = config
+        self.client = listener.server.listener.test_client()
+        listener.compression.min_size = 200
+
+    def tearDown(self):
+        listener.compression.min_size = 1024
+
+    def test_gzip(self):
+        saved = listener.compression.get_bytes_saved()
+        response = self.client.get('/api/memory', headers={'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn('memory', json.loads(gzip.decompress(response.data)))
+        self.assertGreater(listener.compression.get_bytes_saved(), saved)
+
+    def test_deflate_stream(self):
+        response = self.client.get('/api/processes', headers={'Accept-Encoding': 'deflate'})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertIsNone(response.headers.get('Content-Length'))
+        self.assertIn('processes', json.loads(zlib.decompress(response.data)))
+
+    def test_small_or_not_accepted(self):
+        response = self.client.get('/api/memory/virtual/percent', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = self.client.get('/api/memory', headers={'Accept-Encoding': 'gzip;q=0, br'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('memory', json.loads(response.data))
+
+    def test_only_api_compressed(self):
+        accept = werkzeug.datastructures.Accept([('gzip', 1)])
+        for path, mimetype in (('/gui/admin', 'text/html'), ('/api/memory', 'text/html'),
+                               ('/gui/api', 'application/json')):
+            response = flask.Response('x' * 2048, mimetype=mimetype)
+            listener.compression.compress_response(response, accept, path)
+            self.assertNotIn('Content-Encoding', response.headers)
+
+        for path, mimetype in (('/api/memory', 'application/json'),
+                               ('/metrics', 'application/openmetrics-text')):
+            response = flask.Response('x' * 2048, mimetype=mimetype)
+            listener.compression.compress_response(response, accept, path)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+
+class TestWebSocket(unittest.TestCase):
+
+    def test_negotiate_deflate(self):
+        negotiate = listener.compression.negotiate_deflate
+
+        self.assertIsNone(negotiate(''))
+        self.assertIsNone(negotiate('x-webkit-deflate-frame'))
+        self.assertIsNone(negotiate('permessage-deflate; server_max_window_bits=8'))
+        self.assertEqual(negotiate('permessage-deflate; client_max_window_bits'),
+                         (15, False, 'permessage-deflate; client_no_context_takeover'))
+        self.assertEqual(negotiate('permessage-deflate; server_max_window_bits=20, permessage-deflate; server_no_context_takeover'),
+                         (15, True, 'permessage-deflate; client_no_context_takeover; server_no_context_takeover'))
+
+    def test_send_compressed(self):
+        stream = FakeStream()
+        ws = listener.compression.DeflateWebSocket({}, stream, None)
+        message = json.dumps([{'pid': x, 'name': 'python'} for x in range(200)])
+        ws.send(message)
+        ws.send('small')
+
+        data = stream.output.getvalue()
+        header = Header.decode_header(io.BytesIO(data))
+        self.assertTrue(data[0] & 0x40)
+        self.assertLess(header.length, len(message))
+
+        payload = data[len(data) - 7 - header.length:-7]
+        self.assertEqual(zlib.decompressobj(-15).decompress(payload + b'\x00\x00\xff\xff').decode(), message)
+        self.assertEqual(data[-5:], b'small')
+
+    def test_receive_compressed(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        payload = (compressor.compress(b'memory/virtual') + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        frames = Header.encode_header(True, 1, b'', len(payload), Header.RSV0_MASK) + payload
+        frames += Header.encode_header(True, 1, b'', 4, 0) + b'disk'
+
+        ws = listener.compression.DeflateWebSocket({}, FakeStream(frames), None)
+        self.assertEqual(ws.receive(), 'memory/virtual')
+        self.assertEqual(ws.receive(), 'disk')
+
+
+if __name__ == '__main__':
+    unittest.main()
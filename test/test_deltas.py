@@ -0,0 +1,130 @@
+import includes_for_tests
+import os
+import sys
+import tempfile
+import unittest
+import gevent
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.deltas
+
+
+class TestDeltaStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = listener.deltas.DeltaStore(max_entries=2)
+
+    def test_make_key(self):
+        key = listener.deltas.make_key('interface/eth0/bytes_sent', '127.0.0.1')
+
+        self.assertEqual(key, listener.deltas.make_key('interface/eth0/bytes_sent', '127.0.0.1'))
+        self.assertNotEqual(key, listener.deltas.make_key('interface/eth0/bytes_sent', '127.0.0.2'))
+
+    def test_update(self):
+        self.assertIsNone(self.store.update('a', [1]))
+
+        values, seconds, rates = self.store.update('a', [2])
+        self.assertEqual(values, [1])
+        self.assertGreaterEqual(seconds, 0)
+
+    def test_entries_are_bounded(self):
+        for key in ('a', 'b', 'a', 'c'):
+            self.store.update(key, [1])
+
+        self.assertEqual(list(self.store.entries.keys()), ['a', 'c'])
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'deltas.json')
+            self.store.filename = filename
+            self.store.update('a', [1, 2])
+            self.store.save()
+
+            store = listener.deltas.DeltaStore(filename=filename)
+            store.load()
+            values, seconds, rates = store.update('a', [3, 4])
+            self.assertEqual(values, [1, 2])
+
+    def test_saved_on_timer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'deltas.json')
+            store = listener.deltas.DeltaStore(filename=filename, save_interval=0.05)
+
+            # Requests never write the file themselves
+            store.update('a', [1])
+            self.assertFalse(os.path.exists(filename))
+
+            store.start()
+            try:
+                gevent.sleep(0.2)
+            finally:
+                store.stop()
+            self.assertTrue(os.path.exists(filename))
+            self.assertFalse(store.changed)
+
+
+class TestRates(unittest.TestCase):
+
+    def test_counter_rate(self):
+        self.assertEqual(listener.deltas.get_counter_rate(100, 300, 2), 100)
+        self.assertEqual(listener.deltas.get_counter_rate(2 ** 32 - 100, 100, 2), 100)
+        self.assertEqual(listener.deltas.get_counter_rate(2 ** 64 - 100, 100, 2), 100)
+        self.assertIsNone(listener.deltas.get_counter_rate(5000, 10, 2))
+        self.assertIsNone(listener.deltas.get_counter_rate(2 ** 40, 10, 2))
+
+    def test_rates(self):
+        self.assertEqual(listener.deltas.get_rates([10, 10], [5, 20], 1), [-5, 10])
+        self.assertEqual(listener.deltas.get_rates([10, 10], [5, 20], 1, counter=True), [None, 10])
+
+    def test_reset_keeps_last_rate(self):
+        listener.deltas.store = listener.deltas.DeltaStore()
+        listener.deltas.store.entries['a'] = (0, 0, [100], None)
+        listener.deltas.store.update('a', [200])
+        listener.deltas.store.set_rates('a', [50.0])
+
+        self.assertEqual(listener.deltas.get_delta_rates('a', [3], counter=True), [50.0])
+
+    def test_rates_over_collected_times(self):
+        # Sampled values are divided by the time between their samples, not
+        # between the requests that read them
+        listener.deltas.store = listener.deltas.DeltaStore()
+        self.assertEqual(listener.deltas.get_delta_rates('a', [100], collected=10.0), [0])
+        self.assertEqual(listener.deltas.get_delta_rates('a', [300], collected=12.0), [100.0])
+        self.assertEqual(listener.deltas.get_delta_rates('a', [300], collected=12.0), [100.0])
+        self.assertEqual(listener.deltas.get_delta_rates('a', [400], collected=13.0), [100.0])
+
+
+class TestDeltaNode(unittest.TestCase):
+
+    def test_delta_does_not_wait(self):
+        listener.deltas.store = listener.deltas.DeltaStore()
+        counter = iter(range(0, 1000, 10))
+        n = listener.nodes.RunnableNode('counter', lambda: (next(counter), 'B'))
+
+        self.assertEqual(n.context().walk(delta=['1'], accessor='counter'), {'counter': [0, 'B/s']})
+        rate, unit = n.context().walk(delta=['1'], accessor='counter')['counter']
+        self.assertGreater(rate, 0)
+
+    def test_leaf_rates_use_collected_time(self):
+        # Leaf walks and checks get a snapshot too, so their rates are over
+        # the times the values were collected
+        collected = []
+        n = listener.nodes.RunnableNode(
+            'counter', lambda **kwargs: (listener.snapshot.get_snapshot(kwargs).get(int), 'B'))
+        deltaize_values = n.deltaize_values
+
+        def spy(values, hash_val, remote_addr=None, collected_at=None):
+            collected.append(collected_at)
+            return deltaize_values(values, hash_val, remote_addr, collected_at)
+
+        n.deltaize_values = spy
+        n.context().walk(delta=['1'], accessor='counter')
+        n.context().get_values(delta=['1'], accessor='counter')
+        self.assertEqual(len(collected), 2)
+        self.assertTrue(all(x is not None for x in collected))
+
+
+if __name__ == '__main__':
+    unittest.main()
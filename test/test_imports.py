@@ -0,0 +1,45 @@
+import includes_for_tests
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+agent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../agent/')
+
+# Imports each module in a new interpreter and prints how long it took and
+# which of the modules we check for were loaded
+script = """
+import json, sys, time
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'loaded': [x for x in %r if x in sys.modules]}))
+"""
+
+# Modules that are slow to import and only needed by some requests
+heavy = ['flask', 'requests', 'OpenSSL', 'kafka', 'listener.server', 'listener.services',
+         'listener.processes', 'listener.pluginnodes', 'listener.certificate']
+
+
+def import_module(name):
+    output = subprocess.check_output([sys.executable, '-c', script % (name, heavy)], cwd=agent_dir)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+class TestImports(unittest.TestCase):
+
+    def test_ncpa_imports_no_listener(self):
+        # The command line (--status, --stop) does not need the listener
+        result = import_module('ncpa')
+        self.assertEqual(result['loaded'], [])
+        self.assertLess(result['seconds'], 2.0)
+
+    def test_server_imports_lazily(self):
+        result = import_module('listener.server')
+        self.assertEqual(sorted(result['loaded']), ['flask', 'listener.server'])
+        self.assertLess(result['seconds'], 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import includes_for_tests
+import os
+import sys
+import unittest
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.instrument as instrument
+
+
+class TestInstrument(unittest.TestCase):
+
+    def setUp(self):
+        instrument.reset()
+
+    def tearDown(self):
+        instrument.reset()
+
+    def test_histogram(self):
+        histogram = instrument.Histogram()
+        for x in range(100):
+            histogram.observe(0.002 if x < 90 else 0.2, error=(x == 0))
+
+        stats = histogram.as_dict()
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['p50'], 0.0025)
+        self.assertEqual(stats['p95'], 0.2)
+        self.assertEqual(stats['buckets']['0.0025'], 90)
+
+    def test_timed_counts_errors(self):
+        with instrument.timed('api', 'cpu'):
+            pass
+        with self.assertRaises(ValueError):
+            with instrument.timed('api', 'cpu'):
+                raise ValueError()
+
+        stats = instrument.get_stats()['api']['cpu']
+        self.assertEqual((stats['count'], stats['errors']), (2, 1))
+
+    def test_get_prefix(self):
+        self.assertEqual(instrument.get_prefix('/disk/logical/|/used_percent'), 'disk/logical')
+        self.assertEqual(instrument.get_prefix(''), '/')
+        self.assertEqual(instrument.get_prefix(['cpu', 'percent'], depth=1), 'cpu')
+
+    def test_max_keys(self):
+        for x in range(instrument.max_keys + 10):
+            instrument.observe('walk', 'node%d' % x, 0.001)
+
+        self.assertEqual(len(instrument.timings['walk']), instrument.max_keys + 1)
+        self.assertEqual(instrument.timings['walk']['other'].count, 10)
+
+    def test_nodes_are_timed(self):
+        node = listener.nodes.RunnableNode('test', lambda: (1, ''))
+        node.walk()
+        node.run_check(warning='2')
+
+        self.assertEqual(instrument.timings['walk']['test'].count, 1)
+        self.assertEqual(instrument.timings['check']['test'].count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import includes_for_tests
+import configparser
+import os
+import re
+import sys
+import unittest
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.metrics
+from listener.nodes import ParentNode, RunnableNode, RunnableParentNode
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.families = listener.metrics.get_families(configparser.ConfigParser())
+
+    def test_names_and_labels(self):
+        self.assertIn('ncpa_memory_virtual_total_bytes', self.families)
+        self.assertEqual(self.families['ncpa_cpu_user_seconds'].type, 'counter')
+        self.assertEqual(self.families['ncpa_system'].type, 'info')
+        if 'ncpa_memory_swap_swapped_in_bytes' in self.families:
+            self.assertEqual(self.families['ncpa_memory_swap_swapped_in_bytes'].type, 'counter')
+            self.assertEqual(self.families['ncpa_memory_swap_swapped_out_bytes'].type, 'counter')
+
+        for labels in [x[1] for x in self.families['ncpa_disk_logical_used_bytes'].samples]:
+            self.assertEqual(labels[0][0], 'mount')
+            self.assertTrue(labels[0][1].startswith('/') or ':' in labels[0][1])
+
+    def test_render(self):
+        text = listener.metrics.render(self.families)
+        self.assertTrue(text.endswith('# EOF\n'))
+        self.assertIn('# UNIT ncpa_memory_virtual_total_bytes bytes', text)
+        self.assertRegex(text, r'\nncpa_cpu_user_seconds_total\{cpu="0"\} [0-9.]+\n')
+        self.assertRegex(text, r'\nncpa_system_info\{.*agent_version="[^"]+"')
+
+        sample = re.compile(r'^[a-z_]+(\{([a-z_]+="([^"\\]|\\.)*",?)*\})? [-+0-9.eInfNa]+$')
+        for line in text.splitlines():
+            if not line.startswith('#'):
+                self.assertRegex(line, sample)
+
+    def test_render_prometheus(self):
+        text = listener.metrics.render(self.families, openmetrics=False)
+        self.assertNotIn('# EOF', text)
+        self.assertNotIn('# UNIT', text)
+        self.assertIn('# TYPE ncpa_cpu_user_seconds_total counter', text)
+        self.assertIn('# TYPE ncpa_system_info gauge', text)
+
+    def test_instances(self):
+        families = {}
+        interface = RunnableParentNode('eth0', children=[
+            RunnableNode('bytes_sent', lambda: (10, 'B'), counter=True),
+        ], primary='bytes_sent')
+        node = ParentNode('interface', children=[interface])
+        listener.metrics.collect(node, ['interface'], (), {}, families)
+
+        family = families['ncpa_interface_bytes_sent']
+        self.assertEqual(family.type, 'counter')
+        self.assertEqual(family.samples, [('', (('interface', 'eth0'),), 10)])
+
+    def test_escape(self):
+        self.assertEqual(listener.metrics.escape('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+
+class TestMetricsView(unittest.TestCase):
+
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.add_section('api')
+        config.set('api', 'community_string', 'mytoken')
+
+        listener.server.__INTERNAL__ = True
+        listener.server.listener.config['iconfig'] = config
+        self.client = listener.server.listener.test_client()
+
+    def test_content_type(self):
+        response = self.client.get('/metrics', headers={'Accept': 'application/openmetrics-text; version=1.0.0'})
+        self.assertTrue(response.headers['Content-Type'].startswith('application/openmetrics-text'))
+
+        response = self.client.get('/metrics')
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        self.assertNotIn(b'ncpa_processes', response.data)
+
+    def test_include_processes(self):
+        response = self.client.get('/metrics?include=processes')
+        self.assertIn(b'ncpa_processes_count{name=', response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
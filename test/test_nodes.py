@@ -1,6 +1,10 @@
 import includes_for_tests
+import configparser
+import gevent
+import json
 import os
 import sys
+import time
 import unittest
 
 # Load NCPA
@@ -51,6 +55,27 @@ class TestParentNode(unittest.TestCase):
     def test_walk_returns_dict(self):
         self.assertIsInstance(self.n.walk(), dict)
 
+    def test_walk_stream_matches_walk(self):
+        self.assertEqual(json.loads(''.join(self.n.walk_stream())), self.n.walk())
+
+    def test_stream_helpers(self):
+        items = [{'pid': x, 'name': 'p\u00e9%d' % x} for x in range(100)]
+        chunks = list(listener.nodes.join_chunks(listener.nodes.stream_list('processes', items), 256))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads(''.join(chunks)), {'processes': items})
+        self.assertEqual(json.loads(''.join(listener.nodes.stream_list('services', []))), {'services': []})
+
+    def test_stream_error(self):
+        def items():
+            yield {'pid': 1}
+            raise OSError('gone')
+
+        # A walk that fails part of the way still ends as a whole document
+        value = json.loads(''.join(listener.nodes.stream_list('processes', items())))
+        self.assertEqual(value['processes'], [{'pid': 1}])
+        self.assertIn('gone', value['error'])
+
     def test_run_check_returns_dict(self):
         self.assertIsInstance(self.n.run_check(), dict)
 
@@ -61,6 +86,33 @@ class TestParentNode(unittest.TestCase):
         self.assertIn('returncode', result)
 
 
+class TestConcurrentWalk(unittest.TestCase):
+
+    def setUp(self):
+        self.config = configparser.ConfigParser()
+        self.config.add_section('api')
+        self.config.set('api', 'walk_timeout', '0.2')
+
+    def test_walk_times_out_slow_children(self):
+        slow = listener.nodes.RunnableNode('slow', lambda: (gevent.sleep(5), ''))
+        fast = listener.nodes.RunnableNode('fast', lambda: (1, ''))
+        p = listener.nodes.ParentNode('parent', [slow, fast])
+
+        start = time.time()
+        result = p.walk(config=self.config)['parent']
+
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(result['fast'], 1)
+        self.assertEqual(result['slow']['error']['type'], 'timeout')
+
+    def test_walk_in_order(self):
+        self.config.set('api', 'walk_concurrency', '1')
+        fast = listener.nodes.RunnableNode('fast', lambda: (1, ''))
+        p = listener.nodes.ParentNode('parent', [fast, listener.nodes.RunnableNode('other', lambda: (2, ''))])
+
+        self.assertEqual(p.walk(config=self.config), {'parent': {'fast': 1, 'other': 2}})
+
+
 class TestRunnableNode(unittest.TestCase):
 
     def setUp(self):
@@ -70,6 +122,14 @@ class TestRunnableNode(unittest.TestCase):
     def test_accessor_returns_copy(self):
         self.assertIsNot(self.n, self.n.accessor([], None, None, None))
 
+    def test_walk_does_not_change_tree(self):
+        p = listener.nodes.ParentNode('parent', [self.n])
+        p.accessor([], None, None, None).walk(unit=['t'])
+        p.accessor([self.node_name], None, None, None).walk(unit=['t'])
+
+        self.assertIs(p.children[self.node_name], self.n)
+        self.assertEqual(self.n.unit, '')
+
     def test_walk_returns_dict(self):
         self.assertIsInstance(self.n.walk(), dict)
 
@@ -135,6 +195,58 @@ class TestRunnableNode(unittest.TestCase):
         result = self.n.run_check()
         self.assertIsInstance(result, dict)
 
+    def test_is_within_range(self):
+        cases = [
+            ('10', [(11, True), (5, False), (-1, True)]),
+            ('10:', [(9, True), (10, False), (100, False)]),
+            (':10', [(11, True), (5, False), (-1, True)]),
+            ('~:10', [(11, True), (-100, False)]),
+            ('10:20', [(9, True), (15, False), (21, True)]),
+            ('@10:20', [(9, False), (15, True), (20, True)]),
+            ('-5.5:2.5', [(-6, True), (0, False)]),
+        ]
+        for nagios_range, checks in cases:
+            for value, expected in checks:
+                self.assertEqual(self.n.is_within_range(nagios_range, value), expected, (nagios_range, value))
+                self.assertEqual(self.n.is_within_range([nagios_range], str(value)), expected, (nagios_range, value))
+
+        self.assertFalse(self.n.is_within_range('', 100))
+        self.assertRaises(Exception, self.n.is_within_range, '10:x', 1)
+
+    def test_nagios_range_any_alerts(self):
+        nagios_range = listener.nodes.get_nagios_range(['80'])
+
+        self.assertIs(nagios_range, listener.nodes.get_nagios_range('80'))
+        self.assertTrue(nagios_range.any_alerts([10, 90, 20]))
+        self.assertFalse(nagios_range.any_alerts([10, 20]))
+        self.assertFalse(nagios_range.any_alerts([]))
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    def counter(self, *args, **kwargs):
+        self.calls += 1
+        return self.calls
+
+    def test_get_is_memoized(self):
+        snapshot = listener.snapshot.Snapshot()
+
+        self.assertEqual(snapshot.get(self.counter, 'a'), 1)
+        self.assertEqual(snapshot.get(self.counter, 'a'), 1)
+        self.assertEqual(snapshot.get(self.counter, 'b'), 2)
+        self.assertEqual(snapshot.get(self.counter, 'a', perdisk=True), 3)
+
+    def test_walk_shares_snapshot(self):
+        method = lambda **kwargs: (listener.snapshot.get_snapshot(kwargs).get(self.counter), '')
+        p = listener.nodes.ParentNode('parent', [listener.nodes.RunnableNode(x, method) for x in ('a', 'b')])
+        result = p.walk()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(result['parent']['a'], result['parent']['b'])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
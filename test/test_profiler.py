@@ -0,0 +1,114 @@
+import includes_for_tests
+import configparser
+import json
+import os
+import sys
+import time
+import unittest
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.profiler
+
+
+def busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        sum(range(1000))
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_profile_call(self):
+        result, profile = listener.profiler.profile_call(lambda: busy(0.05), limit=5)
+        self.assertIsNone(result)
+        self.assertLessEqual(len(profile['functions']), 5)
+        self.assertTrue(any('busy' in x['function'] for x in profile['functions']))
+
+    def test_sampling(self):
+        sampler = listener.profiler.SamplingProfiler(interval=0.001)
+        sampler.start(0.3)
+        busy(0.3)
+        while sampler.running:
+            time.sleep(0.01)
+
+        report = sampler.report()
+        self.assertGreater(report['samples'], 0)
+        self.assertTrue(any('busy' in name for name, percent in report['total']))
+        self.assertIn('busy', sampler.collapsed())
+
+    def test_memory_diff(self):
+        tracer = listener.profiler.MemoryTracer()
+        self.assertEqual(tracer.diff(), [])
+        kept = [str(x) * 100 for x in range(10000)]
+        rows = tracer.diff()
+        tracer.stop()
+        self.assertTrue(rows)
+        self.assertIn('test_profiler.py', rows[0][0])
+        self.assertGreater(rows[0][1], 0)
+
+
+class TestProfileView(unittest.TestCase):
+
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.add_section('api')
+        config.set('api', 'community_string', 'mytoken')
+        config.add_section('listener')
+        config.set('listener', 'admin_gui_access', '1')
+
+        listener.server.listener.config['iconfig'] = config
+        self.client = listener.server.listener.test_client()
+        self.internal = listener.server.__INTERNAL__
+
+    def tearDown(self):
+        listener.server.__INTERNAL__ = self.internal
+
+    def test_profile_request(self):
+        listener.server.__INTERNAL__ = True
+        response = self.client.get('/api/memory/virtual?profile=cpu&profile_limit=10')
+        data = json.loads(response.data)
+        self.assertIn('virtual', data['value'])
+        self.assertLessEqual(len(data['profile']['functions']), 10)
+
+    def test_profile_skips_cache(self):
+        listener.server.__INTERNAL__ = True
+        for x in range(2):
+            response = self.client.get('/api/memory/virtual?max_age=60&profile=cpu&profile_limit=1000')
+        functions = [x['function'] for x in json.loads(response.data)['profile']['functions']]
+        self.assertTrue(any('walk' in x for x in functions))
+
+    def test_profile_requires_admin(self):
+        listener.server.__INTERNAL__ = False
+        response = self.client.get('/api/memory/virtual?token=mytoken&profile=cpu')
+        self.assertIn('error', json.loads(response.data))
+
+    def test_admin_page(self):
+        listener.server.__INTERNAL__ = False
+        with self.client.session_transaction() as session:
+            session['logged'] = True
+        response = self.client.get('/gui/admin/profile')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Start Profile', response.data)
+
+    def test_invalid_numbers(self):
+        listener.server.__INTERNAL__ = True
+        response = self.client.get('/api/memory/virtual?profile=cpu&profile_limit=abc')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('error', json.loads(response.data))
+        for limit in ('0', '-1'):
+            response = self.client.get('/api/memory/virtual?profile=cpu&profile_limit=' + limit)
+            self.assertIn('error', json.loads(response.data))
+
+        listener.server.__INTERNAL__ = False
+        with self.client.session_transaction() as session:
+            session['logged'] = True
+        response = self.client.post('/gui/admin/profile', data={'action': 'start', 'seconds': 'abc'},
+                                    follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'must be a number', response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
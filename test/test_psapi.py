@@ -2,6 +2,7 @@ import includes_for_tests
 import os
 import sys
 import unittest
+import psutil
 
 # Load NCPA
 sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
@@ -40,3 +41,95 @@ class TestPSApi(unittest.TestCase):
     def test_get_root_node(self):
         root_node = listener.psapi.get_root_node([])
         self.assertIsInstance(root_node, listener.nodes.ParentNode)
+
+    def test_refresh_keeps_root_node(self):
+        config = []
+        listener.psapi.root = None
+        listener.psapi.refresh(config)
+        root_node = listener.psapi.root
+        cpu_node = root_node.children['cpu']
+        listener.psapi.refresh(config)
+        self.assertIs(root_node, listener.psapi.root)
+        self.assertIs(cpu_node, listener.psapi.root.children['cpu'])
+
+    def test_refresh_builds_requested_subtree(self):
+        config = []
+        listener.psapi.root = None
+        listener.psapi.refresh(config, ['memory', 'virtual'])
+        self.assertEqual(list(listener.psapi.root.children.keys()), ['memory'])
+
+        listener.psapi.refresh(config, ['cpu'])
+        listener.psapi.refresh(config)
+        self.assertEqual(list(listener.psapi.root.children.keys())[:3], ['cpu', 'memory', 'disk'])
+
+    def test_getter_resolves_from_cache(self):
+        config = []
+        listener.psapi.root = None
+        first = listener.psapi.getter('memory/virtual/percent', config, '', {})
+        self.assertIn('memory/virtual/percent', listener.psapi.resolved)
+
+        second = listener.psapi.getter('/memory//virtual/percent/', config, '', {})
+        self.assertIsNot(first, second)
+        self.assertEqual(first.name, second.name)
+
+        missing = listener.psapi.getter('memory/nothing', config, '', {})
+        self.assertIsInstance(missing, listener.nodes.DoesNotExistNode)
+        self.assertNotIn('memory/nothing', listener.psapi.resolved)
+
+    def test_refresh_clears_resolved(self):
+        config = []
+        listener.psapi.root = None
+        listener.psapi.getter('interface/gone', config, '', {})
+        listener.psapi.resolved['interface/gone'] = listener.psapi.root.children['interface']
+
+        # A refresh made outside of getter() (websockets, graphs) that changes
+        # the tree still forgets the old nodes
+        listener.psapi.root.children['interface'].children = dict(
+            listener.psapi.root.children['interface'].children, gone=listener.nodes.ParentNode('gone'))
+        listener.psapi.refresh(config, ['interface'])
+        self.assertNotIn('interface/gone', listener.psapi.resolved)
+        node = listener.psapi.getter('interface/gone', config, '', {})
+        self.assertIsInstance(node, listener.nodes.DoesNotExistNode)
+
+    def test_sync_children(self):
+        parent = listener.nodes.ParentNode('parent')
+        make_node = lambda source: listener.nodes.ParentNode(source)
+
+        self.assertTrue(listener.psapi.sync_children(parent, {'a': 'a', 'b': 'b'}, make_node))
+        kept = parent.children['a']
+
+        self.assertFalse(listener.psapi.sync_children(parent, {'a': 'a', 'b': 'b'}, make_node))
+        self.assertTrue(listener.psapi.sync_children(parent, {'a': 'a', 'c': 'c'}, make_node))
+        self.assertIs(kept, parent.children['a'])
+        self.assertEqual(sorted(parent.children.keys()), ['a', 'c'])
+
+    def test_sync_children_copy_on_write(self):
+        parent = listener.nodes.ParentNode('parent')
+        make_node = lambda source: listener.nodes.ParentNode(source)
+        listener.psapi.sync_children(parent, {'a': 'a', 'b': 'b'}, make_node)
+
+        # A walk that is iterating the children is not disturbed by a refresh
+        walking = iter(parent.children.items())
+        next(walking)
+        self.assertTrue(listener.psapi.sync_children(parent, {'c': 'c'}, make_node))
+        self.assertEqual([x[0] for x in walking], ['b'])
+        self.assertEqual(list(parent.children.keys()), ['c'])
+
+    def test_process_standard_form(self):
+        node = listener.psapi.get_processes_node()
+        process = psutil.Process(os.getpid())
+
+        # Values read by process_iter are used, denied ones are unknown and
+        # the rest are read from the process
+        process.info = {'name': 'prefetched', 'exe': None}
+        proc = node.standard_form(node, process, {})
+        self.assertEqual(proc['name'], 'prefetched')
+        self.assertEqual(proc['exe'], 'Unknown')
+        self.assertEqual(proc['username'], process.username())
+        self.assertEqual(proc['pid'], os.getpid())
+
+    def test_process_walk(self):
+        node = listener.psapi.get_processes_node()
+        procs = node.get_process_dict(name=[psutil.Process().name()])
+        self.assertIn(os.getpid(), [x['pid'] for x in procs])
+        self.assertTrue(all(x['exe'] and x['mem_rss'][0] > 0 for x in procs))
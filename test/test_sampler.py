@@ -0,0 +1,123 @@
+import includes_for_tests
+import collections
+import os
+import sys
+import unittest
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.sampler
+import listener.snapshot
+
+class TestSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.s = listener.sampler.Sampler(interval=1, history=5)
+
+    def tearDown(self):
+        listener.sampler.sampler = None
+
+    def test_collect_adds_sample(self):
+        sample = self.s.collect()
+
+        self.assertEqual(len(self.s.samples), 1)
+        self.assertIn(listener.sampler.make_key(listener.sampler.ps.virtual_memory, (), {}), sample.values)
+
+    def test_ring_buffer_size(self):
+        for x in range(10):
+            self.s.collect()
+
+        self.assertEqual(len(self.s.samples), 5)
+
+    def test_latest(self):
+        self.assertRaises(KeyError, self.s.latest, listener.sampler.ps.virtual_memory)
+
+        sample = self.s.collect()
+        key = listener.sampler.make_key(listener.sampler.ps.swap_memory, (), {})
+        self.assertIs(self.s.latest(listener.sampler.ps.swap_memory), sample.values[key])
+
+    def test_watch(self):
+        self.assertTrue(self.s.watch(listener.sampler.ps.disk_usage, '/'))
+        self.assertFalse(self.s.watch(len, '/'))
+
+    def test_snapshot_reads_sample(self):
+        listener.sampler.sampler = self.s
+        sample = self.s.collect()
+
+        snapshot = listener.snapshot.Snapshot()
+        key = listener.sampler.make_key(listener.sampler.ps.virtual_memory, (), {})
+        self.assertIs(snapshot.get(listener.sampler.ps.virtual_memory), sample.values[key])
+
+    def test_cpu_busy_percent(self):
+        times = collections.namedtuple('times', ['user', 'system', 'idle'])
+        self.assertEqual(listener.sampler.cpu_busy_percent(times(10, 10, 80), times(40, 20, 140)), 40.0)
+        self.assertEqual(listener.sampler.cpu_busy_percent(times(10, 10, 80), times(10, 10, 80)), 0.0)
+
+    def test_sample_before(self):
+        for x in range(5):
+            self.s.samples.append(listener.sampler.Sample(x, x, {}))
+
+        self.assertEqual(self.s.sample_before(1).time, 3)
+        self.assertEqual(self.s.sample_before(3).time, 1)
+        self.assertEqual(self.s.sample_before(60).time, 0)
+
+    def test_cpu_percent(self):
+        self.s.collect()
+        self.assertRaises(KeyError, self.s.cpu_percent)
+
+        self.s.collect()
+        percent = self.s.cpu_percent(window=5)
+        self.assertEqual(len(percent), listener.sampler.ps.cpu_count())
+        for value in percent:
+            self.assertTrue(0 <= value <= 100)
+
+    def test_cpu_percent_window(self):
+        listener.sampler.sampler = self.s
+        try:
+            node = listener.psapi.get_cpu_node().children['percent']
+            for window in (['0'], ['-5'], ['x']):
+                self.assertIn('error', node.context().walk(window=window)['percent'])
+                self.assertEqual(node.context().run_check(window=window)['returncode'], 3)
+        finally:
+            listener.sampler.sampler = None
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.s = listener.sampler.Sampler(interval=1, history=60)
+        key = listener.sampler.make_key(listener.sampler.ps.swap_memory, (), {})
+        for x in range(10):
+            self.s.samples.append(listener.sampler.Sample(x, 1000 + x, {key: [x, 10 * x]}))
+        listener.sampler.sampler = self.s
+
+        method = lambda **kwargs: (listener.snapshot.get_snapshot(kwargs).get(listener.sampler.ps.swap_memory), 'B')
+        self.n = listener.nodes.RunnableNode('swap', method)
+
+    def tearDown(self):
+        listener.sampler.sampler = None
+
+    def test_history(self):
+        series, unit = self.n.walk(history=['4'], step=['2'])['swap']
+
+        self.assertEqual(unit, 'B')
+        self.assertEqual(len(series), 3)
+        self.assertEqual(series[0], {'timestamp': 1005, 'min': [5, 50], 'max': [6, 60], 'avg': [5.5, 55.0]})
+        self.assertEqual(series[-1]['min'], [9, 90])
+
+    def test_history_delta(self):
+        series, unit = self.n.walk(history=['3'], delta=['1'])['swap']
+
+        self.assertEqual(unit, 'B/s')
+        self.assertEqual([x['avg'] for x in series], [[1.0, 10.0]] * 4)
+
+    def test_history_not_sampled(self):
+        n = listener.nodes.RunnableNode('uptime', lambda: (1, 's'))
+
+        self.assertIn('error', n.walk(history=['3'])['uptime'])
+        self.assertIn('error', self.n.walk(history=['x'])['swap'])
+
+
+if __name__ == '__main__':
+    unittest.main()
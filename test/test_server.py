@@ -0,0 +1,93 @@
+import includes_for_tests
+import os
+import sys
+import unittest
+import json
+import configparser
+import psutil
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.cache
+
+
+class TestAPI(unittest.TestCase):
+
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.add_section('api')
+        config.set('api', 'community_string', 'mytoken')
+        config.add_section('general')
+        config.set('general', 'check_logging', '0')
+
+        listener.server.__INTERNAL__ = True
+        listener.server.listener.config['iconfig'] = config
+        self.client = listener.server.listener.test_client()
+
+    def test_api(self):
+        response = self.client.get('/api/memory/virtual/percent')
+        self.assertIn('percent', json.loads(response.data))
+
+    def test_api_max_age(self):
+        listener.cache.results.clear()
+        self.client.get('/api/memory/virtual/percent?max_age=60')
+        self.assertEqual(len(listener.cache.results), 1)
+
+        self.client.get('/api/memory/virtual/percent?max_age=60&token=other')
+        self.assertEqual(len(listener.cache.results), 1)
+
+    def test_api_streams_processes(self):
+        name = psutil.Process().name()
+        response = self.client.get('/api/processes?name=%s' % name)
+        self.assertIsNone(response.headers.get('Content-Length'))
+        self.assertIsNotNone(self.client.get('/api/memory').headers.get('Content-Length'))
+
+        processes = json.loads(response.data)['processes']
+        self.assertTrue(processes)
+        for process in processes:
+            self.assertEqual(process['name'], name)
+
+    def test_agent_stats(self):
+        self.client.get('/api/memory/virtual/percent')
+        stats = json.loads(self.client.get('/api/agent/stats').data)['stats']
+
+        self.assertIn('memory/virtual', stats['timings']['api'])
+        self.assertIn('bytes_saved', stats['compression'])
+
+    def test_bulk(self):
+        queries = [
+            {'accessor': 'memory/virtual/percent'},
+            {'accessor': '/api/memory/virtual', 'args': {'check': 1, 'warning': '100'}},
+            {'accessor': 'memory/nothing'},
+            {'args': {}},
+        ]
+        response = self.client.post('/api/_bulk', data=json.dumps(queries), content_type='application/json')
+        results = json.loads(response.data)
+
+        self.assertEqual(len(results), 4)
+        self.assertIn('percent', results[0])
+        self.assertEqual(results[1]['returncode'], 0)
+        self.assertIn('error', results[2])
+        self.assertIn('error', results[3])
+
+    def test_bulk_json_flags(self):
+        queries = [
+            {'accessor': 'memory/virtual/percent', 'args': {'check': False}},
+            {'accessor': 'memory/virtual/percent', 'args': {'check': 0, 'delta': None}},
+            {'accessor': 'memory/virtual/percent', 'args': {'check': True, 'warning': 0}},
+        ]
+        response = self.client.post('/api/_bulk', data=json.dumps(queries), content_type='application/json')
+        results = json.loads(response.data)
+
+        self.assertIn('percent', results[0])
+        self.assertIn('percent', results[1])
+        self.assertIn('returncode', results[2])
+
+    def test_bulk_requires_list(self):
+        response = self.client.post('/api/_bulk', data='{}', content_type='application/json')
+        self.assertIn('error', json.loads(response.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import includes_for_tests
+import configparser
+import multiprocessing
+import os
+import sys
+import time
+import unittest
+import gevent
+
+# Load NCPA
+sys.path.append(os.path.join(os.path.dirname(__file__), '../agent/'))
+import listener.server
+import listener.workers as workers
+
+
+class FakeServer(object):
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.closed = False
+
+    def serve_forever(self):
+        if self.fail:
+            raise Exception('failed to serve')
+        gevent.sleep(60)
+
+    def stop(self, timeout=None):
+        os._exit(0)
+
+    def close(self):
+        self.closed = True
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        workers.table = multiprocessing.RawArray('d', 2 * len(workers.fields))
+        workers.slot = None
+
+    def tearDown(self):
+        workers.table = None
+        workers.slot = None
+
+    def test_get_count(self):
+        config = configparser.ConfigParser()
+        self.assertEqual(workers.get_count(config), 1)
+        config.add_section('listener')
+        config.set('listener', 'workers', '4')
+        self.assertEqual(workers.get_count(config), 4 if os.name == 'posix' else 1)
+        config.set('listener', 'workers', '0')
+        self.assertEqual(workers.get_count(config), 1)
+
+    def test_count_request(self):
+        workers.count_request()
+        self.assertEqual(workers.get_value(1, 'requests'), 0)
+
+        workers.slot = 1
+        workers.set_value(1, 'pid', os.getpid())
+        workers.count_request()
+        workers.count_request(error=True)
+
+        stats = workers.get_stats()
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats[1]['requests'], 2)
+        self.assertEqual(stats[1]['errors'], 1)
+        self.assertTrue(stats[1]['current'])
+        self.assertGreater(stats[1]['memory_rss'], 0)
+        self.assertFalse(stats[0]['current'])
+
+    def test_no_stats_with_one_process(self):
+        workers.table = None
+        self.assertIsNone(workers.get_stats())
+
+    def wait_for_exit(self, supervisor, timeout=10):
+        end = time.monotonic() + timeout
+        while supervisor.workers and time.monotonic() < end:
+            supervisor.reap()
+            time.sleep(0.05)
+
+    @unittest.skipUnless(os.name == 'posix', 'workers are posix only')
+    def test_supervisor_restarts_workers(self):
+        server = FakeServer(fail=True)
+        supervisor = workers.Supervisor(server, 2)
+
+        # A worker that fails right away is restarted after a delay
+        supervisor.start_worker(0)
+        self.assertGreater(workers.get_value(0, 'pid'), 0)
+        self.wait_for_exit(supervisor)
+        self.assertEqual(supervisor.workers, {})
+        self.assertEqual(supervisor.delays[0], 1)
+        self.assertIn(0, supervisor.restart_at)
+
+        # The delay doubles while it keeps failing
+        supervisor.start_worker(0)
+        self.assertEqual(workers.get_value(0, 'restarts'), 1)
+        self.wait_for_exit(supervisor)
+        self.assertEqual(supervisor.delays[0], 2)
+        self.assertEqual(workers.get_value(1, 'pid'), 0)
+
+    @unittest.skipUnless(os.name == 'posix', 'workers are posix only')
+    def test_supervisor_stops_workers(self):
+        server = FakeServer()
+        supervisor = workers.Supervisor(server, 1)
+        supervisor.start_worker(0)
+        supervisor.stopping = True
+        supervisor.stop_workers(timeout=5)
+        self.assertEqual(supervisor.workers, {})
+        self.assertTrue(server.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()